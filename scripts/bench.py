@@ -0,0 +1,342 @@
+# Бенчмарк конвеєра інтеграції на локальних заглушках Koha/DSpace (продакшн не чіпається):
+# docker compose exec kdv-api python3 -m src.bench --books 100 --workers 4
+#
+# Затримка та збої бекендів:
+# docker compose exec kdv-api python3 -m src.bench --koha-latency 30 --dspace-latency 80 --error-rate 0.02
+#
+# Перевірка регресії відносно збереженого прогону (код виходу 1, якщо гірше за допуск):
+# docker compose exec kdv-api python3 -m src.bench --save bench_baseline.json
+# docker compose exec kdv-api python3 -m src.bench --baseline bench_baseline.json --tolerance 0.15
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import resource
+import tempfile
+import threading
+import concurrent.futures
+from datetime import datetime
+
+from .bench_fakes import FakeKoha, FakeDSpace, write_synthetic_pdf
+
+logger = logging.getLogger("Bench")
+
+SCENARIOS = ("integrate", "robot", "nightwalker")
+BENCH_TOKEN = "kdv-bench-token"
+COLLECTION_UUID = "00000000-0000-4000-8000-00000000bench"
+INBOX = "inbox"
+# Результати, що не є збоєм (інтеграція, робот, категорії аудиту Night Walker)
+OK_OUTCOMES = {"SUCCESS", "LINKED", "PREFILTER_IMPORTED", "ok", "synced", "skipped", "zombie"}
+TOUCHED_AHEAD = 60   # секунд: «редагування» в Koha пізніше за lastModified у DSpace (поріг аудиту — 5 с)
+
+
+def configure_environment(koha_url, dspace_url, work_dir):
+    """
+    Конфіг src читається з env під час імпорту, тож викликати до імпорту модулів src.
+    Адреси бекендів, облікові дані та шляхи примусово вказують на заглушки і робочу
+    папку (навіть якщо .env налаштований на продакшн); решту налаштувань
+    (повтори, breaker, кеші) можна задати через env, як у продакшні.
+    """
+    os.environ.update({
+        "KDV_API_TOKEN": BENCH_TOKEN,
+        "KOHA_API_URL": koha_url, "KOHA_OPAC_URL": koha_url,
+        "KOHA_API_USER": "bench", "KOHA_API_PASS": "bench",
+        "DSPACE_API_URL": dspace_url, "DSPACE_UI_URL": "http://dspace.bench",
+        "DSPACE_API_USER": "bench", "DSPACE_API_PASS": "bench",
+        "INTEGRATOR_MOUNT_PATH": os.path.join(work_dir, "drive"),
+        "STAGING_DIR": os.path.join(work_dir, "staging"),
+        "STATE_DB_PATH": os.path.join(work_dir, "state.db"),
+        "MAPPING_CONFIG_PATH": "",
+        "WATCHER_ENABLED": "false",
+        "RESUME_ON_START": "false",
+    })
+
+
+class RssSampler:
+    """
+    Пік RSS процесу за час сценарію: фонове опитування /proc/self/statm.
+    Без /proc (не Linux) — ru_maxrss, тобто пік за весь процес.
+    Заглушки працюють у тому ж процесі, їхня частка мала (файли вони не зберігають).
+    """
+
+    INTERVAL = 0.05
+
+    def __init__(self):
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+        self._page_size = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+    def _current(self):
+        try:
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * self._page_size
+        except OSError:
+            return None
+
+    def _loop(self):
+        while not self._stop.wait(self.INTERVAL):
+            rss = self._current()
+            if rss: self.peak = max(self.peak, rss)
+
+    def __enter__(self):
+        self.peak = self._current() or 0
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        if not self.peak:
+            # ru_maxrss на Linux — у KB, на macOS — у байтах
+            maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            self.peak = maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+def timed(func, latencies):
+    """Обгортка, що додає тривалість кожного виклику func(item, ...) у latencies."""
+    def wrapper(item, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return func(item, *args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - started)
+    return wrapper
+
+
+def summarize(books, outcomes, latencies, elapsed, peak_rss):
+    from .audit_report import percentile
+    ordered = sorted(latencies)
+    ok = sum(count for result, count in outcomes.items() if result in OK_OUTCOMES)
+    return {
+        "books": books,
+        "ok": ok,
+        "failed": sum(outcomes.values()) - ok,
+        "elapsed_s": round(elapsed, 2),
+        "books_per_min": round(books / max(elapsed, 1e-9) * 60, 1),
+        "p50_s": round(percentile(ordered, 50), 3) if ordered else None,
+        "p95_s": round(percentile(ordered, 95), 3) if ordered else None,
+        "peak_rss_mb": round(peak_rss / 1024 / 1024, 1),
+        "outcomes": outcomes,
+    }
+
+
+def seed_books(koha, ids, work_dir, pdf_kb, covers):
+    """Синтетичні PDF на «диску» та записи Koha з 956$u, що на них вказують."""
+    inbox = os.path.join(work_dir, "drive", INBOX)
+    os.makedirs(inbox, exist_ok=True)
+    for biblionumber in ids:
+        name = f"bench_{biblionumber}.pdf"
+        write_synthetic_pdf(os.path.join(inbox, name), pdf_kb, title=f"Book {biblionumber}")
+        koha.add_biblio(biblionumber, f"{INBOX}/{name}", COLLECTION_UUID, cover=not covers)
+
+
+# --- СЦЕНАРІЇ ---
+
+def run_integrate_scenario(ids, workers):
+    """process_integration_logic напряму, workers інтеграцій одночасно (як потоки gunicorn)."""
+    from .app import process_integration_logic
+    outcomes, latencies = {}, []
+    integrate = timed(process_integration_logic, latencies)
+
+    def one(biblionumber):
+        try:
+            result = integrate(f"bench-{biblionumber}", biblionumber)
+            return "LINKED" if result.get('status') == 'linked_existing' else "SUCCESS"
+        except Exception as e:
+            logger.warning(f"#{biblionumber} failed: {e}")
+            return "FAILED"
+
+    started = time.perf_counter()
+    with RssSampler() as rss, concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        for result in executor.map(one, ids):
+            outcomes[result] = outcomes.get(result, 0) + 1
+    return summarize(len(ids), outcomes, latencies, time.perf_counter() - started, rss.peak)
+
+
+def run_robot_scenario(ids, workers):
+    """
+    Робот у конвеєрному режимі (AIMD, стеля workers) проти Flask API на локальному порту:
+    pre-filter bulk-запитом до Koha, POST /integrate, очікування callback-а.
+    """
+    from werkzeug.serving import make_server
+    from .app import app
+    from . import robot
+
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    listener = robot.CallbackListener("127.0.0.1", 0)
+    original_api, original_process = robot.API_BASE, robot.process_single_biblio
+    robot.API_BASE = f"http://127.0.0.1:{server.server_port}/kdv/api"
+    latencies = []
+    robot.process_single_biblio = timed(original_process, latencies)
+    try:
+        started = time.perf_counter()
+        with RssSampler() as rss:
+            outcomes = {}
+            queue = robot.prefilter_candidates((str(i) for i in ids), outcomes)
+            for result, count in robot.run_pipeline(queue, workers, total=len(ids), listener=listener).items():
+                outcomes[result] = outcomes.get(result, 0) + count
+        return summarize(len(ids), outcomes, latencies, time.perf_counter() - started, rss.peak)
+    finally:
+        robot.API_BASE, robot.process_single_biblio = original_api, original_process
+        listener.close()
+        server.shutdown()
+
+
+def run_nightwalker_scenario(ids, workers):
+    """Аудит Night Walker по всіх записах (частина з них «відредагована» і потребує sync)."""
+    from . import nightwalker
+
+    nightwalker.setup_concurrency(workers)
+    latencies = []
+    outcomes = {}
+    started = time.perf_counter()
+    with RssSampler() as rss:
+        for _, category in nightwalker.audit_stream(timed(nightwalker.audit_record, latencies), ids):
+            outcomes[category] = outcomes.get(category, 0) + 1
+    return summarize(len(ids), outcomes, latencies, time.perf_counter() - started, rss.peak)
+
+
+# --- ЗВІТ ---
+
+def format_report(params, results, backends):
+    lines = [f"KDV bench {params['started']}: {params['books']} books x {params['pdf_kb']} KB, "
+             f"{params['workers']} workers, Koha {params['koha_latency']}±{params['jitter']} ms, "
+             f"DSpace {params['dspace_latency']}±{params['jitter']} ms, errors {params['error_rate']:.1%}",
+             f"{'scenario':<12} {'books':>6} {'ok':>6} {'failed':>6} {'books/min':>10} {'p50 s':>8} {'p95 s':>8} {'RSS MB':>8}"]
+    for name, r in results.items():
+        lines.append(f"{name:<12} {r['books']:>6} {r['ok']:>6} {r['failed']:>6} {r['books_per_min']:>10} "
+                     f"{r['p50_s'] if r['p50_s'] is not None else '-':>8} {r['p95_s'] if r['p95_s'] is not None else '-':>8} "
+                     f"{r['peak_rss_mb']:>8}")
+    for name, r in results.items():
+        lines.append(f"  {name}: {r['outcomes']}")
+    lines.append(f"  backends: {backends}")
+    return "\n".join(lines)
+
+
+def compare_with_baseline(results, baseline, tolerance):
+    """Регресії відносно збереженого прогону: books/min нижче або p95 вище більш ніж на tolerance."""
+    problems = []
+    for name, current in results.items():
+        base = baseline.get('scenarios', {}).get(name)
+        if not base: continue
+        if base['books_per_min'] and current['books_per_min'] < base['books_per_min'] * (1 - tolerance):
+            problems.append(f"{name}: books/min {current['books_per_min']} < baseline {base['books_per_min']}")
+        if base['p95_s'] and current['p95_s'] and current['p95_s'] > base['p95_s'] * (1 + tolerance):
+            problems.append(f"{name}: p95 {current['p95_s']}s > baseline {base['p95_s']}s")
+    return problems
+
+
+def build_arg_parser():
+    ap = argparse.ArgumentParser(description="KDV Bench: пропускна здатність інтеграції на локальних заглушках Koha/DSpace")
+    ap.add_argument("--books", type=int, default=50, help="Книг на сценарій")
+    ap.add_argument("--pdf-kb", type=int, default=512, help="Розмір синтетичного PDF")
+    ap.add_argument("--workers", type=int, default=4, help="Паралельність (потоки інтеграції / стеля робота / воркери аудиту)")
+    ap.add_argument("--scenarios", default=",".join(SCENARIOS), help=f"Через кому: {', '.join(SCENARIOS)}")
+    ap.add_argument("--koha-latency", type=float, default=20, help="Затримка відповіді Koha, мс")
+    ap.add_argument("--dspace-latency", type=float, default=50, help="Затримка відповіді DSpace, мс")
+    ap.add_argument("--jitter", type=float, default=10, help="± випадкова добавка до затримки, мс")
+    ap.add_argument("--error-rate", type=float, default=0.0, help="Частка запитів, на які заглушки відповідають 503")
+    ap.add_argument("--index-delay", type=float, default=2.0, help="Через скільки секунд новий Item видно в discover (Solr)")
+    ap.add_argument("--touch-ratio", type=float, default=0.2, help="Частка записів, «відредагованих» у Koha перед аудитом")
+    ap.add_argument("--covers", action="store_true", help="Генерувати й завантажувати обкладинки (потрібні pdf2image і poppler)")
+    ap.add_argument("--seed", type=int, default=None, help="Seed генератора затримок/збоїв (відтворюваний прогін)")
+    ap.add_argument("--output", default="bench_output.txt", help="Текстовий звіт (дописується)")
+    ap.add_argument("--save", metavar="FILE", help="Зберегти результати в JSON (напр., як baseline)")
+    ap.add_argument("--baseline", metavar="FILE", help="JSON попереднього прогону для порівняння")
+    ap.add_argument("--tolerance", type=float, default=0.15, help="Допустиме погіршення відносно baseline (частка)")
+    ap.add_argument("--work-dir", help="Робоча папка (диск, staging, БД стану). За замовчуванням тимчасова, видаляється")
+    ap.add_argument("--verbose", action="store_true", help="Логи інтегратора (INFO) у stdout")
+    return ap
+
+
+def main():
+    args = build_arg_parser().parse_args()
+    started_at = datetime.now().isoformat(timespec='seconds')
+    scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        sys.exit(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+
+    output = os.path.abspath(args.output)
+    save_path = os.path.abspath(args.save) if args.save else None
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+    work_dir = os.path.abspath(args.work_dir) if args.work_dir else tempfile.mkdtemp(prefix="kdv-bench-")
+    os.makedirs(work_dir, exist_ok=True)
+
+    fault = {"jitter": args.jitter / 1000, "error_rate": args.error_rate, "seed": args.seed}
+    koha = FakeKoha(latency=args.koha_latency / 1000, **fault).start()
+    dspace = FakeDSpace(latency=args.dspace_latency / 1000, index_delay=args.index_delay, **fault).start()
+    configure_environment(koha.url, dspace.url, work_dir)
+    # logs/ робота й Night Walker — у робочій папці, а не в поточній
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+
+    try:
+        # Імпорт лише після configure_environment: config.py читає env під час імпорту
+        from . import app, robot, nightwalker  # noqa: F401 (реєструють логування до його приглушення)
+        if not args.verbose:
+            logging.getLogger().setLevel(logging.WARNING)
+            logging.getLogger("werkzeug").setLevel(logging.WARNING)
+        logging.getLogger("Bench").setLevel(logging.INFO)
+
+        runners = {"integrate": run_integrate_scenario, "robot": run_robot_scenario}
+        id_ranges = {}
+        next_id = 1
+        for name in scenarios:
+            if name == "nightwalker": continue
+            id_ranges[name] = list(range(next_id, next_id + args.books))
+            next_id += args.books
+            seed_books(koha, id_ranges[name], work_dir, args.pdf_kb, args.covers)
+
+        results = {}
+        for name in scenarios:
+            if name == "nightwalker":
+                # Аудит проходить усе, що інтегрували попередні сценарії (або свіжі записи)
+                ids = [i for r in id_ranges.values() for i in r]
+                if not ids:
+                    ids = list(range(next_id, next_id + args.books))
+                    seed_books(koha, ids, work_dir, args.pdf_kb, args.covers)
+                for biblionumber in ids[:int(len(ids) * args.touch_ratio)]:
+                    koha.touch(biblionumber, time.time() + TOUCHED_AHEAD)
+                results[name] = run_nightwalker_scenario(ids, args.workers)
+            else:
+                results[name] = runners[name](id_ranges[name], args.workers)
+            logger.info(f"🏁 {name}: {results[name]['books_per_min']} books/min, p95 {results[name]['p95_s']}s")
+    finally:
+        os.chdir(cwd)
+        koha.stop()
+        dspace.stop()
+
+    params = {
+        "started": started_at,
+        "books": args.books, "pdf_kb": args.pdf_kb, "workers": args.workers,
+        "koha_latency": args.koha_latency, "dspace_latency": args.dspace_latency,
+        "jitter": args.jitter, "error_rate": args.error_rate, "index_delay": args.index_delay,
+    }
+    report = format_report(params, results, {"koha": koha.stats(), "dspace": dspace.stats()})
+    problems = compare_with_baseline(results, baseline, args.tolerance) if baseline else []
+    if baseline:
+        report += "\n  baseline: " + ("; ".join(problems) if problems else f"OK (tolerance {args.tolerance:.0%})")
+    print(report)
+    with open(output, 'a', encoding='utf-8') as f:
+        f.write(report + "\n\n")
+    if save_path:
+        with open(save_path, 'w', encoding='utf-8') as f:
+            json.dump({"params": params, "scenarios": results}, f, ensure_ascii=False, indent=2)
+    if not args.work_dir:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,490 @@
+"""
+Легкі локальні заглушки Koha та DSpace для бенчмарку (scripts/bench.py).
+Реалізують лише ті ендпоінти, якими користуються KohaClient і DSpaceClient:
+MARCXML /biblios, CGI-логін і сторінки обкладинок, authn, discover, items,
+bundles, bitstreams. Затримка (latency ± jitter) та частка відповідей 503
+задаються на кожен сервер. Лише стандартна бібліотека: заглушки не залежать від src.
+"""
+import re
+import json
+import time
+import uuid
+import random
+import hashlib
+import threading
+from urllib.parse import urlsplit, parse_qs
+from xml.sax.saxutils import escape
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+MARC_NS = "http://www.loc.gov/MARC21/slim"
+F005_PATTERN = re.compile(r'(<(?:\w+:)?controlfield tag="005">)[^<]*(</(?:\w+:)?controlfield>)')
+XML_DECLARATION = re.compile(r'^\s*<\?xml[^>]*\?>\s*')
+
+
+def marc_timestamp(when=None):
+    """Поле 005 (YYYYMMDDHHMMSS.F, UTC — як lastModified у заглушці DSpace)."""
+    return time.strftime("%Y%m%d%H%M%S.0", time.gmtime(when or time.time()))
+
+
+def iso_timestamp(when=None):
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(when or time.time()))
+
+
+def write_synthetic_pdf(path, size_kb=256, title="Benchmark"):
+    """
+    Мінімальний коректний PDF (одна сторінка з текстом) з правильною таблицею xref,
+    доповнений до size_kb незадіяним потоком випадкових байтів. Проходить preflight
+    і рендериться poppler-ом.
+    """
+    content = f"BT /F1 24 Tf 72 720 Td ({title}) Tj ET".encode('latin-1', 'replace')
+    filler = random.randbytes(max(0, size_kb * 1024 - 1024))
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents 4 0 R "
+        b"/Resources << /Font << /F1 5 0 R >> >> >>",
+        b"<< /Length %d >>\nstream\n" % len(content) + content + b"\nendstream",
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+        b"<< /Length %d >>\nstream\n" % len(filler) + filler + b"\nendstream",
+    ]
+    out = bytearray(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n" % number + body + b"\nendobj\n"
+    xref_offset = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    for offset in offsets:
+        out += b"%010d 00000 n \n" % offset
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref_offset)
+    with open(path, 'wb') as f:
+        f.write(out)
+    return len(out)
+
+
+def _multipart_file(body, content_type):
+    """Вміст файлової частини multipart/form-data (без зовнішніх бібліотек)."""
+    match = re.search(r'boundary="?([^";]+)"?', content_type or '')
+    if not match: return body
+    for part in body.split(b'--' + match.group(1).encode('latin-1')):
+        head, sep, content = part.partition(b'\r\n\r\n')
+        if sep and b'filename=' in head:
+            return content[:-2] if content.endswith(b'\r\n') else content
+    return b''
+
+
+class FakeRequest:
+    __slots__ = ('method', 'path', 'query', 'headers', 'body', 'cookies')
+
+    def __init__(self, method, raw_path, headers, body):
+        parts = urlsplit(raw_path)
+        self.method = method
+        self.path = parts.path
+        self.query = {k: v[0] for k, v in parse_qs(parts.query, keep_blank_values=True).items()}
+        self.headers = headers
+        self.body = body
+        self.cookies = {}
+        for chunk in (headers.get('Cookie') or '').split(';'):
+            name, sep, value = chunk.strip().partition('=')
+            if sep: self.cookies[name] = value
+
+    def form(self):
+        return {k: v[0] for k, v in parse_qs(self.body.decode('utf-8', 'replace')).items()}
+
+
+class FakeBackend:
+    """
+    HTTP-сервер заглушки: таблиця маршрутів (method, regex шляху, обробник),
+    затримка latency ± jitter на кожен запит і 503 з імовірністю error_rate.
+    Обробник повертає (status, body) або (status, body, headers); dict -> JSON.
+    """
+
+    name = "backend"
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.requests = 0
+        self.injected_errors = 0
+        self.url = None
+        self.server = None
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.routes = [(method, re.compile(f"^{pattern}$"), handler) for method, pattern, handler in self.build_routes()]
+
+    def build_routes(self):
+        return []
+
+    def start(self, host="127.0.0.1", port=0):
+        backend = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"   # keep-alive: пул з'єднань requests працює як з реальним сервером
+
+            def _handle(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                backend._serve(self, FakeRequest(self.command, self.path, self.headers, body))
+
+            do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = _handle
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://{host}:{self.server.server_port}"
+        threading.Thread(target=self.server.serve_forever, name=f"fake-{self.name}", daemon=True).start()
+        return self
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def stats(self):
+        return {"requests": self.requests, "injected_errors": self.injected_errors}
+
+    def _serve(self, http, req):
+        with self._lock:
+            self.requests += 1
+            delay = max(0.0, self.latency + self._random.uniform(-self.jitter, self.jitter))
+            fail = self._random.random() < self.error_rate
+            if fail: self.injected_errors += 1
+        if delay: time.sleep(delay)
+
+        if fail:
+            result = (503, {"error": "injected failure"})
+        else:
+            result = (404, {"error": f"{req.method} {req.path} not emulated"})
+            for method, pattern, handler in self.routes:
+                match = pattern.match(req.path)
+                if method == req.method and match:
+                    try:
+                        result = handler(req, *match.groups())
+                    except Exception as e:
+                        result = (500, {"error": str(e)})
+                    break
+
+        status, body, headers = result if len(result) == 3 else (*result, {})
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode('utf-8')
+            headers.setdefault('Content-Type', 'application/json')
+        elif isinstance(body, str):
+            body = body.encode('utf-8')
+        http.send_response(status)
+        for key, value in headers.items():
+            http.send_header(key, value)
+        http.send_header('Content-Length', str(len(body)))
+        http.end_headers()
+        http.wfile.write(body)
+
+
+class FakeKoha(FakeBackend):
+    """
+    Koha: REST /api/v1/biblios (MARCXML і JSON) та CGI-інтерфейс персоналу
+    (логін з CSRF, upload-file.pl, upload-cover-image.pl, svc/report).
+    Записи зберігаються як MARCXML: PUT від інтегратора підміняє запис цілком.
+    """
+
+    name = "koha"
+    CSRF = "bench-csrf-token"
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.records = {}      # { biblionumber: MARCXML }
+        self.updated = {}      # { biblionumber: час зміни }
+        self.covers = {}       # { biblionumber: imagenumber }
+        self.sessions = set()
+        self._uploads = 0
+
+    def build_routes(self):
+        return [
+            ("GET", r"/api/v1/biblios/(\d+)", self.get_biblio),
+            ("PUT", r"/api/v1/biblios/(\d+)", self.put_biblio),
+            ("GET", r"/api/v1/biblios", self.list_biblios),
+            ("GET", r"/cgi-bin/koha/mainpage.pl", self.mainpage),
+            ("POST", r"/cgi-bin/koha/mainpage.pl", self.login),
+            ("GET", r"/cgi-bin/koha/tools/upload-cover-image.pl", self.cover_page),
+            ("POST", r"/cgi-bin/koha/tools/upload-cover-image.pl", self.cover_attach),
+            ("POST", r"/cgi-bin/koha/tools/upload-file.pl", self.upload_temp),
+            ("GET", r"/cgi-bin/koha/svc/report", self.pending_report),
+        ]
+
+    # --- Дані ---
+
+    def add_biblio(self, biblionumber, file_path, collection_uuid, title=None, author=None, year="2024", cover=False):
+        """Запис, що чекає імпорту: 956$u (шлях відносно диска) і 956$x (колекція)."""
+        title = title or f"Benchmark book {biblionumber}"
+        author = author or f"Author {biblionumber % 97}"
+        now = time.time()
+        self.records[biblionumber] = (
+            f'<?xml version="1.0" encoding="UTF-8"?>\n<record xmlns="{MARC_NS}">'
+            f'<leader>00000nam a2200000 i 4500</leader>'
+            f'<controlfield tag="001">{biblionumber}</controlfield>'
+            f'<controlfield tag="005">{marc_timestamp(now)}</controlfield>'
+            f'<datafield tag="100" ind1="1" ind2=" "><subfield code="a">{escape(author)}</subfield></datafield>'
+            f'<datafield tag="245" ind1="1" ind2="0"><subfield code="a">{escape(title)}</subfield></datafield>'
+            f'<datafield tag="264" ind1=" " ind2="1"><subfield code="c">{year}</subfield></datafield>'
+            f'<datafield tag="956" ind1=" " ind2=" "><subfield code="u">{escape(file_path)}</subfield>'
+            f'<subfield code="x">{collection_uuid}</subfield></datafield>'
+            f'<datafield tag="999" ind1=" " ind2=" "><subfield code="c">{biblionumber}</subfield></datafield>'
+            f'</record>')
+        self.updated[biblionumber] = now
+        if cover: self.covers[biblionumber] = biblionumber
+
+    def touch(self, biblionumber, when=None):
+        """Імітує редагування запису в Koha (новий 005) — для аудиту Night Walker."""
+        when = when or time.time()
+        with self._lock:
+            self.records[biblionumber] = F005_PATTERN.sub(rf'\g<1>{marc_timestamp(when)}\g<2>', self.records[biblionumber], count=1)
+            self.updated[biblionumber] = when
+
+    # --- REST ---
+
+    def get_biblio(self, req, biblio_id):
+        biblio_id = int(biblio_id)
+        xml = self.records.get(biblio_id)
+        if xml is None: return 404, {"error": "Bibliographic record not found"}
+        if 'marcxml' in (req.headers.get('Accept') or ''):
+            return 200, xml, {'Content-Type': 'application/marcxml+xml'}
+        return 200, {"biblio_id": biblio_id, "dateupdated": iso_timestamp(self.updated[biblio_id])}
+
+    def put_biblio(self, req, biblio_id):
+        biblio_id = int(biblio_id)
+        if biblio_id not in self.records: return 404, {"error": "Bibliographic record not found"}
+        now = time.time()
+        xml = req.body.decode('utf-8')
+        with self._lock:
+            self.records[biblio_id] = F005_PATTERN.sub(rf'\g<1>{marc_timestamp(now)}\g<2>', xml, count=1)
+            self.updated[biblio_id] = now
+        return 200, {"id": biblio_id}
+
+    def list_biblios(self, req):
+        query = json.loads(req.query['q']) if req.query.get('q') else {}
+        ids = sorted(self.records)
+        if isinstance(query.get('biblio_id'), list):
+            wanted = set(int(i) for i in query['biblio_id'])
+            ids = [i for i in ids if i in wanted]
+        if isinstance(query.get('timestamp'), dict):
+            since = query['timestamp'].get('>=', '')
+            ids = [i for i in ids if iso_timestamp(self.updated[i]).rstrip('Z') >= since]
+        if req.query.get('_order_by', '+biblio_id').startswith('-'):
+            ids.reverse()
+        per_page = int(req.query.get('_per_page', 20))
+        page = int(req.query.get('_page', 1))
+        ids = ids[(page - 1) * per_page:page * per_page]
+
+        if 'marcxml' in (req.headers.get('Accept') or ''):
+            body = "".join(XML_DECLARATION.sub('', self.records[i]) for i in ids)
+            return 200, f'<?xml version="1.0" encoding="UTF-8"?>\n<collection xmlns="{MARC_NS}">{body}</collection>', \
+                {'Content-Type': 'application/marcxml+xml'}
+        return 200, [{"biblio_id": i} for i in ids]
+
+    # --- CGI ---
+
+    def _logged_in(self, req):
+        return req.cookies.get('CGISESSID') in self.sessions
+
+    def _login_form(self):
+        return 200, (f'<html><head><meta name="csrf-token" content="{self.CSRF}"></head><body>'
+                     f'<form action="/cgi-bin/koha/mainpage.pl" method="post">'
+                     f'<input type="hidden" name="csrf_token" value="{self.CSRF}"></form></body></html>'), \
+            {'Content-Type': 'text/html'}
+
+    def mainpage(self, req):
+        if self._logged_in(req):
+            return 200, '<html><body><a href="/cgi-bin/koha/mainpage.pl?logout.x=1">Log out</a></body></html>', \
+                {'Content-Type': 'text/html'}
+        return self._login_form()
+
+    def login(self, req):
+        form = req.form()
+        if form.get('csrf_token') != self.CSRF or not form.get('login_userid'):
+            return self._login_form()
+        session_id = uuid.uuid4().hex
+        with self._lock:
+            self.sessions.add(session_id)
+        return 200, '<html><body>Log out</body></html>', \
+            {'Content-Type': 'text/html', 'Set-Cookie': f'CGISESSID={session_id}; Path=/'}
+
+    def cover_page(self, req):
+        if not self._logged_in(req): return self._login_form()
+        biblionumber = int(req.query.get('biblionumber') or 0)
+        image = self.covers.get(biblionumber)
+        link = f'<a href="/cgi-bin/koha/catalogue/image.pl?imagenumber={image}">cover</a>' if image else ''
+        return 200, (f'<html><body><a href="/cgi-bin/koha/mainpage.pl?logout.x=1">Log out</a>'
+                     f'<form><input type="hidden" name="csrf_token" value="{self.CSRF}"></form>'
+                     f'{link}</body></html>'), {'Content-Type': 'text/html'}
+
+    def upload_temp(self, req):
+        if not self._logged_in(req) or req.headers.get('CSRF-TOKEN') != self.CSRF:
+            return 403, {"error": "wrong csrf"}
+        with self._lock:
+            self._uploads += 1
+            file_id = self._uploads
+        return 200, {"fileid": file_id}
+
+    def cover_attach(self, req):
+        if not self._logged_in(req): return self._login_form()
+        form = req.form()
+        biblionumber = int(form.get('biblionumber') or 0)
+        with self._lock:
+            self.covers[biblionumber] = biblionumber
+        return 200, '<html><body><div id="upload_results">successful</div></body></html>', {'Content-Type': 'text/html'}
+
+    def pending_report(self, req):
+        if not self._logged_in(req): return self._login_form()
+        rows = []
+        for biblionumber, xml in sorted(self.records.items()):
+            match = re.search(r'<(?:\w+:)?subfield code="u">([^<]+)<', xml.split('tag="956"', 1)[-1])
+            if match and '>imported<' not in xml:
+                rows.append([biblionumber, match.group(1)])
+        return 200, rows
+
+
+class FakeDSpace(FakeBackend):
+    """
+    DSpace 7 REST: authn (XSRF-cookie + Bearer-токен), pid/find, discover,
+    items, bundles, bitstreams. Вміст файлів не зберігається — лише розмір і MD5.
+    index_delay імітує Solr: новий Item видно в discover лише через стільки секунд.
+    """
+
+    name = "dspace"
+    HANDLE_PREFIX = "123456789"
+
+    def __init__(self, index_delay=0.0, **kwargs):
+        super().__init__(**kwargs)
+        self.index_delay = index_delay
+        self.items = {}        # { uuid: item }
+        self.handles = {}      # { handle: uuid }
+        self.bundles = {}      # { uuid: {"uuid", "name", "item", "bitstreams": [...]} }
+        self.tokens = set()
+        self._handle_seq = 0
+
+    def build_routes(self):
+        return [
+            ("GET", r"/authn/status", self.authn_status),
+            ("POST", r"/authn/login", self.authn_login),
+            ("GET", r"/pid/find", self.pid_find),
+            ("GET", r"/discover/search/objects", self.discover),
+            ("POST", r"/core/items", self.create_item),
+            ("GET", r"/core/items/([\w-]+)", self.get_item),
+            ("PATCH", r"/core/items/([\w-]+)", self.patch_item),
+            ("GET", r"/core/items/([\w-]+)/bundles", self.list_bundles),
+            ("POST", r"/core/items/([\w-]+)/bundles", self.create_bundle),
+            ("GET", r"/core/bundles/([\w-]+)/bitstreams", self.list_bitstreams),
+            ("POST", r"/core/bundles/([\w-]+)/bitstreams", self.upload_bitstream),
+        ]
+
+    def _authorized(self, req):
+        return req.headers.get('Authorization') in self.tokens
+
+    def _item_json(self, item):
+        return {key: item[key] for key in ("uuid", "name", "handle", "metadata", "lastModified",
+                                           "inArchive", "discoverable")} | {"type": "item"}
+
+    # --- authn ---
+
+    def authn_status(self, req):
+        return 200, {"authenticated": self._authorized(req)}, \
+            {'Set-Cookie': f'DSPACE-XSRF-COOKIE={uuid.uuid4()}; Path=/'}
+
+    def authn_login(self, req):
+        if not req.form().get('user'): return 401, {"error": "no credentials"}
+        token = f"Bearer {uuid.uuid4().hex}"
+        with self._lock:
+            self.tokens.add(token)
+        return 200, b'', {'Authorization': token, 'Set-Cookie': f'DSPACE-XSRF-COOKIE={uuid.uuid4()}; Path=/'}
+
+    # --- пошук ---
+
+    def pid_find(self, req):
+        if not self._authorized(req): return 401, {"error": "unauthorized"}
+        item_uuid = self.handles.get(req.query.get('id'))
+        if not item_uuid: return 404, {"error": "not found"}
+        return 200, {"uuid": item_uuid, "type": "item"}
+
+    def discover(self, req):
+        if not self._authorized(req): return 401, {"error": "unauthorized"}
+        match = re.search(r'koha\.biblionumber:\(?([\d\sOR]+)\)?', req.query.get('query', ''))
+        wanted = set(re.findall(r'\d+', match.group(1))) if match else set()
+        now = time.time()
+        objects = [{"_embedded": {"indexableObject": self._item_json(item)}}
+                   for item in list(self.items.values())
+                   if item['indexed_at'] <= now
+                   and any(v['value'] in wanted for v in item['metadata'].get('koha.biblionumber', []))]
+        size = int(req.query.get('size', 20))
+        return 200, {"_embedded": {"searchResult": {"_embedded": {"objects": objects[:size]}}}}
+
+    # --- items ---
+
+    def create_item(self, req):
+        if not self._authorized(req): return 401, {"error": "unauthorized"}
+        data = json.loads(req.body or b'{}')
+        now = time.time()
+        with self._lock:
+            self._handle_seq += 1
+            handle = f"{self.HANDLE_PREFIX}/{self._handle_seq}"
+            item = {"uuid": str(uuid.uuid4()), "name": data.get('name'), "handle": handle,
+                    "metadata": data.get('metadata', {}), "lastModified": iso_timestamp(now),
+                    "inArchive": True, "discoverable": True, "indexed_at": now + self.index_delay,
+                    "owningCollection": req.query.get('owningCollection')}
+            self.items[item['uuid']] = item
+            self.handles[handle] = item['uuid']
+        return 201, self._item_json(item)
+
+    def get_item(self, req, item_uuid):
+        if not self._authorized(req): return 401, {"error": "unauthorized"}
+        item = self.items.get(item_uuid)
+        return (200, self._item_json(item)) if item else (404, {"error": "not found"})
+
+    def patch_item(self, req, item_uuid):
+        if not self._authorized(req): return 401, {"error": "unauthorized"}
+        item = self.items.get(item_uuid)
+        if not item: return 404, {"error": "not found"}
+        with self._lock:
+            for op in json.loads(req.body or b'[]'):
+                key = op.get('path', '').removeprefix('/metadata/')
+                if op.get('op') in ('replace', 'add'): item['metadata'][key] = op.get('value')
+                elif op.get('op') == 'remove': item['metadata'].pop(key, None)
+            item['lastModified'] = iso_timestamp()
+        return 200, self._item_json(item)
+
+    # --- bundles / bitstreams ---
+
+    def list_bundles(self, req, item_uuid):
+        if not self._authorized(req): return 401, {"error": "unauthorized"}
+        if item_uuid not in self.items: return 404, {"error": "not found"}
+        bundles = [{"uuid": b['uuid'], "name": b['name']} for b in self.bundles.values() if b['item'] == item_uuid]
+        return 200, {"_embedded": {"bundles": bundles}}
+
+    def create_bundle(self, req, item_uuid):
+        if not self._authorized(req): return 401, {"error": "unauthorized"}
+        if item_uuid not in self.items: return 404, {"error": "not found"}
+        bundle = {"uuid": str(uuid.uuid4()), "name": json.loads(req.body or b'{}').get('name'),
+                  "item": item_uuid, "bitstreams": []}
+        with self._lock:
+            self.bundles[bundle['uuid']] = bundle
+        return 201, {"uuid": bundle['uuid'], "name": bundle['name']}
+
+    def list_bitstreams(self, req, bundle_uuid):
+        if not self._authorized(req): return 401, {"error": "unauthorized"}
+        bundle = self.bundles.get(bundle_uuid)
+        if not bundle: return 404, {"error": "not found"}
+        return 200, {"_embedded": {"bitstreams": bundle['bitstreams']}}
+
+    def upload_bitstream(self, req, bundle_uuid):
+        if not self._authorized(req): return 401, {"error": "unauthorized"}
+        bundle = self.bundles.get(bundle_uuid)
+        if not bundle: return 404, {"error": "not found"}
+        content = _multipart_file(req.body, req.headers.get('Content-Type'))
+        name = re.search(rb'filename="([^"]*)"', req.body)
+        bitstream = {"uuid": str(uuid.uuid4()), "name": name.group(1).decode('utf-8', 'replace') if name else None,
+                     "sizeBytes": len(content),
+                     "checkSum": {"checkSumAlgorithm": "MD5", "value": hashlib.md5(content).hexdigest()}}
+        with self._lock:
+            bundle['bitstreams'].append(bitstream)
+            self.items[bundle['item']]['lastModified'] = iso_timestamp()
+        return 201, bitstream
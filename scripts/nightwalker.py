@@ -8,18 +8,45 @@
 
 # docker compose exec kdv-api python3 -m src.nightwalker 5000 5100
 
+# Офлайн-режим (нічний аудит з файлу експорту Koha, без запитів до Koha API):
+# Bash
+
+# docker compose exec kdv-api python3 -m src.nightwalker --export /app/exports/koha.marcxml
+
+# Інкрементальний режим (лише змінені з минулого успішного прогону; для cron щоночі):
+# Bash
+
+# docker compose exec kdv-api python3 -m src.nightwalker --incremental
+
+# Шардований повний аудит (запустіть кілька процесів, вони поділять шарди між собою):
+# Bash
+
+# docker compose exec kdv-api python3 -m src.nightwalker --sharded --workers 4
+
+# Конкурентний режим (8 потоків, не більше 20 запитів/сек до Koha і 10 до DSpace):
+# Bash
+
+# docker compose exec kdv-api python3 -m src.nightwalker --workers 8 --koha-rps 20 --dspace-rps 10
+
 import logging
 import sys
 import time
 import os
-from datetime import datetime, timezone
+import argparse
+import json
+import socket
+import itertools
+import concurrent.futures
+from datetime import datetime, timezone, timedelta
 from dateutil import parser 
-from io import BytesIO
-from pymarc import parse_xml_to_array
+from pymarc import MARCReader, record_to_xml
 
 from .koha import KohaClient
 from .dspace import DSpaceClient
-from .app import parse_marc_details
+from .marc import parse_biblio, iter_records
+from .sessions import TokenBucket, record_calls
+from .state import StateStore
+from .audit_report import AuditReport
 
 # --- НАЛАШТУВАННЯ ЛОГУВАННЯ ---
 LOG_DIR = "logs"
@@ -38,6 +65,188 @@ logger = logging.getLogger("NightWalker")
 
 # Кількість пустих ID підряд, після яких робот вважає, що база закінчилась
 MAX_CONSECUTIVE_ERRORS = 201
+# Категорії аудиту, які для авто-режиму означають «дірку» в нумерації
+GAP_STATES = {"missing", "no_956", "error"}
+
+# Структурований звіт прогону (JSONL/CSV). None = лише текстовий лог
+REPORT = None
+
+# --- ІНКРЕМЕНТАЛЬНИЙ РЕЖИМ ---
+WATERMARK_FILE = os.path.join(LOG_DIR, "nightwalker.watermark.json")
+# Запас на розбіжність годинників та транзакції, що комітились під час минулого прогону
+WATERMARK_OVERLAP_SECONDS = 300
+# Категорії, після яких запис треба перевірити ще раз (вони не «закриті» watermark-ом)
+RETRY_STATES = {"error", "sync_failed"}
+
+def load_watermark():
+    """
+    Час початку останнього успішного прогону (datetime) та ID, що тоді не пройшли аудит.
+    :return: (datetime або None, [biblionumber, ...])
+    """
+    try:
+        with open(WATERMARK_FILE, 'r') as f:
+            data = json.load(f)
+        return datetime.fromisoformat(data['last_run']), [int(i) for i in data.get('retry', [])]
+    except FileNotFoundError:
+        return None, []
+    except Exception as e:
+        logger.warning(f"⚠️ Watermark file is unreadable ({e}), ignoring it.")
+        return None, []
+
+def save_watermark(run_started, retry_ids=()):
+    """
+    Атомарний запис (tmp + rename), щоб аварія не лишила битий файл.
+    :param retry_ids: записи з помилкою аудиту/sync: їхній 005 уже позаду watermark,
+                      тож наступний прогін перевіряє їх явно
+    """
+    tmp_path = f"{WATERMARK_FILE}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump({"last_run": run_started.isoformat(timespec='seconds'), "retry": sorted(retry_ids)}, f)
+    os.replace(tmp_path, WATERMARK_FILE)
+
+# --- ШАРДИНГ (кілька процесів / вузлів) ---
+SHARD_DB_FILE = os.path.join(LOG_DIR, "nightwalker_shards.db")
+SHARD_SIZE = 1000
+SHARD_LEASE_SECONDS = 600
+# Незавершений прогін, старший за це, вважається покинутим (процеси не дожили до кінця)
+SHARD_RUN_MAX_AGE_HOURS = 20
+
+class ShardLedger(StateStore):
+    """
+    Журнал шардів одного повного прогону. Процеси забирають шард через лізу
+    (owner + lease_until); протермінована ліза (процес помер) забирається іншим.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS runs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        started_at TEXT, finished_at TEXT,
+        min_id INTEGER, max_id INTEGER, shard_size INTEGER,
+        status TEXT DEFAULT 'active'
+    );
+    CREATE TABLE IF NOT EXISTS shards (
+        run_id INTEGER, shard_no INTEGER,
+        start_id INTEGER, end_id INTEGER,
+        status TEXT DEFAULT 'pending',
+        owner TEXT, lease_until REAL,
+        stats TEXT,
+        PRIMARY KEY (run_id, shard_no)
+    );
+    """
+
+    def join_or_create_run(self, min_id, max_id, shard_size, new_run=False, max_age_hours=SHARD_RUN_MAX_AGE_HOURS):
+        """
+        Повертає id активного прогону або створює новий (атомарно для всіх процесів).
+        Активний прогін, старший за max_age_hours (або будь-який при new_run), закривається
+        як 'abandoned': інакше залишок учорашнього прогону підхоплювався б щоночі.
+        """
+        with self.transaction() as conn:
+            row = conn.execute("SELECT id, started_at FROM runs WHERE status = 'active' ORDER BY id DESC LIMIT 1").fetchone()
+            if row:
+                age = datetime.now() - datetime.fromisoformat(row['started_at'])
+                if not new_run and age < timedelta(hours=max_age_hours): return row['id']
+                conn.execute("UPDATE runs SET status = 'abandoned', finished_at = ? WHERE status = 'active'",
+                             (datetime.now().isoformat(timespec='seconds'),))
+                logger.warning(f"🗑️ Run #{row['id']} (started {row['started_at']}) abandoned, starting a new one")
+            run_id = conn.execute(
+                "INSERT INTO runs (started_at, min_id, max_id, shard_size) VALUES (?, ?, ?, ?)",
+                (datetime.now().isoformat(timespec='seconds'), min_id, max_id, shard_size)
+            ).lastrowid
+            shards = [(run_id, no, start, min(start + shard_size - 1, max_id))
+                      for no, start in enumerate(range(min_id, max_id + 1, shard_size))]
+            conn.executemany("INSERT INTO shards (run_id, shard_no, start_id, end_id) VALUES (?, ?, ?, ?)", shards)
+            logger.info(f"🗂️ Created run #{run_id}: {min_id}-{max_id} in {len(shards)} shards")
+            return run_id
+
+    def claim(self, run_id, owner, lease_seconds=SHARD_LEASE_SECONDS):
+        now = time.time()
+        with self.transaction() as conn:
+            # Прогін закрили як 'abandoned' (--new-run на іншому процесі) — нових шардів не беремо
+            run = conn.execute("SELECT status FROM runs WHERE id = ?", (run_id,)).fetchone()
+            if not run or run['status'] != 'active': return None
+            row = conn.execute(
+                """SELECT shard_no, start_id, end_id FROM shards WHERE run_id = ? AND
+                   (status = 'pending' OR (status = 'claimed' AND lease_until < ?))
+                   ORDER BY shard_no LIMIT 1""", (run_id, now)).fetchone()
+            if not row: return None
+            conn.execute("UPDATE shards SET status = 'claimed', owner = ?, lease_until = ? WHERE run_id = ? AND shard_no = ?",
+                         (owner, now + lease_seconds, run_id, row['shard_no']))
+            return dict(row)
+
+    def heartbeat(self, run_id, shard_no, owner, lease_seconds=SHARD_LEASE_SECONDS):
+        with self.transaction() as conn:
+            conn.execute("UPDATE shards SET lease_until = ? WHERE run_id = ? AND shard_no = ? AND owner = ?",
+                         (time.time() + lease_seconds, run_id, shard_no, owner))
+
+    def complete(self, run_id, shard_no, owner, stats):
+        with self.transaction() as conn:
+            conn.execute("UPDATE shards SET status = 'done', stats = ? WHERE run_id = ? AND shard_no = ? AND owner = ?",
+                         (json.dumps(stats), run_id, shard_no, owner))
+
+    def finish_if_done(self, run_id):
+        """Закриває прогін, якщо всі шарди готові. Повертає зведену статистику лише одному процесу."""
+        with self.transaction() as conn:
+            left = conn.execute("SELECT COUNT(*) FROM shards WHERE run_id = ? AND status != 'done'", (run_id,)).fetchone()[0]
+            run = conn.execute("SELECT status FROM runs WHERE id = ?", (run_id,)).fetchone()
+            if left or run['status'] != 'active': return None
+            conn.execute("UPDATE runs SET status = 'finished', finished_at = ? WHERE id = ?",
+                         (datetime.now().isoformat(timespec='seconds'), run_id))
+            merged, reports = {}, set()
+            for row in conn.execute("SELECT stats FROM shards WHERE run_id = ?", (run_id,)):
+                for key, value in json.loads(row['stats'] or '{}').items():
+                    if key == "_report": reports.add(value)
+                    else: merged[key] = merged.get(key, 0) + value
+            if reports: merged["_reports"] = sorted(reports)
+            return merged
+
+# --- КОНКУРЕНТНИЙ РЕЖИМ ---
+# Спільні клієнти (пул з'єднань + token bucket на бекенд). None = новий клієнт на кожен запис.
+SHARED_CLIENTS = {"koha": None, "dspace": None}
+WORKERS = 1
+
+def setup_concurrency(workers=1, koha_rps=0, dspace_rps=0):
+    """
+    :param workers: скільки записів аудитувати паралельно
+    :param koha_rps / dspace_rps: глобальний ліміт запитів/сек на бекенд (0 = без ліміту)
+    """
+    global WORKERS
+    WORKERS = max(1, workers)
+    if WORKERS > 1 or koha_rps or dspace_rps:
+        SHARED_CLIENTS["koha"] = KohaClient(limiter=TokenBucket(koha_rps), pool_size=WORKERS)
+        SHARED_CLIENTS["dspace"] = DSpaceClient(limiter=TokenBucket(dspace_rps), pool_size=WORKERS)
+        logger.info(f"⚙️ Concurrency: {WORKERS} workers, Koha {koha_rps or '∞'} rps, DSpace {dspace_rps or '∞'} rps")
+
+def run_tracked(func, item):
+    """Аудит одного елемента з заміром часу всіх HTTP-викликів і рядком у REPORT."""
+    started = time.perf_counter()
+    with record_calls() as calls:
+        try:
+            category = func(item)
+        except Exception as e:
+            logger.error(f"Error auditing {item if isinstance(item, int) else item.get('biblionumber')}: {e}")
+            category = "error"
+    if REPORT:
+        biblionumber = item if isinstance(item, int) else item.get('biblionumber')
+        REPORT.add(biblionumber, category, time.perf_counter() - started, calls)
+    return category
+
+def audit_stream(func, items, pause=0):
+    """
+    Виконує func для кожного елемента, повертаючи (item, категорія) у вихідному порядку.
+    Послідовно (з паузою, як раніше) при WORKERS == 1, інакше — пачками в пулі потоків.
+    """
+    if WORKERS == 1:
+        for item in items:
+            yield item, run_tracked(func, item)
+            if pause: time.sleep(pause)
+        return
+
+    iterator = iter(items)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=WORKERS) as executor:
+        while True:
+            batch = list(itertools.islice(iterator, WORKERS * 4))
+            if not batch: break
+            yield from zip(batch, executor.map(lambda item: run_tracked(func, item), batch))
 
 def parse_date(date_str):
     """Парсинг ISO рядка (для DSpace)"""
@@ -49,45 +258,29 @@ def parse_date(date_str):
         return dt
     except: return None
 
-def extract_koha_date_from_xml(xml_data):
-    """Витягує дату з поля 005 MARC"""
+def parse_koha_timestamp(f005):
+    """Парсинг поля 005 MARC (YYYYMMDDHHMMSS.F)"""
+    if not f005: return None
     try:
-        reader = parse_xml_to_array(BytesIO(xml_data.encode('utf-8')))
-        record = reader[0]
-        if '005' in record:
-            f005 = record['005'].data
-            dt_str = f005.split('.')[0] 
-            return datetime.strptime(dt_str, "%Y%m%d%H%M%S")
-    except: pass
-    return None
+        dt_str = f005.split('.')[0] 
+        return datetime.strptime(dt_str, "%Y%m%d%H%M%S")
+    except: return None
 
-def audit_record(biblionumber):
+def audit_parsed(biblionumber, record, dspace, offline=False):
     """
-    Перевіряє один запис.
-    Повертає True, якщо запис існує в Koha (навіть якщо не синхронізований).
-    Повертає False, якщо запису в Koha немає (404/Empty).
+    Аудит уже розібраного запису (з Koha API або з файлу експорту).
+    :param offline: у режимі експорту DSpace питаємо лише про записи, яким це потрібно
+    :return: категорія: no_956 | zombie | synced | sync_failed | ok | skipped
     """
-    koha = KohaClient()
-    dspace = DSpaceClient()
+    marc_data = record['metadata']
+    marc_data['koha.biblionumber'] = str(biblionumber)
 
-    try:
-        # 1. Читаємо XML
-        xml_data = koha._get_biblio_xml(biblionumber)
-        if not xml_data: 
-            return False # Запис не існує
+    meta = record['koha']
+    if not meta:
+        return "no_956" # Технічно запис є, але без метаданих (рідкісний випадок)
 
-        marc_data = parse_marc_details(xml_data)
-        marc_data['koha.biblionumber'] = str(biblionumber)
-        
-        meta = koha.get_biblio_metadata(biblionumber)
-        if not meta: 
-            return False # Технічно запис є, але без метаданих (рідкісний випадок)
-
-        koha_date = extract_koha_date_from_xml(xml_data)
-
-    except Exception as e:
-        logger.error(f"Error reading Koha #{biblionumber}: {e}")
-        return False
+    koha_date = parse_koha_timestamp(record['timestamp'])
+    category = "ok"
 
     # === АУДИТ 1: DEAD LINK DETECTOR ===
     has_file = bool(meta.get('file_path'))
@@ -96,9 +289,14 @@ def audit_record(biblionumber):
 
     if has_file and not has_handle and status not in ['processing', 'imported']:
         logger.warning(f"🧟 [ZOMBIE] #{biblionumber}: File exists but NO Handle!")
+        category = "zombie"
     
     # === АУДИТ 2: SYNC CHECK ===
     item_uuid = meta.get('dspace_uuid')
+
+    if offline and not item_uuid and not has_handle and status != 'imported':
+        # Запис ще не імпортовано — у DSpace шукати нічого
+        return category if category == "zombie" else "skipped"
     
     if not item_uuid:
         found = dspace.find_item_by_biblionumber(biblionumber)
@@ -117,10 +315,70 @@ def audit_record(biblionumber):
                 success = dspace.update_metadata(item_uuid, marc_data)
                 if success:
                     logger.info(f"✅ [SYNC SUCCESS] #{biblionumber} updated.")
+                    category = "synced"
                 else:
                     logger.error(f"❌ [SYNC FAILED] #{biblionumber} update failed.")
+                    category = "sync_failed"
     
-    return True # Запис існує і був оброблений
+    return category
+
+def audit_record(biblionumber):
+    """
+    Перевіряє один запис. Повертає категорію аудиту:
+    missing (запису в Koha немає), error (помилка читання) або результат audit_parsed.
+    """
+    koha = SHARED_CLIENTS["koha"] or KohaClient()
+    dspace = SHARED_CLIENTS["dspace"] or DSpaceClient()
+
+    try:
+        # 1. Читаємо XML (один запит, один прохід парсера)
+        record = koha.get_biblio_record(biblionumber)
+        if not record: 
+            return "missing" # Запис не існує
+    except Exception as e:
+        logger.error(f"Error reading Koha #{biblionumber}: {e}")
+        return "error"
+
+    return audit_parsed(biblionumber, record, dspace)
+
+def iter_export_records(path):
+    """
+    Потокове читання експорту Koha: MARCXML (<collection>) або бінарний MARC (ISO 2709).
+    Пам'ять не залежить від розміру файлу.
+    """
+    with open(path, 'rb') as f:
+        head = f.read(64).lstrip()
+
+    if head.startswith(b'<'):
+        yield from iter_records(path)
+        return
+
+    with open(path, 'rb') as f:
+        for marc_record in MARCReader(f, to_unicode=True, force_utf8=True):
+            if marc_record is None: continue
+            parsed = parse_biblio(record_to_xml(marc_record).decode('utf-8'))
+            if parsed: yield parsed
+
+def run_export_mode(export_path):
+    """Аудит за файлом експорту: Koha не запитується, DSpace — лише за потреби."""
+    logger.info("="*40)
+    logger.info(f"🌙 NIGHT WALKER STARTED (Offline export: {export_path})")
+    logger.info("="*40)
+
+    dspace = SHARED_CLIENTS["dspace"] or DSpaceClient()
+
+    def audit_export_record(record):
+        biblionumber = record.get('biblionumber')
+        if not biblionumber: return "no_id"
+        return audit_parsed(biblionumber, record, dspace, offline=True)
+
+    stats = {}
+    for _, category in audit_stream(audit_export_record, iter_export_records(export_path)):
+        stats[category] = stats.get(category, 0) + 1
+
+    logger.info("="*40)
+    logger.info(f"📊 Stats: {stats}")
+    logger.info("🏁 WALKER FINISHED.")
 
 def run_auto_mode():
     logger.info("="*40)
@@ -128,14 +386,11 @@ def run_auto_mode():
     logger.info(f"ℹ️  Will stop after {MAX_CONSECUTIVE_ERRORS} consecutive empty records.")
     logger.info("="*40)
 
-    bib_id = 1
     gap_count = 0
     processed_count = 0
 
-    while True:
-        exists = audit_record(bib_id)
-        
-        if exists:
+    for bib_id, category in audit_stream(audit_record, itertools.count(1), pause=0.05): # Дуже коротка пауза для швидкості
+        if category not in GAP_STATES:
             gap_count = 0 # Скидаємо лічильник пропусків, бо знайшли живу книгу
             processed_count += 1
             # Логуємо кожні 100 записів для розуміння прогресу
@@ -149,9 +404,6 @@ def run_auto_mode():
             logger.info(f"   Last checked ID: {bib_id}")
             break
 
-        bib_id += 1
-        time.sleep(0.05) # Дуже коротка пауза для швидкості
-
     logger.info("="*40)
     logger.info("🏁 WALKER FINISHED.")
 
@@ -160,22 +412,142 @@ def run_range_mode(start_id, end_id):
     logger.info(f"🌙 NIGHT WALKER STARTED (Range: {start_id}-{end_id})")
     logger.info("="*40)
 
-    for bib_id in range(start_id, end_id + 1):
-        audit_record(bib_id)
-        time.sleep(0.1)
+    for _ in audit_stream(audit_record, range(start_id, end_id + 1), pause=0.1):
+        pass
 
     logger.info("="*40)
     logger.info("🏁 WALKER FINISHED.")
 
+def run_incremental_mode(since=None):
+    """
+    Аудит лише записів, змінених після watermark (або --since), плюс записів,
+    що не пройшли минулого разу (error / sync_failed).
+    Watermark просувається на час старту прогону лише після успішного завершення;
+    записи, що знову не пройшли, зберігаються поруч для наступного прогону.
+    """
+    run_started = datetime.now().replace(microsecond=0)
+    watermark, retry_ids = load_watermark()
+    if since is None:
+        if watermark is None:
+            logger.info("ℹ️  No watermark yet: running a full auto scan first.")
+            run_auto_mode()
+            save_watermark(run_started)
+            return
+        since = watermark - timedelta(seconds=WATERMARK_OVERLAP_SECONDS)
+
+    logger.info("="*40)
+    logger.info(f"🌙 NIGHT WALKER STARTED (Incremental since {since.isoformat(timespec='seconds')})")
+    logger.info("="*40)
+
+    koha = SHARED_CLIENTS["koha"] or KohaClient()
+    if retry_ids: logger.info(f"🔁 Re-auditing {len(retry_ids)} records that failed last time")
+    retry_set = set(retry_ids)
+    changed = koha.iter_biblios_modified_since(since.isoformat(timespec='seconds'))
+    items = itertools.chain(retry_ids, (bib for bib in changed if bib not in retry_set))
+    audited, failed = 0, set()
+    for bib, category in audit_stream(audit_record, items, pause=0.05):
+        audited += 1
+        if category in RETRY_STATES: failed.add(int(bib))
+
+    save_watermark(run_started, failed)
+    logger.info("="*40)
+    logger.info(f"🏁 WALKER FINISHED. Audited {audited} changed records ({len(failed)} to retry). Watermark -> {run_started.isoformat()}")
+
+def run_sharded_mode(ledger_path=SHARD_DB_FILE, shard_size=SHARD_SIZE, new_run=False):
+    """
+    Повний аудит, розбитий на шарди. Запускайте скільки завгодно процесів (на різних
+    ядрах або вузлах зі спільним ledger): кожен забирає вільні шарди, доки вони є.
+    Діапазон ID визначається наперед, тож «дірки» в нумерації не зупиняють аудит.
+    :param new_run: закрити незавершений прогін і почати новий (лише для першого процесу)
+    """
+    koha = SHARED_CLIENTS["koha"] or KohaClient()
+    id_range = koha.get_biblio_id_range()
+    if not id_range:
+        logger.error("❌ Could not discover biblionumber range from Koha.")
+        return
+
+    ledger = ShardLedger(ledger_path)
+    run_id = ledger.join_or_create_run(id_range[0], id_range[1], shard_size, new_run)
+    owner = f"{socket.gethostname()}:{os.getpid()}"
+
+    logger.info("="*40)
+    logger.info(f"🌙 NIGHT WALKER STARTED (Sharded run #{run_id}, range {id_range[0]}-{id_range[1]}, worker {owner})")
+    logger.info("="*40)
+
+    while True:
+        shard = ledger.claim(run_id, owner)
+        if not shard: break
+        shard_no = shard['shard_no']
+        logger.info(f"📦 Shard #{shard_no}: {shard['start_id']}-{shard['end_id']}")
+
+        stats = {}
+        for i, (_, category) in enumerate(audit_stream(audit_record, range(shard['start_id'], shard['end_id'] + 1))):
+            stats[category] = stats.get(category, 0) + 1
+            if i % 100 == 99: ledger.heartbeat(run_id, shard_no, owner)
+        if REPORT: stats["_report"] = REPORT.path
+        ledger.complete(run_id, shard_no, owner, stats)
+
+    merged = ledger.finish_if_done(run_id)
+    logger.info("="*40)
+    if merged is not None:
+        reports = merged.pop("_reports", [])
+        logger.info(f"📊 Run #{run_id} merged stats: {merged}")
+        # Зведений підсумок з усіх звітів процесів (якщо вони на спільному диску)
+        readable = [p for p in reports if p.endswith('.jsonl') and os.path.exists(p)]
+        if REPORT: REPORT.close()
+        if readable:
+            summary = AuditReport.summarize_files(readable)
+            summary_path = os.path.join(os.path.dirname(readable[0]), f"nightwalker_run_{run_id}.summary.json")
+            with open(summary_path, 'w', encoding='utf-8') as f:
+                json.dump(summary, f, ensure_ascii=False, indent=2)
+            logger.info(f"📈 Merged report summary: {summary_path}")
+    logger.info("🏁 WALKER FINISHED (no more shards to claim).")
+
+def build_arg_parser():
+    ap = argparse.ArgumentParser(description="KDV Night Walker: аудит Koha <-> DSpace")
+    ap.add_argument("start", nargs="?", type=int, help="Перший biblionumber (ручний режим)")
+    ap.add_argument("end", nargs="?", type=int, help="Останній biblionumber (ручний режим)")
+    ap.add_argument("--export", metavar="FILE", help="Офлайн-аудит з файлу експорту Koha (MARCXML / MARC)")
+    ap.add_argument("--incremental", action="store_true", help="Лише записи, змінені після останнього успішного прогону")
+    ap.add_argument("--since", help="Явна точка відліку для --incremental (ISO, напр. 2025-01-31T00:00:00)")
+    ap.add_argument("--sharded", action="store_true", help="Повний аудит шардами (можна запускати кілька процесів)")
+    ap.add_argument("--shard-size", type=int, default=SHARD_SIZE, help="Кількість ID в одному шарді")
+    ap.add_argument("--shard-db", default=SHARD_DB_FILE, help="Файл ledger шардів (спільний для всіх процесів)")
+    ap.add_argument("--new-run", action="store_true",
+                    help="Не приєднуватись до незавершеного прогону, а почати новий (лише для першого процесу)")
+    ap.add_argument("--report", default=None,
+                    help="Файл звіту: .jsonl або .csv (за замовчуванням logs/nightwalker_report_<час>_<pid>.jsonl)")
+    ap.add_argument("--no-report", action="store_true", help="Не писати структурований звіт")
+    ap.add_argument("--workers", type=int, default=1, help="Скільки записів аудитувати паралельно")
+    ap.add_argument("--koha-rps", type=float, default=0, help="Ліміт запитів/сек до Koha (0 = без ліміту)")
+    ap.add_argument("--dspace-rps", type=float, default=0, help="Ліміт запитів/сек до DSpace (0 = без ліміту)")
+    return ap
+
 if __name__ == "__main__":
+    args = build_arg_parser().parse_args()
+    setup_concurrency(args.workers, args.koha_rps, args.dspace_rps)
+    if not args.no_report:
+        report_path = args.report or os.path.join(
+            LOG_DIR, f"nightwalker_report_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{os.getpid()}.jsonl")
+        REPORT = AuditReport(report_path)
+        logger.info(f"📝 Structured report: {report_path}")
+
+    # Офлайн-аудит за файлом експорту Koha (MARCXML або бінарний MARC)
+    if args.export:
+        run_export_mode(args.export)
+    # Повний аудит шардами (кілька процесів / вузлів)
+    elif args.sharded:
+        run_sharded_mode(args.shard_db, args.shard_size, args.new_run)
+    # Інкрементальний аудит за watermark
+    elif args.incremental:
+        run_incremental_mode(datetime.fromisoformat(args.since) if args.since else None)
     # Якщо передано аргументи - працюємо по діапазону
-    if len(sys.argv) == 3:
-        try:
-            start = int(sys.argv[1])
-            end = int(sys.argv[2])
-            run_range_mode(start, end)
-        except ValueError:
-            print("Error: IDs must be integers.")
+    elif args.start is not None and args.end is not None:
+        run_range_mode(args.start, args.end)
     # Якщо аргументів немає - працюємо в авто-режимі (все підряд)
     else:
-        run_auto_mode()
\ No newline at end of file
+        run_auto_mode()
+
+    if REPORT and not REPORT.closed:
+        summary = REPORT.close()
+        logger.info(f"📈 Summary: {json.dumps(summary, ensure_ascii=False)}")
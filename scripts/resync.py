@@ -0,0 +1,82 @@
+# масовий re-sync метаданих DSpace після зміни правил мапування:
+# docker compose exec kdv-api python3 -m src.resync "1-5000, 7000" --fields changed
+# docker compose exec kdv-api python3 -m src.resync --file candidates.txt
+
+import requests
+import time
+import logging
+import sys
+import os
+import argparse
+from .config import KDV_API_TOKEN
+from .candidates import parse_candidates_file, parse_candidates_text
+
+
+LOG_DIR = "logs"
+os.makedirs(LOG_DIR, exist_ok=True)
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s [RESYNC] %(levelname)s: %(message)s',
+    handlers=[
+        logging.FileHandler(os.path.join(LOG_DIR, "resync.log")),
+        logging.StreamHandler(sys.stdout)
+    ]
+)
+logger = logging.getLogger("Resync")
+
+API_BASE = "http://localhost:5000/kdv/api"
+HEADERS = {"X-KDV-TOKEN": KDV_API_TOKEN}
+POLL_INTERVAL = 5
+
+
+def run_resync(candidates, fields=None):
+    """Ставить масовий resync у чергу API і стежить за прогресом задачі."""
+    logger.info(f"📋 Resync of {len(candidates)} records: {str(candidates)[:200]}")
+    resp = requests.post(f"{API_BASE}/resync", headers=HEADERS, json={"ids": str(candidates), "fields": fields})
+    if resp.status_code != 202:
+        logger.error(f"❌ Resync request failed ({resp.status_code}): {resp.text}")
+        return None
+    task_id = resp.json()['task_id']
+    logger.info(f"   Task started: {task_id}")
+
+    last_progress = None
+    while True:
+        time.sleep(POLL_INTERVAL)
+        try:
+            status_resp = requests.get(f"{API_BASE}/status/{task_id}", headers=HEADERS)
+        except Exception as e:
+            logger.warning(f"   Polling exception: {e}")
+            continue
+        if status_resp.status_code != 200: continue
+
+        data = status_resp.json()
+        if data.get('progress') != last_progress:
+            last_progress = data.get('progress')
+            logger.info(f"   {last_progress}")
+
+        if data.get('status') == 'success':
+            result = data['result']
+            logger.info(f"🏁 Resync completed: {result['counts']}")
+            for failure in result['failures']:
+                logger.warning(f"   #{failure['biblionumber']}: {failure['status']} {failure.get('message') or ''}")
+            return result
+        if data.get('status') == 'error':
+            logger.error(f"❌ Resync task failed: {data.get('error')}")
+            return None
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="KDV bulk metadata resync")
+    ap.add_argument("ids", nargs="?", help="ID або діапазони: '1-5000, 7000'")
+    ap.add_argument("--file", help="Файл зі списком ID (формат candidates.txt)")
+    ap.add_argument("--fields", help="'changed' або список полів через кому (за замовчуванням усі)")
+    args = ap.parse_args()
+
+    if args.file:
+        candidates = parse_candidates_file(args.file)
+    else:
+        candidates = parse_candidates_text([args.ids or ''])
+    if not candidates:
+        ap.error("no IDs given")
+    run_resync(candidates, args.fields)
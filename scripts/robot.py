@@ -6,7 +6,17 @@ import time
 import logging
 import sys
 import os
+import argparse
+import threading
+import json
+import itertools
+import hmac
+import hashlib
+import concurrent.futures
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from .config import KDV_API_TOKEN
+from .koha import KohaClient
+from .candidates import parse_candidates_file
 
 
 # Налаштування логування
@@ -27,6 +37,20 @@ API_BASE = "http://localhost:5000/kdv/api"
 HEADERS = {"X-KDV-TOKEN": KDV_API_TOKEN}
 POLL_INTERVAL = 3  # секунди перерви між опитуванням статусу
 BATCH_DELAY = 5    # секунди перерви між книгами (щоб не "покласти" DSpace)
+MAX_DEFER = 1800   # скільки максимум чекати, поки бекенд відновиться (503 від API)
+
+# --- ЖУРНАЛ ТА ПРЕ-ФІЛЬТР ---
+JOURNAL_FILE = os.path.join(LOG_DIR, "robot_journal.jsonl")
+DONE_RESULTS = {"SUCCESS", "LINKED"}   # Після цих результатів ID при перезапуску пропускається
+PREFILTER_CHUNK = 100                  # ID в одному bulk-запиті до Koha
+
+# --- PIPELINE (AIMD) ---
+MAX_IN_FLIGHT = 8          # Стеля паралельних інтеграцій
+LATENCY_TOLERANCE = 2.0    # Латентність > базова * N => DSpace «захлинається»
+ERROR_RATE_LIMIT = 0.2     # Частка перевантажень (EWMA), після якої зменшуємо паралельність
+LATENCY_MIN_MB = 1.0       # Латентність рахуємо на MB, але не менше ніж на 1 MB (фіксовані накладні)
+# Результати, що вказують на перевантаження (а не на проблему з конкретним записом)
+OVERLOAD_RESULTS = {"TIMEOUT", "ERROR_CONN", "ERROR_POST"}
 
 def parse_candidates(filename):
     """
@@ -36,62 +60,163 @@ def parse_candidates(filename):
       20, 21, 25
       100-110
       300-305, 400
+    Повертає IntervalSet: діапазони не розгортаються в пам'яті, ID видаються ліниво.
+    """
+    return parse_candidates_file(filename)
+
+class BatchJournal:
+    """
+    Append-only журнал результатів (JSONL: один рядок на ID).
+    Повторний запуск після падіння пропускає вже завершені ID.
     """
-    if not os.path.exists(filename):
-        logger.error(f"File {filename} not found!")
-        return []
 
-    unique_ids = set()
+    def __init__(self, path=JOURNAL_FILE, resume=True):
+        """
+        :param resume: False — старі записи не читаємо (нічого не пропускаємо),
+                       але результати цього запуску все одно дописуємо
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self.done = set()
+        if resume and os.path.exists(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    try: entry = json.loads(line)
+                    except ValueError: continue  # обрізаний останній рядок після аварії
+                    if entry.get('result') in DONE_RESULTS: self.done.add(str(entry['id']))
+                    else: self.done.discard(str(entry['id']))
+        self._file = open(path, 'a')
 
-    with open(filename, 'r') as f:
-        for line in f:
-            # Видаляємо коментарі та зайві пробіли
-            line = line.split('#')[0].strip()
-            if not line: continue
+    def record(self, biblionumber, result):
+        line = json.dumps({"id": str(biblionumber), "result": result, "ts": time.strftime('%Y-%m-%dT%H:%M:%S')})
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            if result in DONE_RESULTS: self.done.add(str(biblionumber))
 
-            # Розбиваємо по комі (якщо є перелік в одному рядку)
-            parts = line.split(',')
-            
-            for part in parts:
-                part = part.strip()
-                if not part: continue
-
-                # Перевірка на діапазон (наприклад "14-30")
-                if '-' in part:
-                    try:
-                        start_s, end_s = part.split('-')
-                        start = int(start_s)
-                        end = int(end_s)
-                        
-                        # Захист від "30-14" (міняємо місцями)
-                        if start > end: start, end = end, start
-                        
-                        # Додаємо весь діапазон (включно з останнім)
-                        for i in range(start, end + 1):
-                            unique_ids.add(i)
-                    except ValueError:
-                        logger.error(f"⚠️ Invalid range format ignored: '{part}'")
-                
-                # Звичайне число
-                elif part.isdigit():
-                    unique_ids.add(int(part))
-                else:
-                    logger.warning(f"⚠️ Invalid ID format ignored: '{part}'")
+    def close(self):
+        self._file.close()
 
-    # Повертаємо відсортований список рядків
-    sorted_ids = sorted(list(unique_ids))
-    return [str(i) for i in sorted_ids]
+def prefilter_candidates(ids, stats):
+    """
+    Відсіює ID пачками (один bulk-запит MARCXML на PREFILTER_CHUNK ID):
+    без 956 або з 956$y = imported — POST не потрібен.
+    ID, про які Koha не відповіла, лишаються в черзі (рішення прийме сама інтеграція).
+    """
+    koha = KohaClient()
+    iterator = iter(ids)
+    while True:
+        chunk = list(itertools.islice(iterator, PREFILTER_CHUNK))
+        if not chunk: break
+        try:
+            records = koha.get_biblio_records_bulk(chunk)
+        except Exception as e:
+            logger.warning(f"⚠️ Pre-filter failed for chunk starting {chunk[0]}: {e}. Dispatching unfiltered.")
+            yield from chunk
+            continue
+        for bib_id in chunk:
+            if int(bib_id) in records and records[int(bib_id)] is None:
+                yield bib_id   # тимчасовий збій Koha — це не «немає 956»
+                continue
+            record = records.get(int(bib_id))
+            meta = record['koha'] if record else None
+            if not meta:
+                stats["PREFILTER_NO_956"] = stats.get("PREFILTER_NO_956", 0) + 1
+            elif meta.get('status') == 'imported':
+                stats["PREFILTER_IMPORTED"] = stats.get("PREFILTER_IMPORTED", 0) + 1
+            else:
+                yield bib_id
 
-def process_single_biblio(biblionumber):
+class CallbackListener:
+    """
+    Мінімальний HTTP-сервер для callback-ів API: замість опитування /status
+    робот чекає, поки інтегратор сам POST-не фінальний стан задачі.
+    """
+
+    def __init__(self, host, port, public_url=None):
+        self.results = {}   # { task_id: payload }
+        self._cond = threading.Condition()
+        listener = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                expected = hmac.new(KDV_API_TOKEN.encode('utf-8'), body, hashlib.sha256).hexdigest()
+                if not hmac.compare_digest(expected, self.headers.get('X-KDV-Signature', '')):
+                    self.send_response(403); self.end_headers()
+                    return
+                try: payload = json.loads(body)
+                except ValueError:
+                    self.send_response(400); self.end_headers()
+                    return
+                with listener._cond:
+                    listener.results[payload.get('task_id')] = payload
+                    listener._cond.notify_all()
+                self.send_response(204); self.end_headers()
+
+            def log_message(self, *args):
+                pass  # без шуму в robot_batch.log
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.url = public_url or f"http://{host}:{self.server.server_port}/"
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        logger.info(f"📡 Callback listener on {self.url}")
+
+    def wait(self, task_id, timeout):
+        """Фінальний стан задачі або None, якщо callback не прийшов за timeout."""
+        with self._cond:
+            self._cond.wait_for(lambda: task_id in self.results, timeout=timeout)
+            return self.results.pop(task_id, None)
+
+    def close(self):
+        self.server.shutdown()
+
+def classify_task_result(biblionumber, s_data):
+    """Фінальний стан задачі (з /status або callback-а) -> результат для статистики. None — ще не завершено."""
+    status = s_data.get('status')
+    if status == 'success':
+        res = s_data.get('result') or {}
+        handle = res.get('handle')
+        if res.get('status') == 'linked_existing':
+            logger.info(f"🔄 #{biblionumber} LINKED (Duplicate): {handle}")
+            return "LINKED"
+        logger.info(f"✅ #{biblionumber} SUCCESS! Handle: {handle}")
+        return "SUCCESS"
+    if status == 'error':
+        logger.error(f"❌ #{biblionumber} FAILED: {s_data.get('error')}")
+        return "FAILED"
+    return None
+
+def remember_size(info, s_data):
+    """Розмір файлу (size_mb) з фінального стану задачі -> info (для AIMD)."""
+    if info is not None:
+        info['size_mb'] = (s_data.get('result') or {}).get('size_mb')
+
+def process_single_biblio(biblionumber, adaptive_poll=False, listener=None, info=None):
     """
     Виконує повний цикл архівації для однієї книги:
-    POST (Start) -> Polling (Wait) -> Result
+    POST (Start) -> Callback або Polling (Wait) -> Result
+    :param adaptive_poll: почати з частого опитування (1с) і поступово рідшати до POLL_INTERVAL*2
+    :param listener: CallbackListener — чекати на callback замість опитування
+    :param info: dict, куди записується size_mb файлу з результату задачі (для AIMD)
     """
     logger.info(f"▶️ Processing Biblio #{biblionumber}...")
 
     # 1. Ініціація (POST)
     try:
-        resp = requests.post(f"{API_BASE}/integrate/{biblionumber}", headers=HEADERS)
+        body = {"callback_url": listener.url} if listener else None
+        resp = requests.post(f"{API_BASE}/integrate/{biblionumber}", headers=HEADERS, json=body)
+
+        # 503: circuit breaker Koha/DSpace відкритий — чекаємо Retry-After, книга лишається в черзі
+        deferred = 0
+        while resp.status_code == 503 and deferred < MAX_DEFER:
+            retry_after = int(resp.headers.get('Retry-After', POLL_INTERVAL))
+            logger.warning(f"⏸️ #{biblionumber} backend unavailable, retrying in {retry_after}s")
+            time.sleep(retry_after)
+            deferred += retry_after
+            resp = requests.post(f"{API_BASE}/integrate/{biblionumber}", headers=HEADERS, json=body)
         
         # Обробка статусів HTTP
         if resp.status_code == 409:
@@ -119,13 +244,25 @@ def process_single_biblio(biblionumber):
         logger.error(f"❌ #{biblionumber} Connection Error: {e}")
         return "ERROR_CONN"
 
-    # 2. Очікування (Polling)
-    waited = 0
     max_wait = 900 # 15 хвилин максимум (для дуже великих файлів)
+
+    # 2a. Очікування callback-а
+    if listener:
+        payload = listener.wait(task_id, max_wait)
+        if payload:
+            remember_size(info, payload)
+            return classify_task_result(biblionumber, payload) or "FAILED"
+        logger.warning(f"   #{biblionumber} no callback in {max_wait}s, checking status once...")
+        max_wait = POLL_INTERVAL
+
+    # 2b. Очікування (Polling)
+    waited = 0
+    interval = 1.0 if adaptive_poll else POLL_INTERVAL
     
     while waited < max_wait:
-        time.sleep(POLL_INTERVAL)
-        waited += POLL_INTERVAL
+        time.sleep(interval)
+        waited += interval
+        if adaptive_poll: interval = min(interval * 1.5, POLL_INTERVAL * 2)
         
         try:
             status_resp = requests.get(f"{API_BASE}/status/{task_id}", headers=HEADERS)
@@ -139,25 +276,10 @@ def process_single_biblio(biblionumber):
                 continue
                 
             s_data = status_resp.json()
-            status = s_data.get('status')
-            
-            if status == 'success':
-                res = s_data.get('result', {})
-                handle = res.get('handle')
-                uuid = res.get('uuid')
-                special_status = res.get('status') # linked_existing?
-                
-                if special_status == 'linked_existing':
-                    logger.info(f"🔄 #{biblionumber} LINKED (Duplicate): {handle}")
-                    return "LINKED"
-                else:
-                    logger.info(f"✅ #{biblionumber} SUCCESS! Handle: {handle}")
-                    return "SUCCESS"
-            
-            elif status == 'error':
-                err_msg = s_data.get('error')
-                logger.error(f"❌ #{biblionumber} FAILED: {err_msg}")
-                return "FAILED"
+            result = classify_task_result(biblionumber, s_data)
+            if result:
+                remember_size(info, s_data)
+                return result
             
             # Якщо processing/queued - чекаємо далі
             
@@ -167,16 +289,129 @@ def process_single_biblio(biblionumber):
     logger.error(f"❌ #{biblionumber} TIMEOUT (waited {max_wait}s)")
     return "TIMEOUT"
 
-def run_batch(filename="candidates.txt"):
-    ids = parse_candidates(filename)
+class AIMDController:
+    """
+    Кількість інтеграцій «в польоті» за схемою AIMD (як TCP congestion control):
+    +1 за кожне «вікно» успішних книг, ×0.5 при перевантаженні (зростання латентності
+    на MB відносно базової, таймаути/помилки з'єднання/5xx або високий EWMA перевантажень).
+    FAILED (проблема конкретного запису: немає 956, битий PDF) перевантаженням не вважається.
+    Зменшення — не частіше одного разу на вікно, щоб одна хвиля збоїв не обнулила паралельність.
+    """
+
+    def __init__(self, initial=2, minimum=1, maximum=MAX_IN_FLIGHT):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(initial)
+        self.base_latency = None   # найкраща (мінімальна, з повільним дрейфом) латентність
+        self.error_rate = 0.0
+        self._last_decrease = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def current(self):
+        return max(self.minimum, int(self.limit))
+
+    def on_result(self, result, latency, started_at, size_mb=None):
+        """
+        :param size_mb: розмір файлу з результату задачі; без нього латентність не враховується
+                        (100-сторінкова і 1000-сторінкова книга мають різну «норму»)
+        """
+        with self._lock:
+            overloaded = result in OVERLOAD_RESULTS
+            self.error_rate = self.error_rate * 0.8 + (0.2 if overloaded else 0.0)
+
+            # Латентність на MB — лише для реально виконаних інтеграцій (SKIPPED/409 миттєві)
+            per_mb = None
+            if result in ("SUCCESS", "LINKED") and size_mb:
+                per_mb = latency / max(size_mb, LATENCY_MIN_MB)
+                if self.base_latency is None or per_mb < self.base_latency:
+                    self.base_latency = per_mb
+                else:
+                    self.base_latency = self.base_latency * 0.99 + per_mb * 0.01
+
+            congested = (overloaded
+                         or self.error_rate > ERROR_RATE_LIMIT
+                         or (per_mb is not None and per_mb > self.base_latency * LATENCY_TOLERANCE))
+
+            if congested:
+                # Книга стартувала до минулого зменшення — її сигнал вже враховано
+                if started_at > self._last_decrease:
+                    self.limit = max(self.minimum, self.limit * 0.5)
+                    self._last_decrease = time.time()
+                    logger.warning(f"📉 Congestion ({result}, {round(latency)}s): in-flight -> {self.current}")
+            else:
+                old = self.current
+                self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+                if self.current != old:
+                    logger.info(f"📈 In-flight -> {self.current}")
+
+def run_pipeline(ids, max_in_flight=MAX_IN_FLIGHT, journal=None, total=None, listener=None):
+    """
+    Конвеєрний режим: кілька інтеграцій одночасно, без фіксованих пауз.
+    Паралельність підлаштовується під спостережувану латентність і помилки DSpace.
+    """
+    controller = AIMDController(maximum=max_in_flight)
+    stats = {}
+    in_flight = {}
+    iterator = iter(ids)
+    exhausted = False
+    done_count = 0
+    batch_started = time.time()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        while True:
+            while not exhausted and len(in_flight) < controller.current:
+                bib_id = next(iterator, None)
+                if bib_id is None:
+                    exhausted = True
+                    break
+                info = {}
+                future = executor.submit(process_single_biblio, bib_id, True, listener, info)
+                in_flight[future] = (bib_id, time.time(), info)
+
+            if not in_flight: break
+
+            done, _ = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                bib_id, started_at, info = in_flight.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    logger.error(f"❌ #{bib_id} worker crashed: {e}")
+                    result = "ERROR_CONN"
+                controller.on_result(result, time.time() - started_at, started_at, info.get('size_mb'))
+                if journal: journal.record(bib_id, result)
+                stats[result] = stats.get(result, 0) + 1
+                done_count += 1
+
+                if done_count % 10 == 0:
+                    rate = done_count / max(time.time() - batch_started, 1e-9) * 60
+                    logger.info(f"--- Done {done_count}/{total or '?'} | in-flight limit {controller.current} | {round(rate, 1)} books/min ---")
+
+    return stats
+
+def run_batch(filename="candidates.txt", pipeline=False, max_in_flight=MAX_IN_FLIGHT, resume=True, prefilter=True, listener=None):
+    candidates = parse_candidates(filename)
     
-    if not ids:
+    if not candidates:
         logger.warning("No candidates found via parse logic. Exiting.")
         return
 
+    # Загальна кількість рахується за довжинами інтервалів, без розгортання діапазонів
+    total = len(candidates)
+    ids = (str(i) for i in candidates)
+
+    journal = BatchJournal(resume=resume)
+    if journal.done:
+        skipped = sum(1 for i in journal.done if i in candidates)
+        total -= skipped
+        done = journal.done
+        ids = (i for i in ids if i not in done)
+        logger.info(f"⏩ Journal: skipping {skipped} already completed IDs")
+
     logger.info("="*40)
-    logger.info(f"📋 BATCH STARTED. Candidates: {len(ids)}")
-    logger.info(f"   List: {', '.join(ids[:10])} ...") # Показати перші 10
+    logger.info(f"📋 BATCH STARTED. Candidates: {total}")
+    logger.info(f"   Ranges: {str(candidates)[:200]}")
     logger.info("="*40)
     
     stats = {
@@ -188,24 +423,52 @@ def run_batch(filename="candidates.txt"):
         "ERROR_CLIENT": 0,
         "ERROR_CONN": 0
     }
-    
-    for i, bib_id in enumerate(ids):
-        logger.info(f"--- Item {i+1}/{len(ids)} ---")
-        result = process_single_biblio(bib_id)
-        
-        # Спрощення статистики для звіту
-        key = result if result in stats else "FAILED"
-        stats[key] = stats.get(key, 0) + 1
-        
-        # Пауза між книгами, щоб DSpace встиг "видихнути" (індексація Solr)
-        if i < len(ids) - 1:
-            time.sleep(BATCH_DELAY)
+
+    # Pre-filter: не POST-имо записи без 956 та вже імпортовані
+    queue = prefilter_candidates(ids, stats) if prefilter else iter(ids)
+
+    if pipeline:
+        for result, count in run_pipeline(queue, max_in_flight, journal, total, listener).items():
+            key = result if result in stats else "FAILED"
+            stats[key] = stats.get(key, 0) + count
+    else:
+        for i, bib_id in enumerate(queue):
+            # Пауза між книгами, щоб DSpace встиг "видихнути" (індексація Solr); після останньої — не чекаємо.
+            # Черга — генератор (pre-filter), тож паузу робимо перед наступною книгою, а не після поточної
+            if i > 0: time.sleep(BATCH_DELAY)
+            logger.info(f"--- Item {i+1} (of ≤{total}) ---")
+            result = process_single_biblio(bib_id, listener=listener)
+            journal.record(bib_id, result)
+            
+            # Спрощення статистики для звіту
+            key = result if result in stats else "FAILED"
+            stats[key] = stats.get(key, 0) + 1
 
     logger.info("="*40)
     logger.info(f"🏁 BATCH COMPLETED.")
     logger.info(f"📊 Stats: {stats}")
     logger.info(f"📝 See full details in robot_batch.log")
+    journal.close()
 
 if __name__ == "__main__":
     # Для запуску: docker compose exec kdv-api python3 -m src.robot
-    run_batch("candidates.txt")
\ No newline at end of file
+    # Конвеєрний режим:  docker compose exec kdv-api python3 -m src.robot --pipeline --max-in-flight 8
+    ap = argparse.ArgumentParser(description="KDV Robot: масова архівація")
+    ap.add_argument("file", nargs="?", default="candidates.txt", help="Файл зі списком ID")
+    ap.add_argument("--pipeline", action="store_true", help="Кілька інтеграцій одночасно з адаптивною (AIMD) паралельністю")
+    ap.add_argument("--max-in-flight", type=int, default=MAX_IN_FLIGHT, help="Стеля паралельних інтеграцій")
+    ap.add_argument("--no-resume", action="store_true", help="Не пропускати ID з журналу і пройти всі заново (результати все одно пишуться в журнал)")
+    ap.add_argument("--no-prefilter", action="store_true", help="Не перевіряти 956 у Koha перед POST")
+    ap.add_argument("--callback-listen", metavar="HOST:PORT", help="Чекати на callback-и API замість опитування /status")
+    ap.add_argument("--callback-url", help="Адреса listener-а, як її бачить API (за замовчуванням http://HOST:PORT/)")
+    args = ap.parse_args()
+
+    listener = None
+    if args.callback_listen:
+        host, _, port = args.callback_listen.rpartition(':')
+        listener = CallbackListener(host or "0.0.0.0", int(port), args.callback_url)
+    try:
+        run_batch(args.file, pipeline=args.pipeline, max_in_flight=args.max_in_flight,
+                  resume=not args.no_resume, prefilter=not args.no_prefilter, listener=listener)
+    finally:
+        if listener: listener.close()
\ No newline at end of file
@@ -1,20 +1,29 @@
 import os
 import logging
 import shutil
-import re
 import time  # 🟢 NEW: Потрібно для пауз при повторних спробах
-import concurrent.futures
 from flask import Flask, jsonify, request, abort
 from flask_cors import CORS
-from io import BytesIO
-from pymarc import parse_xml_to_array
 
-from .tasks import task_manager
-from .config import setup_logging, KDV_API_TOKEN, KOHA_API_URL, INTEGRATOR_MOUNT_PATH, FOLDER_PROCESSED, FOLDER_ERROR, DSPACE_UI_URL
-from .mapping import METADATA_RULES, TYPE_CONVERSION
+from .tasks import task_manager, is_valid_callback_url
+from .config import setup_logging, KDV_API_TOKEN, KOHA_API_URL, INTEGRATOR_MOUNT_PATH, FOLDER_PROCESSED, FOLDER_ERROR, DSPACE_UI_URL, WATCHER_ENABLED, RETRY_ATTEMPTS, RESUME_ON_START, CLUSTER_MODE, CLUSTER_WORKERS, STATE_DB_PATH
 from .koha import KohaClient
 from .dspace import DSpaceClient
 from .covers import CoverService
+from .versioning import version_index
+from .staging import staging_cache
+from .watcher import InboxWatcher
+from .preflight import check_pdf
+from .marc import plan_registry
+from .events import Debouncer
+from .sync import sync_metadata, run_bulk_resync
+from .candidates import parse_candidates_text
+from .breaker import BREAKERS, CircuitOpenError
+from .errors import TransientError, PermanentError, is_transient, backoff_delay
+from .dlq import dead_letters
+from .journal import integration_journal, step_reached
+from .reservations import reservations
+from .jobs import JobQueue, JobWorkers, NODE_ID, LeaseLostError, lease_owner, ensure_lease
 
 setup_logging()
 logger = logging.getLogger("KDV-Core")
@@ -24,206 +33,386 @@ CORS(app)
 
 LIMIT_WARNING = 150 * 1024 * 1024
 LIMIT_ERROR = 250 * 1024 * 1024
+COVER_RETRIES = 6           # спроби задачі обкладинки (рендер/upload, imagenumber, 956$c)
+COVER_RETRY_DELAY = 2       # секунди, база експоненційної паузи
 
 def get_versioned_path(base_dir, biblionumber):
-    """Генерує унікальний шлях для файлу з версійністю."""
+    """Генерує унікальний шлях для файлу з версійністю (через кешований індекс папки)."""
     target_dir = os.path.join(base_dir, FOLDER_PROCESSED)
-    os.makedirs(target_dir, exist_ok=True)
-    version = 1
-    while True:
-        filename = f"biblio_{biblionumber}_v{version:02d}.pdf"
-        full_path = os.path.join(target_dir, filename)
-        if not os.path.exists(full_path):
-            return full_path
-        version += 1
-        if version > 999:
-            return os.path.join(target_dir, f"biblio_{biblionumber}_v999_{os.urandom(4).hex()}.pdf")
-
-def parse_marc_details(xml_data):
-    try:
-        reader = parse_xml_to_array(BytesIO(xml_data.encode('utf-8')))
-        record = reader[0]
-        extracted_data = {}
-        for dspace_field, rule in METADATA_RULES.items():
-            values = []
-            sources = rule.get('sources', [{"tag": rule.get("tag"), "subfield": rule.get("subfield")}])
-            for src in sources:
-                tag = src.get('tag')
-                sub = src.get('subfield')
-                if not tag or tag not in record: continue
-                if rule.get('multivalue'):
-                    for field in record.get_fields(tag):
-                        val = field[sub] if sub in field else None
-                        if val: values.append(val)
-                else:
-                    val = record[tag][sub] if sub in record[tag] else None
-                    if val:
-                        values.append(val)
-                        break 
-            final_values = []
-            for v in values:
-                if 'regex' in rule:
-                    match = re.search(rule['regex'], v)
-                    if match: v = match.group(1)
-                    else: continue
-                if 'conversion' in rule and rule['conversion'] == 'type':
-                    v = TYPE_CONVERSION.get(v, TYPE_CONVERSION.get("DEFAULT"))
-                final_values.append(v)
-            if final_values:
-                extracted_data[dspace_field] = final_values if rule.get('multivalue') else final_values[0]
-        handle = None
-        if '856' in record and 'u' in record['856']:
-            full_url = record['856']['u']
-            match = re.search(r'handle/(\d+/\d+)', full_url)
-            if match: handle = match.group(1)
-        extracted_data['handle'] = handle
-        return extracted_data
-    except Exception as e:
-        logger.warning(f"Could not parse MARC details: {e}")
-        return {}
+    return version_index.allocate(target_dir, biblionumber)
+
+def move_to_error_folder(file_path, source_dir):
+    """Переносить файл у папку Error поруч із вихідною папкою (для ручного аналізу)."""
+    error_dir = os.path.join(source_dir, FOLDER_ERROR)
+    os.makedirs(error_dir, exist_ok=True)
+    target = os.path.join(error_dir, os.path.basename(file_path))
+    shutil.move(file_path, target)
+    return target
 
-def run_dspace_workflow(biblionumber, file_path, meta):
+def run_dspace_workflow(biblionumber, file_path, meta, md, file_md5=None, state=None, on_step=None):
     """
     THREAD: Critical DSpace Logic
+    :param md: метадані, вже розібрані з того ж MARCXML, що й 956 (без повторного запиту)
+    :param state: стан з журналу ({"item_uuid", "handle", "uploaded"}): зроблені кроки не повторюємо
+    :param on_step: callback(step, **fields) — фіксація кроку в журналі інтеграції
     """
-    local_koha = KohaClient()
     local_dspace = DSpaceClient()
+    state = state if state is not None else {}
+    on_step = on_step or (lambda step, **fields: None)
     
     logger.info(f"🚀 [DSpace-Thread] Starting metadata & upload for #{biblionumber}")
     
-    raw_xml = local_koha._get_biblio_xml(biblionumber)
-    md = parse_marc_details(raw_xml)
+    md = dict(md)
     md['koha.biblionumber'] = str(biblionumber)
     
     collection_uuid = meta['collection_uuid']
-    if not collection_uuid: raise Exception("Collection UUID missing")
-
-    existing_item = local_dspace.find_item_by_biblionumber(biblionumber)
-    if existing_item:
-        logger.warning(f"🔄 Item already exists (UUID: {existing_item['uuid']}). Linking only.")
-        item_uuid = existing_item['uuid']
-        handle = existing_item.get('handle')
-        final_link = f"{DSPACE_UI_URL}/handle/{handle}" if handle else f"{DSPACE_UI_URL}/items/{item_uuid}"
-        return {"handle": final_link, "uuid": item_uuid, "status": "linked_existing"}
-
-    item_data = local_dspace.create_item_direct(collection_uuid, md)
-    if not item_data: raise Exception("Failed to create item in DSpace")
-
-    item_uuid = item_data['uuid']
-    handle = item_data.get('handle')
+    if not collection_uuid: raise PermanentError("Collection UUID missing")
+
+    resumed = bool(state.get('item_uuid'))
+    if not resumed:
+        # Спершу локальний індекс: Solr ще може не бачити Item, створений секунди тому
+        existing_item = reservations.known_item(biblionumber)
+        if existing_item:
+            exists = local_dspace.item_exists(existing_item['uuid'])
+            if exists is None: raise TransientError("Could not check cached item in DSpace")
+            if not exists:
+                # Item видалили вручну: індекс не повинен перекривати Solr до кінця TTL
+                logger.warning(f"🗑️ Cached item {existing_item['uuid']} for #{biblionumber} is gone, asking Solr")
+                reservations.forget_item(biblionumber)
+                existing_item = None
+        existing_item = existing_item or local_dspace.find_item_by_biblionumber(biblionumber)
+        if existing_item:
+            bitstreams = local_dspace.get_original_bitstreams(existing_item['uuid'])
+            if bitstreams is None: raise TransientError("Could not list bitstreams of existing item")
+            if bitstreams:
+                logger.warning(f"🔄 Item already exists (UUID: {existing_item['uuid']}). Linking only.")
+                reservations.set_item(biblionumber, existing_item['uuid'], existing_item.get('handle'))
+                item_uuid = existing_item['uuid']
+                handle = existing_item.get('handle')
+                final_link = f"{DSPACE_UI_URL}/handle/{handle}" if handle else f"{DSPACE_UI_URL}/items/{item_uuid}"
+                return {"handle": final_link, "uuid": item_uuid, "status": "linked_existing"}
+            # Порожній Item від перерваної спроби: доводимо його до кінця, а не лінкуємо без файлу
+            logger.warning(f"♻️ Item {existing_item['uuid']} exists without files, resuming upload")
+            state['item_uuid'], state['handle'] = existing_item['uuid'], existing_item.get('handle')
+            resumed = True
+        else:
+            item_data = local_dspace.create_item_direct(collection_uuid, md)
+            if not item_data: raise TransientError("Failed to create item in DSpace")
+            state['item_uuid'], state['handle'] = item_data['uuid'], item_data.get('handle')
+        reservations.set_item(biblionumber, state['item_uuid'], state['handle'])
+        on_step("item_created", item_uuid=state['item_uuid'], handle=state['handle'])
+
+    item_uuid = state['item_uuid']
+    handle = state.get('handle')
     final_link = f"{DSPACE_UI_URL}/handle/{handle}" if handle else f"{DSPACE_UI_URL}/items/{item_uuid}"
 
-    logger.info(f"📤 [DSpace-Thread] Uploading file to Item {item_uuid}")
-    if not local_dspace.upload_to_item(item_uuid, file_path):
-        raise Exception("Failed to upload file")
+    if not state.get('uploaded') and resumed and file_md5:
+        # Падіння між upload і записом кроку: файл міг уже дійти — звіряємо MD5
+        bitstreams = local_dspace.get_original_bitstreams(item_uuid)
+        # None — DSpace не відповів; вважати це «файлу немає» означало б дубль bitstream-а
+        if bitstreams is None: raise TransientError("Could not list bitstreams of resumed item")
+        if any((bs['md5'] or '').lower() == file_md5.lower() for bs in bitstreams):
+            logger.info(f"♻️ Bitstream with MD5 {file_md5} already in Item {item_uuid}, skipping upload")
+            state['uploaded'] = True
+            on_step("bitstream_uploaded")
+
+    if not state.get('uploaded'):
+        logger.info(f"📤 [DSpace-Thread] Uploading file to Item {item_uuid}")
+        if not local_dspace.upload_to_item(item_uuid, file_path, expected_md5=file_md5):
+            raise TransientError("Failed to upload file")
+        state['uploaded'] = True
+        on_step("bitstream_uploaded")
 
     logger.info(f"✅ [DSpace-Thread] Finished for #{biblionumber}")
     return {"handle": final_link, "uuid": item_uuid}
 
-def process_integration_logic(task_id, biblionumber):
-    logger.info(f"⚙️ [Core] Processing Biblio #{biblionumber}")
+def process_cover_followup(task_id, biblionumber, pdf_path, pdf_file):
+    """
+    Фонова задача обкладинки: генерація + upload у Koha + запис URL у 956$c.
+    Не впливає на статус інтеграції. Усі кроки повторюються в одному циклі з backoff
+    (зроблений upload не повторюється); вичерпані повтори -> DLQ з kind="cover".
+    :param pdf_path: локальна (staging) копія PDF, звільняється наприкінці
+    :param pdf_file: PDF у Processed: поруч пишеться covers/, з нього ж робить replay DLQ
+    """
     koha = KohaClient()
     cover_service = CoverService(koha_client=koha)
-    current_active_path = None
-
+    cover_res, error = None, None
+    try:
+        for attempt in range(1, COVER_RETRIES + 1):
+            try:
+                if cover_res is None:
+                    res = cover_service.process_book(str(biblionumber), pdf_path, os.path.dirname(pdf_file))
+                    logger.info(f"🖼️ [Cover-Job] #{biblionumber} result: {res}")
+                    if res.get('status') not in ['success', 'skipped']:
+                        raise TransientError(f"Cover not uploaded: {res.get('reason')}")
+                    cover_res = res
+
+                # Koha не одразу показує imagenumber
+                cover_url, answered = koha.lookup_cover_image_url(biblionumber)
+                if not cover_url and answered and cover_res.get('reason') == 'missing_library':
+                    return cover_res   # без pdf2image обкладинки не буде, якщо її не додали вручну
+                if not cover_url:
+                    raise TransientError("Cover URL not resolved yet" if answered else "Koha cover page unavailable")
+                if not koha.set_cover_url(biblionumber, cover_url):
+                    raise TransientError("Failed to write 956$c")
+                logger.info(f"🔗 [Cover-Job] #{biblionumber} 956$c = {cover_url}")
+                return {**cover_res, "cover_url": cover_url}
+            except Exception as e:
+                error = e
+                if attempt < COVER_RETRIES:
+                    delay = round(backoff_delay(attempt, base=COVER_RETRY_DELAY), 1)
+                    logger.info(f"⏳ [Cover-Job] #{biblionumber}: {e}, retry {attempt}/{COVER_RETRIES - 1} in {delay}s")
+                    time.sleep(delay)
+    finally:
+        staging_cache.release(pdf_path)
+
+    logger.error(f"❌ [Cover-Job] #{biblionumber} gave up after {COVER_RETRIES} attempts: {error}")
+    try:
+        dead_letters.add(biblionumber, f"Cover: {error}", "cover", COVER_RETRIES, file_path=pdf_file)
+    except Exception as dlq_err:
+        logger.error(f"Failed to record cover of #{biblionumber} in DLQ: {dlq_err}")
+    raise error
+
+def ensure_backends_available(*backends):
+    """Кидає CircuitOpenError, якщо breaker одного з бекендів відкритий (до будь-яких змін)."""
+    for name in backends:
+        if BREAKERS[name].is_open():
+            raise CircuitOpenError(name, BREAKERS[name].retry_after())
+
+def reject_if_unavailable(*backends):
+    """503 + Retry-After, поки бекенд лежить: нові задачі не накопичуються в потоках."""
     try:
-        # --- 1. SERIAL PHASE: Checks & Rename ---
-        meta = koha.get_biblio_metadata(biblionumber)
-        if not meta: raise Exception("No 956 field found")
+        ensure_backends_available(*backends)
+    except CircuitOpenError as e:
+        response = jsonify({"status": "unavailable", "message": str(e)})
+        response.headers['Retry-After'] = str(e.retry_after)
+        return response, 503
+    return None
+
+def process_integration_logic(task_id, biblionumber, resumed=False):
+    """
+    Інтеграція як послідовність кроків із журналом (renamed -> item_created ->
+    bitstream_uploaded -> koha_linked): після рестарту чи повтору продовжуємо
+    з останнього завершеного кроку.
+    Тимчасові збої (мережа, 5xx, відкритий breaker) повторюються з експоненційною
+    паузою, файл лишається на місці. Постійні збої або вичерпані повтори ->
+    956 error, файл у Error, запис у DLQ.
+    :param resumed: відновлення після рестарту (resume_incomplete_integrations)
+    """
+    logger.info(f"⚙️ [Core] Processing Biblio #{biblionumber}")
+    # Атомарний claim: друга задача для того ж biblio (робот + клік у Koha) не піде далі
+    owner = lease_owner(task_id)
+    claimed, holder = reservations.claim(biblionumber, owner)
+    if not claimed:
+        error = Exception(f"Biblio #{biblionumber} is already being integrated (task {holder['owner']} on {holder['node']})")
+        if resumed:
+            # Інакше запис журналу і файл у Processed лишаються «завислими» до наступного рестарту
+            koha = KohaClient()
+            fail_integration(biblionumber, koha, load_integration_context(biblionumber), error, 0)
+        raise error
 
+    koha = KohaClient()
+    ctx = load_integration_context(biblionumber)
+    ctx['owner'] = owner
+    attempt = 0
+
+    try:
+        while True:
+            attempt += 1
+            ensure_lease()
+            reservations.refresh(biblionumber, owner)
+            try:
+                return integration_attempt(biblionumber, koha, ctx)
+            except LeaseLostError:
+                # Задачу веде інший вузол: ні 956 error, ні Error-папки, ні DLQ
+                logger.warning(f"⚠️ [Core] #{biblionumber} lease lost, stopping before the next step")
+                raise
+            except Exception as e:
+                if is_transient(e) and attempt < RETRY_ATTEMPTS:
+                    delay = round(backoff_delay(attempt), 1)
+                    logger.warning(f"🔁 [Core] #{biblionumber} transient failure ({e}), retry {attempt}/{RETRY_ATTEMPTS - 1} in {delay}s")
+                    task_manager.update_progress(task_id, f"Retry {attempt}/{RETRY_ATTEMPTS - 1} in {delay}s: {e}")
+                    time.sleep(delay)
+                    continue
+                fail_integration(biblionumber, koha, ctx, e, attempt)
+                raise e
+    finally:
+        if ctx['staged']: staging_cache.release(ctx['staged']['path'])
+        reservations.release(biblionumber, owner)
+
+def load_integration_context(biblionumber):
+    """Стан спроби: з журналу, якщо попередній запуск обірвався посередині."""
+    ctx = {"record": None, "source_path": None, "path": None, "staged": None, "cover_task_id": None, "dspace": {}}
+    entry = integration_journal.load(biblionumber)
+    if not entry or entry['step'] == 'koha_linked':
+        return ctx
+
+    logger.info(f"♻️ [Core] #{biblionumber} resuming after step '{entry['step']}'")
+    ctx['source_path'] = entry['source_path']
+    if entry['step'] == 'renaming':
+        # Обрив посеред rename: файл або ще на місці 956$u, або вже під новим ім'ям
+        if entry['path'] and os.path.exists(entry['path']) and not os.path.exists(entry['source_path']):
+            integration_journal.save(biblionumber, "renamed")
+            ctx['path'] = entry['path']
+    else:
+        ctx['path'] = entry['path']
+    if step_reached(entry, "item_created"):
+        ctx['dspace'] = {"item_uuid": entry['item_uuid'], "handle": entry['handle'],
+                         "uploaded": step_reached(entry, "bitstream_uploaded")}
+    return ctx
+
+def integration_attempt(biblionumber, koha, ctx):
+    """Одна спроба; кроки, виконані раніше (ctx / журнал), пропускаються."""
+    # Koha/DSpace недоступні — відмовляємось до rename і запису помилки в 956
+    ensure_backends_available("koha", "dspace")
+
+    # Один запит + один прохід парсера: 956 і метадані DSpace разом
+    if not ctx['record']:
+        record = koha.get_biblio_record(biblionumber)
+        if not record: raise TransientError("Koha record unavailable")
+        if not record['koha']: raise PermanentError("No 956 field found")
+        ctx['record'] = record
+    record = ctx['record']
+    meta = record['koha']
+
+    # --- 1. SERIAL PHASE: Checks & Rename ---
+    if not ctx['path']:
         file_rel_path = meta['file_path']
         original_full_path = os.path.join(INTEGRATOR_MOUNT_PATH, file_rel_path)
+        ctx['source_path'] = original_full_path
         
         if not os.path.exists(original_full_path):
-            koha.set_status(biblionumber, 'error', f"File missing: {file_rel_path}")
-            raise Exception("File not found on disk")
+            raise PermanentError(f"File missing: {file_rel_path}")
 
         file_size = os.path.getsize(original_full_path)
         if file_size > LIMIT_ERROR:
-            msg = f"FILE TOO LARGE ({round(file_size/1024/1024)} MB)"
-            koha.set_status(biblionumber, 'error', msg)
-            raise Exception(msg)
+            raise PermanentError(f"FILE TOO LARGE ({round(file_size/1024/1024)} MB)")
         if file_size > LIMIT_WARNING:
             koha.set_status(biblionumber, None, f"Warning: {round(file_size/1024/1024)} MB")
 
         source_dir = os.path.dirname(original_full_path)
+
+        # Pre-flight: бите/обрізане PDF відсікаємо до rename, рендеру та створення Item
+        try:
+            pdf_ok, pdf_problem = check_pdf(original_full_path)
+        except OSError as e:
+            # Збій читання (rclone, NFS), а не битий файл: повторюємо, у карантин не відправляємо
+            raise TransientError(f"Could not read PDF for preflight: {e}")
+        if not pdf_ok:
+            ctx['quarantine'] = True
+            raise PermanentError(f"BROKEN PDF: {pdf_problem}")
+
         versioned_path = get_versioned_path(source_dir, biblionumber)
         
         logger.info(f"📂 [Core] Renaming to: {versioned_path}")
+        integration_journal.save(biblionumber, "renaming", source_path=original_full_path, path=versioned_path,
+                                 item_uuid=None, handle=None, md5=None)
         shutil.move(original_full_path, versioned_path)
-        current_active_path = versioned_path
-
-        # --- ⚡ 2. PARALLEL PHASE: DSpace + Cover ---
-        dspace_result = None
-        cover_url = None
-        
-        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
-            # Task A: Cover
-            pdf_dir = os.path.dirname(current_active_path)
-            future_cover = executor.submit(cover_service.process_book, str(biblionumber), current_active_path, pdf_dir)
-            
-            # Task B: DSpace
-            future_dspace = executor.submit(run_dspace_workflow, biblionumber, current_active_path, meta)
-            
-            logger.info("⚡ [Core] Parallel tasks started: Cover + DSpace")
-
-            # Check Critical Task (DSpace)
-            try:
-                dspace_result = future_dspace.result()
-            except Exception as e:
-                logger.error(f"❌ [Core] DSpace Thread failed: {e}")
-                raise e
-
-            # Check Bonus Task (Cover)
-            try:
-                cover_res = future_cover.result(timeout=10)
-                logger.info(f"🖼️ [Core] Cover result: {cover_res}")
-                
-                # 🟢 NEW: Retry Logic для отримання URL
-                if cover_res.get('status') in ['success', 'skipped']:
-                     # Робимо до 3 спроб з паузою, щоб Koha API встигло побачити картинку
-                     for attempt in range(3):
-                         real_url = koha.get_cover_image_url(biblionumber)
-                         if real_url:
-                             logger.info(f"🔗 [Core] Resolved Cover URL: {real_url}")
-                             cover_url = real_url
-                             break
-                         else:
-                             logger.info(f"⏳ [Core] Waiting for cover API index (attempt {attempt+1}/3)...")
-                             time.sleep(1)
-                     
-            except concurrent.futures.TimeoutError:
-                logger.warning("⚠️ [Core] Cover generation timeout.")
-            except Exception as e:
-                logger.warning(f"⚠️ [Core] Cover Thread warning: {e}")
+        integration_journal.save(biblionumber, "renamed")
+        ctx['path'] = versioned_path
+    elif not os.path.exists(ctx['path']):
+        raise PermanentError(f"Renamed file disappeared: {ctx['path']}")
+
+    # Єдине читання файлу з мережевого диска: далі працюємо з локальною копією
+    if not ctx['staged']:
+        try:
+            ctx['staged'] = staging_cache.stage(ctx['path'])
+        except OSError as e:
+            # Збій читання з rclone-диска, а не проблема файлу: повторюємо, файл лишається в Processed
+            raise TransientError(f"Could not stage {ctx['path']}: {e}") from e
+        integration_journal.update(biblionumber, md5=ctx['staged']['md5'])
+    staged = ctx['staged']
+    local_path = staged['path']
+
+    # --- 2. DSpace ---
+    try:
+        dspace_result = run_dspace_workflow(
+            biblionumber, local_path, meta, record['metadata'], staged['md5'], ctx['dspace'],
+            on_step=lambda step, **fields: record_step(biblionumber, ctx, step, **fields))
+    except Exception as e:
+        logger.error(f"❌ [Core] DSpace workflow failed: {e}")
+        raise e
 
-        # --- 3. FINALIZE ---
-        if dspace_result:
-            koha.set_success(
-                biblionumber, 
-                dspace_result['handle'], 
-                item_uuid=dspace_result['uuid'],
-                cover_url=cover_url 
-            )
+    # --- 3. FINALIZE: Handle у Koha одразу після DSpace ---
+    if not koha.set_success(biblionumber, dspace_result['handle'], item_uuid=dspace_result['uuid']):
+        raise TransientError("Failed to write 956/856 to Koha")
+    integration_journal.save(biblionumber, "koha_linked", item_uuid=dspace_result['uuid'])
+    # До старту обкладинки: її збій може сам записати biblio в DLQ (kind="cover")
+    dead_letters.remove(biblionumber)
+
+    # --- 4. Cover: незалежна фонова задача, яка сама допише 956$c ---
+    # Лише після успіху: невдала інтеграція не отримує 956$c, а файл уже точно лишається в Processed
+    if not ctx['cover_task_id']:
+        staging_cache.pin(local_path)
+        ctx['cover_task_id'] = task_manager.start_task(process_cover_followup, biblionumber, local_path, ctx['path'])
+        logger.info(f"🖼️ [Core] Cover job {ctx['cover_task_id']} started")
+    dspace_result['cover_task_id'] = ctx['cover_task_id']
+    dspace_result['size_mb'] = round(staged['size'] / 1024 / 1024, 2)   # робот нормалізує латентність на MB
+
+    return dspace_result
+
+def record_step(biblionumber, ctx, step, **fields):
+    """
+    Крок у журнал + продовження claim (довгий upload не має його «протермінувати»).
+    Якщо лізу задачі вже забрав інший вузол — зупиняємось тут, до наступного кроку.
+    """
+    integration_journal.save(biblionumber, step, **fields)
+    ensure_lease()
+    reservations.refresh(biblionumber, ctx['owner'])
+
+def fail_integration(biblionumber, koha, ctx, error, attempts):
+    """Остаточний збій: 956 = error, файл у Error, запис у DLQ (для replay)."""
+    kind = "transient" if is_transient(error) else "permanent"
+    logger.error(f"❌ [Core] Logic Error processing #{biblionumber} ({kind}, {attempts} attempts): {error}")
+    try: koha.set_status(biblionumber, 'error', str(error))
+    except: pass
+
+    # Файл у Error: перейменований (Processed) або оригінал, якщо це битий PDF
+    current = ctx['path'] or (ctx['source_path'] if ctx.get('quarantine') else None)
+    moved_to = None
+    if current and os.path.exists(current):
+        try:
+            source_dir = os.path.dirname(os.path.dirname(current)) if ctx['path'] else os.path.dirname(current)
+            moved_to = move_to_error_folder(current, source_dir)
+        except Exception as move_err:
+            logger.error(f"Failed to move file to Error folder: {move_err}")
+
+    # Файл пішов з Processed — журнал більше не описує реальний стан; replay почне з початку
+    # (порожній Item з попередньої спроби буде підхоплено, а не продубльовано)
+    try: integration_journal.discard(biblionumber)
+    except Exception as journal_err: logger.error(f"Failed to clear journal for #{biblionumber}: {journal_err}")
 
-        return dspace_result
+    try:
+        dead_letters.add(biblionumber, error, kind, attempts, file_path=moved_to, source_path=ctx['source_path'])
+    except Exception as dlq_err:
+        logger.error(f"Failed to record #{biblionumber} in DLQ: {dlq_err}")
 
-    except Exception as e:
-        logger.error(f"❌ [Core] Logic Error processing #{biblionumber}: {e}")
-        try: koha.set_status(biblionumber, 'error', str(e))
-        except: pass
-        
-        if current_active_path and os.path.exists(current_active_path):
-            try:
-                source_dir = os.path.dirname(current_active_path) 
-                parent_dir = os.path.dirname(source_dir) 
-                error_dir = os.path.join(parent_dir, FOLDER_ERROR)
-                os.makedirs(error_dir, exist_ok=True)
-                filename = os.path.basename(current_active_path)
-                shutil.move(current_active_path, os.path.join(error_dir, filename))
-            except Exception as move_err:
-                logger.error(f"Failed to move file to Error folder: {move_err}")
-        raise e
+def abandon_integration(job, error):
+    """
+    Кластерну інтеграцію покинуто (вузли вмирали на ній JOB_MAX_ATTEMPTS разів):
+    той самий остаточний збій, що й fail_integration, плюс claim останнього вузла.
+    """
+    biblionumber = job['args'][0]
+    try:
+        fail_integration(biblionumber, KohaClient(), load_integration_context(biblionumber),
+                         PermanentError(error), job['attempts'])
+    finally:
+        reservations.release(biblionumber, job['owner'])
+
+def resume_incomplete_integrations():
+    """Після рестарту ставить у чергу інтеграції, перервані посередині (за журналом)."""
+    entries = integration_journal.incomplete()
+    for entry in entries:
+        task_id = task_manager.start_task(process_integration_logic, entry['biblionumber'], True)
+        logger.info(f"♻️ [Core] #{entry['biblionumber']} interrupted at '{entry['step']}', resumed as task {task_id}")
+    return len(entries)
+
+def sync_metadata_logic(task_id, biblionumber, fields=None):
+    """Фонова задача sync метаданих (PUT та події Koha)."""
+    result = sync_metadata(biblionumber, fields)
+    if result['status'] != 'success':
+        raise Exception(result.get('message') or "DSpace metadata update failed")
+    return result
 
 @app.after_request
 def add_cors_headers(response):
@@ -239,46 +428,240 @@ def check_security():
         abort(401, description="Invalid Token")
 
 @app.route('/kdv/api/health', methods=['GET'])
-def healthcheck(): return jsonify({"status": "ok", "mode": "v6.5-parallel-covers"})
+def healthcheck():
+    return jsonify({"status": "ok", "mode": "v6.5-parallel-covers",
+                    "node": NODE_ID, "cluster": CLUSTER_MODE,
+                    "breakers": {name: breaker.info() for name, breaker in BREAKERS.items()}})
 
 @app.route('/kdv/api/integrate/<int:biblionumber>', methods=['POST'])
 def archive_record_async(biblionumber):
+    # callback_url: у JSON-тілі або в query (?callback_url=...)
+    callback_url = (request.get_json(silent=True) or {}).get('callback_url') or request.args.get('callback_url')
+    if callback_url and not is_valid_callback_url(callback_url):
+        return jsonify({"status": "error", "message": "callback_url must be an http(s) URL"}), 400
+    holder = reservations.active_claim(biblionumber)
+    if holder:
+        # owner у кластері — "job_id:вузол:спроба"; клієнту потрібен лише task_id
+        return jsonify({"status": "conflict", "message": "Biblio is already being integrated", "task_id": holder['owner'].split(':')[0]}), 409
+    rejected = reject_if_unavailable("koha", "dspace")
+    if rejected: return rejected
     try:
-        task_id = task_manager.start_task(process_integration_logic, biblionumber)
+        task_id = task_manager.start_task(process_integration_logic, biblionumber, callback_url=callback_url)
         return jsonify({"status": "accepted", "task_id": task_id}), 202
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
+@app.route('/kdv/api/integrate/batch', methods=['POST'])
+def archive_batch_async():
+    """
+    Тіло: {"biblionumbers": [1, 2, ...], "callback_url": "...", "task_callback_url": "..."}
+    callback_url отримує один POST зі зведенням, коли завершиться весь пакет.
+    """
+    data = request.get_json(silent=True) or {}
+    ids = data.get('biblionumbers')
+    if not isinstance(ids, list) or not ids or not all(str(i).isdigit() for i in ids):
+        return jsonify({"status": "error", "message": "biblionumbers must be a non-empty list of integers"}), 400
+    for key in ('callback_url', 'task_callback_url'):
+        if data.get(key) and not is_valid_callback_url(data[key]):
+            return jsonify({"status": "error", "message": f"{key} must be an http(s) URL"}), 400
+    rejected = reject_if_unavailable("koha", "dspace")
+    if rejected: return rejected
+    ids = list(dict.fromkeys(int(i) for i in ids))
+    batch_id, task_ids = task_manager.start_batch(process_integration_logic, ids,
+                                                  callback_url=data.get('callback_url'),
+                                                  task_callback_url=data.get('task_callback_url'))
+    return jsonify({"status": "accepted", "batch_id": batch_id,
+                    "task_ids": {str(k): v for k, v in task_ids.items()}}), 202
+
+@app.route('/kdv/api/batch/<batch_id>', methods=['GET'])
+def get_batch_status(batch_id):
+    info = task_manager.get_batch_status(batch_id)
+    return jsonify(info) if info else (jsonify({"status": "not_found"}), 404)
+
 @app.route('/kdv/api/status/<task_id>', methods=['GET'])
 def get_task_status(task_id):
     info = task_manager.get_status(task_id)
     return jsonify(info) if info else (jsonify({"status": "not_found"}), 404)
 
+def resolve_fields_param(value):
+    """'changed' -> поля з останнього reload правил; 'a,b' -> список; None -> усі поля."""
+    if not value: return None
+    if value == 'changed': return list(plan_registry.changed_fields)
+    return [f.strip() for f in value.split(',') if f.strip()]
+
+@app.route('/kdv/api/mapping', methods=['GET'])
+def mapping_info():
+    return jsonify(plan_registry.info())
+
+@app.route('/kdv/api/mapping/reload', methods=['POST'])
+def mapping_reload():
+    if not plan_registry.path:
+        return jsonify({"status": "error", "message": "MAPPING_CONFIG_PATH is not set"}), 400
+    reloaded = plan_registry.reload(force=True)
+    info = plan_registry.info()
+    if not reloaded:
+        if info['last_error']:
+            return jsonify({"status": "error", **info}), 422
+        return jsonify({"status": "unchanged", **info})
+    return jsonify({"status": "reloaded", **info})
+
 @app.route('/kdv/api/integrate/<int:biblionumber>', methods=['PUT'])
 def update_record(biblionumber):
-    koha = KohaClient()
-    dspace = DSpaceClient()
+    """Sync метаданих у фоні: 202 + task_id, результат — через /status або callback_url."""
+    # ?fields=changed — лише поля, яких торкнулась остання зміна правил; ?fields=a,b — явний список
+    fields = resolve_fields_param(request.args.get('fields'))
+    callback_url = (request.get_json(silent=True) or {}).get('callback_url') or request.args.get('callback_url')
+    if callback_url and not is_valid_callback_url(callback_url):
+        return jsonify({"status": "error", "message": "callback_url must be an http(s) URL"}), 400
+    rejected = reject_if_unavailable("koha", "dspace")
+    if rejected: return rejected
     try:
-        raw_xml = koha._get_biblio_xml(biblionumber)
-        md = parse_marc_details(raw_xml)
-        md['koha.biblionumber'] = str(biblionumber)
-        
-        meta = koha.get_biblio_metadata(biblionumber)
-        item_uuid = meta.get('dspace_uuid')
-
-        if not item_uuid and md.get('handle'):
-            item_uuid = dspace.find_item_uuid_by_handle(md['handle'])
-
-        if not item_uuid:
-            existing = dspace.find_item_by_biblionumber(biblionumber)
-            if existing: item_uuid = existing['uuid']
-
-        if not item_uuid:
-            return jsonify({"status": "error", "message": "Item not found"}), 404
-
-        success = dspace.update_metadata(item_uuid, md)
-        return jsonify({"status": "success"}) if success else (jsonify({"status": "error"}), 500)
-
+        task_id = task_manager.start_task(sync_metadata_logic, biblionumber, fields, callback_url=callback_url)
+        return jsonify({"status": "accepted", "task_id": task_id}), 202
     except Exception as e:
         logger.error(f"UPDATE ERROR: {e}")
-        return jsonify({"status": "error", "message": str(e)}), 500
\ No newline at end of file
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+def bulk_resync_logic(task_id, candidates, fields=None):
+    """Фонова задача масового re-sync; прогрес — у /status/<task_id>."""
+    return run_bulk_resync(candidates, fields, total=len(candidates),
+                           progress=lambda message: task_manager.update_progress(task_id, message))
+
+@app.route('/kdv/api/resync', methods=['POST'])
+def bulk_resync():
+    """
+    Масовий re-sync метаданих. Тіло:
+    {"ids": "1-5000, 7000" | [1, 2, 3], "fields": "changed" | "dc.title,dc.type", "callback_url": "..."}
+    """
+    data = request.get_json(silent=True) or {}
+    ids = data.get('ids')
+    if isinstance(ids, list): ids = ",".join(str(i) for i in ids)
+    candidates = parse_candidates_text(str(ids or '').splitlines())
+    if not candidates:
+        return jsonify({"status": "error", "message": "ids must be a list or a range spec like '1-100, 205'"}), 400
+    callback_url = data.get('callback_url')
+    if callback_url and not is_valid_callback_url(callback_url):
+        return jsonify({"status": "error", "message": "callback_url must be an http(s) URL"}), 400
+
+    fields = data.get('fields')
+    if isinstance(fields, list): fields = ",".join(fields)
+    fields = resolve_fields_param(fields)
+    rejected = reject_if_unavailable("koha", "dspace")
+    if rejected: return rejected
+    task_id = task_manager.start_task(bulk_resync_logic, candidates, fields, callback_url=callback_url)
+    return jsonify({"status": "accepted", "task_id": task_id, "total": len(candidates)}), 202
+
+# --- 📥 DEAD-LETTER QUEUE ---
+@app.route('/kdv/api/dlq', methods=['GET'])
+def dlq_list():
+    try:
+        limit = min(int(request.args.get('limit', 100)), 1000)
+        offset = int(request.args.get('offset', 0))
+    except ValueError:
+        return jsonify({"status": "error", "message": "limit and offset must be integers"}), 400
+    if limit < 0 or offset < 0:
+        return jsonify({"status": "error", "message": "limit and offset must be non-negative"}), 400
+    return jsonify({"total": dead_letters.count(), "items": dead_letters.list(limit, offset)})
+
+@app.route('/kdv/api/dlq/replay', methods=['POST'])
+def dlq_replay():
+    """
+    Повторний запуск інтеграцій з DLQ: {"biblionumbers": [...]} або {"all": true}.
+    Файл повертається з Error на місце 956$u, запис з DLQ видаляється
+    (новий збій поверне його туди). Для kind="cover" перезапускається лише обкладинка.
+    """
+    data = request.get_json(silent=True) or {}
+    if data.get('all'):
+        entries = dead_letters.list(limit=-1)
+    else:
+        ids = data.get('biblionumbers')
+        if not isinstance(ids, list) or not all(str(i).isdigit() for i in ids):
+            return jsonify({"status": "error", "message": "biblionumbers list or all=true required"}), 400
+        entries = [e for e in (dead_letters.get(int(i)) for i in ids) if e]
+    rejected = reject_if_unavailable("koha", "dspace")
+    if rejected: return rejected
+
+    tasks, problems = {}, {}
+    for entry in entries:
+        bib = entry['biblionumber']
+        try:
+            if entry['kind'] == 'cover':
+                # Інтеграція вже успішна: PDF у Processed, рендеримо з нього
+                staged = staging_cache.stage(entry['file_path'])
+                tasks[str(bib)] = task_manager.start_task(process_cover_followup, bib, staged['path'], entry['file_path'])
+            else:
+                restore_dead_letter_file(entry)
+                tasks[str(bib)] = task_manager.start_task(process_integration_logic, bib)
+            # Задача вже могла впасти й оновити запис — тоді він лишається в DLQ
+            dead_letters.remove(bib, updated_at=entry['updated_at'])
+        except Exception as e:
+            problems[str(bib)] = str(e)
+    logger.info(f"📤 [DLQ] Replayed {len(tasks)} entries, {len(problems)} problems")
+    return jsonify({"status": "accepted", "task_ids": tasks, "problems": problems}), 202
+
+def restore_dead_letter_file(entry):
+    """Повертає файл з Error туди, де його чекає 956$u."""
+    file_path, source_path = entry.get('file_path'), entry.get('source_path')
+    if not file_path or not source_path or os.path.exists(source_path): return
+    if not os.path.exists(file_path):
+        raise Exception(f"File not found in Error folder: {file_path}")
+    os.makedirs(os.path.dirname(source_path), exist_ok=True)
+    shutil.move(file_path, source_path)
+    logger.info(f"↩️ [DLQ] {file_path} -> {source_path}")
+
+# --- 🔔 ПОДІЇ ЗМІН У KOHA (debounce) ---
+def enqueue_metadata_sync(biblionumber):
+    # Поки бекенд лежить, кидаємо CircuitOpenError — Debouncer відкладе подію на наступне вікно
+    ensure_backends_available("koha", "dspace")
+    return task_manager.start_task(sync_metadata_logic, biblionumber)
+
+event_debouncer = Debouncer(on_fire=enqueue_metadata_sync)
+
+@app.route('/kdv/api/events', methods=['POST'])
+def biblio_events():
+    """
+    Сповіщення «biblio змінено»: {"biblionumber": 123} або {"biblionumbers": [...]}.
+    Повертає одразу; серія подій для одного запису згортається в один фоновий sync.
+    """
+    data = request.get_json(silent=True) or {}
+    ids = data.get('biblionumbers') or ([data['biblionumber']] if 'biblionumber' in data else [])
+    if not isinstance(ids, list) or not ids or not all(str(i).isdigit() for i in ids):
+        return jsonify({"status": "error", "message": "biblionumber(s) required"}), 400
+    for bib in ids:
+        event_debouncer.submit(int(bib))
+    return jsonify({"status": "accepted", "window_s": event_debouncer.window, "pending": event_debouncer.pending()}), 202
+
+# --- 👀 INBOX WATCHER (опційно) ---
+def enqueue_integration(biblionumber):
+    # Поки бекенд лежить, кидаємо CircuitOpenError — файл лишається в черзі watcher-а
+    ensure_backends_available("koha", "dspace")
+    if reservations.active_claim(biblionumber):
+        logger.info(f"⏭️ [Watcher] #{biblionumber} is already being integrated")
+        return None
+    return task_manager.start_task(process_integration_logic, biblionumber)
+
+# --- ♻️ ВІДНОВЛЕННЯ ПЕРЕРВАНИХ ІНТЕГРАЦІЙ ---
+# Claim-и попередніх процесів (інший BOOT_ID) нікому не належать
+# (у кластері БД спільна: звільняємо лише claim-и цього hostname)
+orphaned = reservations.release_orphaned(all_nodes=not CLUSTER_MODE)
+if orphaned: logger.info(f"♻️ Released {orphaned} orphaned reservations")
+
+# --- 🌐 CLUSTER MODE: спільна черга задач для кількох вузлів ---
+if CLUSTER_MODE:
+    job_queue = JobQueue(STATE_DB_PATH)
+    cluster_handlers = {"integrate": process_integration_logic, "sync": sync_metadata_logic}
+    task_manager.enable_cluster(job_queue, cluster_handlers)
+    JobWorkers(job_queue, cluster_handlers, CLUSTER_WORKERS,
+               on_abandon={"integrate": abandon_integration}).start()
+    logger.info(f"🌐 Cluster mode: node {NODE_ID}, {CLUSTER_WORKERS} workers")
+elif RESUME_ON_START:
+    # У кластері перервані задачі підхоплюються через прострочені лізи
+    resume_incomplete_integrations()
+
+# Watcher — після відновлення: перервані інтеграції беруть claim першими
+if WATCHER_ENABLED:
+    inbox_watcher = InboxWatcher(
+        koha_client=KohaClient(),
+        on_match=enqueue_integration
+    )
+    inbox_watcher.start()
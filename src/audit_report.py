@@ -0,0 +1,147 @@
+import os
+import csv
+import math
+import json
+import time
+import threading
+import logging
+
+logger = logging.getLogger("KDV-AuditReport")
+
+CSV_COLUMNS = ["biblionumber", "state", "action", "duration_ms",
+               "koha_calls", "koha_ms", "dspace_calls", "dspace_ms"]
+
+# Дія, яку аудит виконав для запису (для звіту)
+STATE_ACTIONS = {"synced": "metadata_updated", "sync_failed": "metadata_update_failed"}
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank перцентиль для відсортованого списку."""
+    if not sorted_values: return None
+    rank = max(1, math.ceil(pct / 100.0 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+class AuditReport:
+    """
+    Машиночитний звіт Night Walker: один рядок на запис (JSONL або CSV за розширенням)
+    і підсумок прогону (<report>.summary.json) з пропускною здатністю,
+    p50/p95/p99 латентності на бекенд та лічильниками категорій.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.is_csv = path.endswith('.csv')
+        directory = os.path.dirname(path)
+        if directory: os.makedirs(directory, exist_ok=True)
+        self._file = open(path, 'a', newline='', encoding='utf-8')
+        self._writer = csv.DictWriter(self._file, fieldnames=CSV_COLUMNS) if self.is_csv else None
+        if self._writer and self._file.tell() == 0: self._writer.writeheader()
+        self._lock = threading.Lock()
+        self._started = time.time()
+        self._counts = {}
+        self._latencies = {}   # { backend: [ms, ...] }
+        self._records = 0
+
+    def add(self, biblionumber, state, duration, calls):
+        """
+        :param duration: загальний час аудиту запису (сек)
+        :param calls: [(backend, сек), ...] з sessions.record_calls()
+        """
+        per_backend = {}
+        for backend, seconds in calls:
+            per_backend.setdefault(backend or "other", []).append(round(seconds * 1000, 1))
+
+        row = {
+            "biblionumber": biblionumber,
+            "state": state,
+            "action": STATE_ACTIONS.get(state, "none"),
+            "duration_ms": round(duration * 1000, 1),
+            "ts": round(time.time(), 3),
+        }
+        with self._lock:
+            self._records += 1
+            self._counts[state] = self._counts.get(state, 0) + 1
+            for backend, values in per_backend.items():
+                self._latencies.setdefault(backend, []).extend(values)
+
+            if self._writer:
+                self._writer.writerow({
+                    **{k: row[k] for k in ("biblionumber", "state", "action", "duration_ms")},
+                    "koha_calls": len(per_backend.get("koha", [])),
+                    "koha_ms": round(sum(per_backend.get("koha", [])), 1),
+                    "dspace_calls": len(per_backend.get("dspace", [])),
+                    "dspace_ms": round(sum(per_backend.get("dspace", [])), 1),
+                })
+            else:
+                self._file.write(json.dumps({**row, "calls_ms": per_backend}, ensure_ascii=False) + "\n")
+
+    def summary(self):
+        elapsed = max(time.time() - self._started, 1e-9)
+        with self._lock:
+            latency = {}
+            for backend, values in self._latencies.items():
+                ordered = sorted(values)
+                latency[backend] = {
+                    "calls": len(ordered),
+                    "p50_ms": percentile(ordered, 50),
+                    "p95_ms": percentile(ordered, 95),
+                    "p99_ms": percentile(ordered, 99),
+                }
+            return {
+                "records": self._records,
+                "elapsed_s": round(elapsed, 1),
+                "records_per_s": round(self._records / elapsed, 2),
+                "counts": dict(self._counts),
+                "latency": latency,
+            }
+
+    @property
+    def closed(self):
+        return self._file.closed
+
+    def close(self):
+        """Закриває файл рядків і пише підсумок. Повертає підсумок."""
+        summary = self.summary()
+        with self._lock:
+            self._file.close()
+        with open(f"{self.path}.summary.json", 'w', encoding='utf-8') as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+        return summary
+
+    @staticmethod
+    def summarize_files(paths):
+        """
+        Зведений підсумок із кількох JSONL-звітів (напр., від різних процесів шардованого прогону).
+        Запис, який аудитували двічі (шард процесу, що помер, перехопив інший), рахується один раз —
+        за останнім рядком.
+        """
+        latest = {}   # { biblionumber: (ts, state, calls_ms) }
+        first_ts, last_ts = None, None
+        for path in paths:
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    row = json.loads(line)
+                    previous = latest.get(row['biblionumber'])
+                    if previous is None or row['ts'] >= previous[0]:
+                        latest[row['biblionumber']] = (row['ts'], row['state'], row.get('calls_ms', {}))
+                    row_start = row['ts'] - row['duration_ms'] / 1000.0
+                    first_ts = row_start if first_ts is None else min(first_ts, row_start)
+                    last_ts = row['ts'] if last_ts is None else max(last_ts, row['ts'])
+
+        counts, latencies = {}, {}
+        for _, state, calls_ms in latest.values():
+            counts[state] = counts.get(state, 0) + 1
+            for backend, values in calls_ms.items():
+                latencies.setdefault(backend, []).extend(values)
+        records = len(latest)
+        elapsed = max((last_ts or 0) - (first_ts or 0), 1e-9)
+        return {
+            "records": records,
+            "elapsed_s": round(elapsed, 1),
+            "records_per_s": round(records / elapsed, 2),
+            "counts": counts,
+            "latency": {b: {"calls": len(v), "p50_ms": percentile(sorted(v), 50),
+                            "p95_ms": percentile(sorted(v), 95), "p99_ms": percentile(sorted(v), 99)}
+                        for b, v in latencies.items()},
+        }
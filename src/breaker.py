@@ -0,0 +1,109 @@
+"""
+Circuit breaker на бекенд (Koha / DSpace).
+Після серії збоїв (помилки з'єднання, таймаути, 5xx або виклики, що майже
+вичерпали свій timeout) запити до бекенду не йдуть у мережу, а одразу падають
+з CircuitOpenError. Через BREAKER_RECOVERY_SECONDS пропускається один пробний
+запит (half-open): успіх закриває breaker, збій — відкриває знову.
+"""
+import time
+import threading
+import logging
+import requests
+
+from .config import BREAKER_FAILURE_THRESHOLD, BREAKER_RECOVERY_SECONDS, BREAKER_SLOW_RATIO
+
+logger = logging.getLogger("KDV-Breaker")
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+
+class CircuitOpenError(requests.RequestException):
+    """Бекенд вважається недоступним; запит не виконувався."""
+
+    def __init__(self, backend, retry_after):
+        super().__init__(f"{backend} circuit is open (retry in {retry_after}s)")
+        self.backend = backend
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+
+    def __init__(self, name, failure_threshold=BREAKER_FAILURE_THRESHOLD,
+                 recovery_seconds=BREAKER_RECOVERY_SECONDS, slow_ratio=BREAKER_SLOW_RATIO):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_seconds = recovery_seconds
+        self.slow_ratio = slow_ratio
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def retry_after(self):
+        """Секунди до наступної пробної спроби (0, якщо breaker закритий)."""
+        with self._lock:
+            if self._state == CLOSED: return 0
+            return max(1, int(self._opened_at + self.recovery_seconds - time.monotonic()))
+
+    def is_open(self):
+        """True, якщо новий запит зараз було б відхилено (без зміни стану)."""
+        with self._lock:
+            if self._state == CLOSED: return False
+            if self._state == OPEN:
+                return time.monotonic() < self._opened_at + self.recovery_seconds
+            return self._probe_in_flight
+
+    def before_call(self):
+        """Кидає CircuitOpenError, якщо виклик не можна пропускати."""
+        with self._lock:
+            if self._state == CLOSED: return
+            now = time.monotonic()
+            if self._state == OPEN and now >= self._opened_at + self.recovery_seconds:
+                self._state = HALF_OPEN
+                self._probe_in_flight = False
+                logger.info(f"🟡 [{self.name}] breaker half-open, probing")
+            if self._state == HALF_OPEN and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return
+            retry_after = max(1, int(self._opened_at + self.recovery_seconds - now))
+        raise CircuitOpenError(self.name, retry_after)
+
+    def record(self, ok):
+        with self._lock:
+            if ok:
+                if self._state != CLOSED:
+                    logger.info(f"🟢 [{self.name}] breaker closed, backend recovered")
+                self._state = CLOSED
+                self._failures = 0
+                self._probe_in_flight = False
+                return
+            self._failures += 1
+            if self._state == HALF_OPEN or self._failures >= self.failure_threshold:
+                if self._state != OPEN:
+                    logger.error(f"🔴 [{self.name}] breaker OPEN after {self._failures} failures "
+                                 f"(next probe in {self.recovery_seconds}s)")
+                self._state = OPEN
+                self._opened_at = time.monotonic()
+                self._probe_in_flight = False
+
+    def info(self):
+        with self._lock:
+            return {"state": self._state, "consecutive_failures": self._failures}
+
+    def is_failure(self, response=None, error=None, elapsed=0, timeout=None):
+        """Збій для breaker-а: мережа/таймаут, 5xx або виклик, що майже вичерпав свій timeout."""
+        if error is not None:
+            return isinstance(error, (requests.ConnectionError, requests.Timeout))
+        if response is not None and response.status_code >= 500:
+            return True
+        if isinstance(timeout, (int, float)) and elapsed > timeout * self.slow_ratio:
+            return True
+        return False
+
+
+# Один breaker на бекенд — спільний для всіх клієнтів і потоків процесу
+BREAKERS = {"koha": CircuitBreaker("koha"), "dspace": CircuitBreaker("dspace")}
+
+def get_breaker(backend):
+    return BREAKERS.get(backend)
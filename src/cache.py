@@ -0,0 +1,45 @@
+import time
+import threading
+from collections import OrderedDict
+
+from .config import UUID_CACHE_TTL, UUID_CACHE_MAX
+
+
+class TTLCache:
+    """
+    Потокобезпечний кеш ключ -> значення з часом життя запису.
+    При переповненні витісняються найстаріші записи (LRU).
+    """
+
+    def __init__(self, ttl=UUID_CACHE_TTL, max_entries=UUID_CACHE_MAX):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._data = OrderedDict()   # { key: (expires_at, value) }
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None: return None
+            if entry[0] < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value):
+        if self.ttl <= 0 or value is None: return
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+
+# Кеші розв'язання DSpace item uuid (спільні для всіх запитів процесу)
+handle_uuid_cache = TTLCache()
+biblio_uuid_cache = TTLCache()
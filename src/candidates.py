@@ -0,0 +1,114 @@
+"""
+Списки кандидатів (biblionumber) у компактному вигляді.
+Діапазони на кшталт "1-5000000" зберігаються як один інтервал, а не мільйони чисел:
+пам'ять залежить від кількості інтервалів, а ітерація лінива.
+"""
+import os
+import bisect
+import logging
+
+logger = logging.getLogger("KDV-Candidates")
+
+
+class IntervalSet:
+    """
+    Відсортований список неперетинних закритих інтервалів [start, end].
+    Суміжні та перекриті інтервали зливаються при додаванні.
+    """
+
+    def __init__(self, intervals=()):
+        self._intervals = self._merge(intervals)
+
+    @staticmethod
+    def _merge(pairs):
+        """Одне сортування + один прохід: O(n log n) замість add() на кожну пару."""
+        merged = []
+        for start, end in sorted((min(s, e), max(s, e)) for s, e in pairs):
+            if merged and start <= merged[-1][1] + 1:
+                if end > merged[-1][1]: merged[-1] = (merged[-1][0], end)
+            else:
+                merged.append((start, end))
+        return merged
+
+    def add(self, start, end=None):
+        end = start if end is None else end
+        if start > end: start, end = end, start
+        # Перший інтервал, що може злитися з новим (його кінець >= start - 1)
+        idx = bisect.bisect_left(self._intervals, (start,))
+        if idx > 0 and self._intervals[idx - 1][1] >= start - 1:
+            idx -= 1
+        merged_start, merged_end = start, end
+        stop = idx
+        while stop < len(self._intervals) and self._intervals[stop][0] <= end + 1:
+            merged_start = min(merged_start, self._intervals[stop][0])
+            merged_end = max(merged_end, self._intervals[stop][1])
+            stop += 1
+        self._intervals[idx:stop] = [(merged_start, merged_end)]
+
+    @property
+    def intervals(self):
+        return list(self._intervals)
+
+    def __len__(self):
+        return sum(end - start + 1 for start, end in self._intervals)
+
+    def __bool__(self):
+        return bool(self._intervals)
+
+    def __iter__(self):
+        for start, end in self._intervals:
+            yield from range(start, end + 1)
+
+    def __contains__(self, value):
+        try: value = int(value)
+        except (TypeError, ValueError): return False
+        idx = bisect.bisect_right(self._intervals, (value, float('inf'))) - 1
+        return idx >= 0 and self._intervals[idx][0] <= value <= self._intervals[idx][1]
+
+    def __str__(self):
+        return ", ".join(str(s) if s == e else f"{s}-{e}" for s, e in self._intervals)
+
+
+def parse_candidates_text(lines):
+    """
+    Розбирає рядки формату:
+      105
+      100-110
+      300-305, 400   # коментар
+    :return: IntervalSet
+    """
+    # Пари збираються списком і зливаються один раз у кінці (тисячі окремих ID — не O(n²))
+    pairs = []
+    for line in lines:
+        # Видаляємо коментарі та зайві пробіли
+        line = line.split('#')[0].strip()
+        if not line: continue
+
+        # Розбиваємо по комі (якщо є перелік в одному рядку)
+        for part in line.split(','):
+            part = part.strip()
+            if not part: continue
+
+            # Перевірка на діапазон (наприклад "14-30"); "30-14" міняємо місцями при злитті
+            if '-' in part:
+                try:
+                    start_s, end_s = part.split('-')
+                    pairs.append((int(start_s), int(end_s)))
+                except ValueError:
+                    logger.error(f"⚠️ Invalid range format ignored: '{part}'")
+
+            # Звичайне число
+            elif part.isdigit():
+                pairs.append((int(part), int(part)))
+            else:
+                logger.warning(f"⚠️ Invalid ID format ignored: '{part}'")
+    return IntervalSet(pairs)
+
+
+def parse_candidates_file(filename):
+    """IntervalSet з файлу кандидатів (порожній, якщо файлу немає)."""
+    if not os.path.exists(filename):
+        logger.error(f"File {filename} not found!")
+        return IntervalSet()
+    with open(filename, 'r') as f:
+        return parse_candidates_text(f)
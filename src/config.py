@@ -47,4 +47,60 @@ FOLDER_PROCESSED = get_env("FOLDER_PROCESSED", default="Processed")
 FOLDER_ERROR = get_env("FOLDER_ERROR", default="Error")
 
 TIMEOUT = 30
-UPLOAD_TIMEOUT = 300
\ No newline at end of file
+UPLOAD_TIMEOUT = 300
+
+# Локальний кеш (SSD) для PDF: файл читається з rclone-диска лише один раз
+STAGING_DIR = get_env("STAGING_DIR", required=False, default="/tmp/kdv-staging")
+STAGING_MAX_BYTES = int(get_env("STAGING_MAX_MB", required=False, default="2048")) * 1024 * 1024
+
+# Inbox Watcher: автоматична постановка нових PDF у чергу
+WATCHER_ENABLED = get_env("WATCHER_ENABLED", required=False, default="false").lower() in ("1", "true", "yes")
+WATCHER_INTERVAL = int(get_env("WATCHER_INTERVAL", required=False, default="30"))
+# ID збереженого SQL-звіту Koha: рядки [biblionumber, 956$u] для записів, що чекають імпорту
+KOHA_PENDING_REPORT_ID = get_env("KOHA_PENDING_REPORT_ID", required=False, default=None)
+
+# Зовнішній файл правил мапування (JSON/YAML). Порожньо = правила з mapping.py
+MAPPING_CONFIG_PATH = get_env("MAPPING_CONFIG_PATH", required=False, default=None)
+MAPPING_RELOAD_INTERVAL = int(get_env("MAPPING_RELOAD_INTERVAL", required=False, default="10"))
+
+# Локальна БД стану (журнали, черги, лізи). Для БД на спільному томі між вузлами — DELETE
+STATE_DB_PATH = get_env("STATE_DB_PATH", required=False, default="data/kdv_state.db")
+STATE_DB_JOURNAL_MODE = get_env("STATE_DB_JOURNAL_MODE", required=False, default="WAL")
+
+# Події «biblio змінено»: серія збережень за вікно згортається в один sync метаданих
+EVENT_DEBOUNCE_SECONDS = int(get_env("EVENT_DEBOUNCE_SECONDS", required=False, default="30"))
+EVENT_MAX_DELAY = int(get_env("EVENT_MAX_DELAY", required=False, default="300"))
+
+# Кеш розв'язання handle -> uuid та biblionumber -> uuid (секунди; 0 вимикає)
+UUID_CACHE_TTL = int(get_env("UUID_CACHE_TTL", required=False, default="3600"))
+UUID_CACHE_MAX = int(get_env("UUID_CACHE_MAX", required=False, default="10000"))
+
+# Масовий re-sync метаданих (POST /kdv/api/resync, scripts/resync.py)
+RESYNC_WORKERS = int(get_env("RESYNC_WORKERS", required=False, default="4"))
+RESYNC_DSPACE_RPS = float(get_env("RESYNC_DSPACE_RPS", required=False, default="10"))
+
+# Circuit breaker на бекенд (Koha / DSpace)
+BREAKER_FAILURE_THRESHOLD = int(get_env("BREAKER_FAILURE_THRESHOLD", required=False, default="5"))   # збоїв поспіль
+BREAKER_RECOVERY_SECONDS = int(get_env("BREAKER_RECOVERY_SECONDS", required=False, default="30"))    # до пробного запиту
+BREAKER_SLOW_RATIO = float(get_env("BREAKER_SLOW_RATIO", required=False, default="0.8"))             # частка timeout, після якої виклик = збій
+
+# Повтори інтеграції при тимчасових збоях (мережа, 5xx, відкритий breaker)
+RETRY_ATTEMPTS = int(get_env("RETRY_ATTEMPTS", required=False, default="5"))          # разом з першою спробою
+RETRY_BASE_DELAY = float(get_env("RETRY_BASE_DELAY", required=False, default="5"))    # секунди, подвоюється
+RETRY_MAX_DELAY = float(get_env("RETRY_MAX_DELAY", required=False, default="300"))
+
+# Після рестарту продовжити інтеграції, перервані посередині (за журналом кроків)
+RESUME_ON_START = get_env("RESUME_ON_START", required=False, default="true").lower() in ("1", "true", "yes")
+
+# Резервації biblio (захист від дублікатів Item при паралельній роботі)
+RESERVATION_TTL = int(get_env("RESERVATION_TTL", required=False, default="3600"))             # claim без оновлення стає мертвим
+RESERVATION_ITEM_TTL = int(get_env("RESERVATION_ITEM_TTL", required=False, default="86400"))  # скільки пам'ятати створений Item
+
+# Кілька вузлів інтегратора: спільна черга задач з лізами.
+# STATE_DB_PATH має лежати на спільному томі (STATE_DB_JOURNAL_MODE=DELETE): там же reservations і журнал кроків
+CLUSTER_MODE = get_env("CLUSTER_MODE", required=False, default="false").lower() in ("1", "true", "yes")
+CLUSTER_WORKERS = int(get_env("CLUSTER_WORKERS", required=False, default="2"))          # задач одночасно на вузлі
+JOB_LEASE_SECONDS = int(get_env("JOB_LEASE_SECONDS", required=False, default="120"))
+JOB_HEARTBEAT_SECONDS = int(get_env("JOB_HEARTBEAT_SECONDS", required=False, default="30"))
+JOB_POLL_INTERVAL = float(get_env("JOB_POLL_INTERVAL", required=False, default="2"))
+JOB_MAX_ATTEMPTS = int(get_env("JOB_MAX_ATTEMPTS", required=False, default="3"))        # скільки разів задачу можна перехопити після смерті вузла
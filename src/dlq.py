@@ -0,0 +1,66 @@
+import time
+import logging
+
+from .config import STATE_DB_PATH
+from .state import StateStore
+
+logger = logging.getLogger("KDV-DLQ")
+
+
+class DeadLetterQueue(StateStore):
+    """
+    Інтеграції, що остаточно не вдались (постійна помилка або вичерпані повтори).
+    Один запис на biblionumber: повторний збій оновлює наявний.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS dead_letters (
+        biblionumber INTEGER PRIMARY KEY,
+        error        TEXT,
+        kind         TEXT,      -- transient / permanent / cover (інтеграція вдалась, не записано 956$c)
+        attempts     INTEGER,
+        file_path    TEXT,      -- де файл лежить зараз (Error/...), якщо його переміщено
+        source_path  TEXT,      -- куди повернути файл при replay (956$u)
+        failures     INTEGER NOT NULL DEFAULT 1,
+        created_at   REAL,
+        updated_at   REAL
+    );
+    """
+
+    def add(self, biblionumber, error, kind, attempts, file_path=None, source_path=None):
+        now = time.time()
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT INTO dead_letters (biblionumber, error, kind, attempts, file_path, source_path, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(biblionumber) DO UPDATE SET error=excluded.error, kind=excluded.kind, "
+                "attempts=excluded.attempts, file_path=COALESCE(excluded.file_path, dead_letters.file_path), "
+                "source_path=COALESCE(excluded.source_path, dead_letters.source_path), "
+                "failures=dead_letters.failures + 1, updated_at=excluded.updated_at",
+                (biblionumber, str(error)[:500], kind, attempts, file_path, source_path, now, now))
+        logger.warning(f"📥 [DLQ] #{biblionumber} ({kind}): {error}")
+
+    def get(self, biblionumber):
+        rows = self.query("SELECT * FROM dead_letters WHERE biblionumber = ?", (biblionumber,))
+        return rows[0] if rows else None
+
+    def list(self, limit=100, offset=0):
+        return self.query("SELECT * FROM dead_letters ORDER BY updated_at DESC LIMIT ? OFFSET ?", (limit, offset))
+
+    def count(self):
+        return self.query("SELECT COUNT(*) AS n FROM dead_letters")[0]['n']
+
+    def remove(self, biblionumber, updated_at=None):
+        """
+        :param updated_at: видалити, лише якщо запис не змінювався відтоді (replay:
+                           новий збій, що встиг повернути biblio в DLQ, не губиться)
+        """
+        with self.transaction() as conn:
+            if updated_at is None:
+                conn.execute("DELETE FROM dead_letters WHERE biblionumber = ?", (biblionumber,))
+            else:
+                conn.execute("DELETE FROM dead_letters WHERE biblionumber = ? AND updated_at = ?",
+                             (biblionumber, updated_at))
+
+
+dead_letters = DeadLetterQueue(STATE_DB_PATH)
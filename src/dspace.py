@@ -1,18 +1,26 @@
 import os
-import requests
 import logging
 import time
+import threading
 from requests.exceptions import RequestException
 from .config import DSPACE_API_URL, DSPACE_USER, DSPACE_PASS, TIMEOUT, UPLOAD_TIMEOUT
+from .sessions import make_session
+from .breaker import CircuitOpenError
 
 logger = logging.getLogger("DSpaceClient")
 
 class DSpaceClient:
-    def __init__(self):
+    def __init__(self, limiter=None, pool_size=10):
+        """
+        :param limiter: TokenBucket, спільний для всіх потоків (масові режими)
+        :param pool_size: розмір пулу з'єднань, якщо клієнт ділять кілька потоків
+        """
         self.base_url = DSPACE_API_URL
-        self.session = requests.Session()
+        self.session = make_session(limiter, pool_size, backend="dspace")
         self.session.headers.update({"Accept": "application/json"})
         self.token = None
+        # Один логін на всі потоки, що ділять клієнт
+        self._login_lock = threading.Lock()
 
     def _update_xsrf_header(self):
         csrf_cookie = self.session.cookies.get("DSPACE-XSRF-COOKIE")
@@ -24,6 +32,8 @@ class DSpaceClient:
         try:
             self.session.get(f"{self.base_url}/authn/status", timeout=TIMEOUT)
             self._update_xsrf_header()
+        except CircuitOpenError:
+            raise
         except Exception as e:
             logger.error(f"⚠️ DSpace is unreachable: {e}")
             return False
@@ -42,22 +52,31 @@ class DSpaceClient:
             logger.error(f"❌ Login Exception: {e}")
             return False
 
+    def _ensure_login(self, stale_token=None):
+        """Логін під замком: якщо інший потік уже оновив токен — повторно не логінимось."""
+        with self._login_lock:
+            if self.token and self.token != stale_token: return True
+            return self.login()
+
     def _request(self, method, endpoint, **kwargs):
         if not self.token and endpoint != "/authn/login":
-            if not self.login(): 
+            if not self._ensure_login(): 
                 return None
         
         url = f"{self.base_url}{endpoint}"
         current_timeout = kwargs.pop('timeout', TIMEOUT)
 
         try:
+            used_token = self.token
             resp = self.session.request(method, url, timeout=current_timeout, **kwargs)
             self._update_xsrf_header()
             
             if resp.status_code == 401:
-                if self.login():
+                if self._ensure_login(stale_token=used_token):
                     resp = self.session.request(method, url, timeout=current_timeout, **kwargs)
             return resp
+        except CircuitOpenError:
+            raise  # DSpace лежить: падаємо одразу, без логів на кожен запит
         except Exception as e:
             logger.error(f"❌ Request Exception [{method} {endpoint}]: {e}")
             return None
@@ -89,6 +108,30 @@ class DSpaceClient:
             except: pass
         return None
 
+    def find_items_by_biblionumbers(self, biblionumbers, chunk_size=50):
+        """
+        Пошук айтемів для багатьох biblionumber: один запит Solr на chunk_size номерів
+        (koha.biblionumber:(1 OR 2 OR ...)). :return: { biblionumber: {"uuid", "handle"} }
+        """
+        found = {}
+        ids = [str(b) for b in biblionumbers]
+        for i in range(0, len(ids), chunk_size):
+            chunk = ids[i:i + chunk_size]
+            params = {"query": f"koha.biblionumber:({' OR '.join(chunk)})", "dsoType": "item", "size": len(chunk) * 2}
+            resp = self._request("GET", "/discover/search/objects", params=params)
+            if resp is None or resp.status_code != 200: continue
+            try:
+                objects = resp.json().get('_embedded', {}).get('searchResult', {}).get('_embedded', {}).get('objects', [])
+                for obj in objects:
+                    item = obj['_embedded']['indexableObject']
+                    for entry in item.get('metadata', {}).get('koha.biblionumber', []):
+                        value = str(entry.get('value', '')).strip()
+                        if value in chunk and int(value) not in found:
+                            found[int(value)] = {"uuid": item['uuid'], "handle": item.get('handle')}
+            except Exception as e:
+                logger.warning(f"⚠️ Bulk item search parse error: {e}")
+        return found
+
     # 🟢 НОВИЙ МЕТОД
     def get_item_last_modified(self, item_uuid):
         """Повертає рядок lastModified (ISO 8601) для Item"""
@@ -97,15 +140,25 @@ class DSpaceClient:
             return resp.json().get('lastModified')
         return None
 
+    def item_exists(self, item_uuid):
+        """True/False за відповіддю /core/items/{uuid}; None, якщо DSpace не відповів."""
+        resp = self._request("GET", f"/core/items/{item_uuid}")
+        if resp is None: return None
+        if resp.status_code == 200: return True
+        if resp.status_code == 404: return False
+        return None
+
     def _format_metadata_value(self, value):
         if isinstance(value, list):
             return [{"value": str(v), "language": None} for v in value]
         return [{"value": str(value), "language": None}]
 
-    def update_metadata(self, item_uuid, metadata_dict):
+    def update_metadata(self, item_uuid, metadata_dict, fields=None):
+        """:param fields: якщо задано — PATCH лише цих полів (точковий re-sync після зміни правил)"""
         operations = []
         for key, value in metadata_dict.items():
             if key in ['handle', 'uuid'] or value is None: continue
+            if fields is not None and key not in fields: continue
             dspace_values = self._format_metadata_value(value)
             operations.append({"op": "replace", "path": f"/metadata/{key}", "value": dspace_values})
 
@@ -137,7 +190,24 @@ class DSpaceClient:
             return resp.json()
         return None
 
-    def upload_to_item(self, item_uuid, file_path):
+    def get_original_bitstreams(self, item_uuid):
+        """
+        Файли в бандлі ORIGINAL: [{"uuid", "name", "md5"}].
+        None, якщо DSpace не відповів (щоб не сплутати з порожнім айтемом).
+        """
+        resp = self._request("GET", f"/core/items/{item_uuid}/bundles")
+        if resp is None or resp.status_code != 200: return None
+        bundle_uuid = None
+        for b in resp.json().get('_embedded', {}).get('bundles', []):
+            if b['name'] == 'ORIGINAL': bundle_uuid = b['uuid']
+        if not bundle_uuid: return []
+
+        resp = self._request("GET", f"/core/bundles/{bundle_uuid}/bitstreams")
+        if resp is None or resp.status_code != 200: return None
+        return [{"uuid": bs['uuid'], "name": bs.get('name'), "md5": (bs.get('checkSum') or {}).get('value')}
+                for bs in resp.json().get('_embedded', {}).get('bitstreams', [])]
+
+    def upload_to_item(self, item_uuid, file_path, expected_md5=None):
         if not os.path.exists(file_path): return False
         
         bundle_uuid = None
@@ -157,7 +227,14 @@ class DSpaceClient:
                 files = {'file': (os.path.basename(file_path), f, 'application/pdf')}
                 resp = self._request("POST", f"/core/bundles/{bundle_uuid}/bitstreams", 
                                      files=files, timeout=UPLOAD_TIMEOUT)
-                return resp and resp.status_code in [200, 201]
+                if not (resp and resp.status_code in [200, 201]): return False
+                # Звіряємо MD5, порахований під час staging, з тим, що зберіг DSpace
+                if expected_md5:
+                    remote_md5 = (resp.json().get('checkSum') or {}).get('value')
+                    if remote_md5 and remote_md5.lower() != expected_md5.lower():
+                        logger.error(f"❌ Checksum mismatch for {os.path.basename(file_path)}: {remote_md5} != {expected_md5}")
+                        return False
+                return True
         except Exception: return False
         finally:
             if old_ct: self.session.headers["Content-Type"] = old_ct
\ No newline at end of file
@@ -0,0 +1,28 @@
+"""
+Класифікація збоїв інтеграції.
+Transient — мережа, таймаути, 5xx, відкритий circuit breaker: повторюємо з паузою.
+Permanent — проблема самого запису чи файлу: повтор нічого не змінить.
+"""
+import random
+import requests
+
+from .config import RETRY_BASE_DELAY, RETRY_MAX_DELAY
+
+
+class TransientError(Exception):
+    """Тимчасовий збій: варто повторити пізніше."""
+
+
+class PermanentError(Exception):
+    """Збій, який не зникне сам (немає 956, битий PDF, завеликий файл...)."""
+
+
+def is_transient(error):
+    if isinstance(error, PermanentError): return False
+    return isinstance(error, (TransientError, requests.RequestException, TimeoutError, ConnectionError))
+
+
+def backoff_delay(attempt, base=RETRY_BASE_DELAY, cap=RETRY_MAX_DELAY):
+    """Експоненційна пауза з jitter: половина фіксована, половина випадкова (щоб повтори не йшли хвилею)."""
+    delay = min(cap, base * 2 ** (attempt - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
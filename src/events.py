@@ -0,0 +1,68 @@
+import time
+import threading
+import logging
+
+from .config import EVENT_DEBOUNCE_SECONDS, EVENT_MAX_DELAY
+from .breaker import CircuitOpenError
+
+logger = logging.getLogger("KDV-Events")
+
+
+class Debouncer:
+    """
+    Згортає серію подій «biblio змінено» в одну дію на biblionumber.
+    Дія запускається, коли з останньої події минуло window секунд
+    (але не пізніше max_delay від першої — щоб безперервне редагування не відкладало sync вічно).
+    Один фоновий потік на всі biblionumber.
+    """
+
+    def __init__(self, on_fire, window=EVENT_DEBOUNCE_SECONDS, max_delay=EVENT_MAX_DELAY):
+        """
+        :param on_fire: callback(biblionumber) — постановка sync у чергу
+        """
+        self.on_fire = on_fire
+        self.window = window
+        self.max_delay = max(max_delay, window)
+        self._pending = {}   # { biblionumber: (first_seen, deadline, events) }
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def submit(self, biblionumber):
+        """Реєструє подію. Повертає кількість подій, уже згорнутих для цього запису."""
+        now = time.monotonic()
+        with self._cond:
+            first_seen, _, events = self._pending.get(biblionumber, (now, None, 0))
+            deadline = min(now + self.window, first_seen + self.max_delay)
+            self._pending[biblionumber] = (first_seen, deadline, events + 1)
+            self._cond.notify()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, daemon=True)
+                self._thread.start()
+            return events + 1
+
+    def pending(self):
+        with self._cond:
+            return len(self._pending)
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                now = time.monotonic()
+                due = [bib for bib, (_, deadline, _) in self._pending.items() if deadline <= now]
+                fired = {bib: self._pending.pop(bib)[2] for bib in due}
+                if not fired:
+                    next_deadline = min((d for _, d, _ in self._pending.values()), default=None)
+                    self._cond.wait(None if next_deadline is None else next_deadline - now)
+                    continue
+
+            for bib, events in fired.items():
+                logger.info(f"🔔 #{bib}: {events} change event(s) collapsed into one sync")
+                try:
+                    self.on_fire(bib)
+                except CircuitOpenError as e:
+                    # Бекенд лежить — не губимо подію: повторна спроба через наступне вікно
+                    logger.warning(f"⚠️ #{bib}: failed to enqueue sync ({e}), retrying in {self.window}s")
+                    self.submit(bib)
+                except Exception as e:
+                    # Інша помилка від повтору не зникне — інакше подія крутилася б вічно
+                    logger.error(f"❌ #{bib}: failed to enqueue sync ({e}), event dropped")
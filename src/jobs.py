@@ -0,0 +1,263 @@
+"""
+Спільна черга задач для кількох вузлів інтегратора (CLUSTER_MODE).
+Задача бере лізу (lease_until) і продовжує її heartbeat-ом; якщо вузол помер,
+ліза спливає і задачу підхоплює інший вузол. Кроки інтеграції при цьому
+продовжуються з журналу (journal.py), а reservations не дають двом вузлам
+працювати з одним biblio одночасно.
+"""
+import json
+import time
+import uuid
+import socket
+import threading
+import logging
+
+from .config import JOB_LEASE_SECONDS, JOB_HEARTBEAT_SECONDS, JOB_POLL_INTERVAL, JOB_MAX_ATTEMPTS
+from .state import StateStore
+from .tasks import send_callback
+
+logger = logging.getLogger("KDV-Jobs")
+
+NODE_ID = socket.gethostname()
+TERMINAL = ("success", "error")
+
+# Задача, яку виконує поточний потік-воркер (для перевірки лізи всередині обробника)
+_current = threading.local()
+
+
+class LeaseLostError(Exception):
+    """Лізу задачі забрав інший вузол: обробник має зупинитися, не чіпаючи стан."""
+
+
+def lease_owner(task_id):
+    """
+    Власник reservation для задачі: job_id + вузол + спроба. Вузол, що перехопив
+    прострочену лізу, отримує інший owner і не «успадковує» claim попередника.
+    Поза JobWorkers (локальний TaskManager) — просто task_id.
+    """
+    job = getattr(_current, 'job', None)
+    if not job or job['id'] != task_id: return task_id
+    return _owner(task_id, NODE_ID, job['attempt'])
+
+
+def _owner(job_id, node, attempt):
+    return f"{job_id}:{node}:{attempt}"
+
+
+def ensure_lease():
+    """Кидає LeaseLostError, якщо heartbeat поточної задачі вже не зміг продовжити лізу."""
+    job = getattr(_current, 'job', None)
+    if job and job['lost'].is_set():
+        raise LeaseLostError(f"Lease of job {job['id']} was taken over by another node")
+
+
+class JobQueue(StateStore):
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS jobs (
+        id           TEXT PRIMARY KEY,
+        kind         TEXT NOT NULL,
+        args         TEXT NOT NULL,    -- JSON-список аргументів обробника
+        status       TEXT NOT NULL,    -- queued -> processing -> success / error
+        node         TEXT,
+        lease_until  REAL,
+        attempts     INTEGER NOT NULL DEFAULT 0,
+        progress     TEXT,
+        result       TEXT,
+        error        TEXT,
+        callback_url TEXT,
+        callback     TEXT,
+        created_at   REAL,
+        updated_at   REAL
+    );
+    CREATE INDEX IF NOT EXISTS jobs_claimable ON jobs (status, lease_until, created_at);
+    """
+
+    def enqueue(self, kind, args, callback_url=None):
+        job_id = str(uuid.uuid4())
+        now = time.time()
+        with self.transaction() as conn:
+            conn.execute("INSERT INTO jobs (id, kind, args, status, progress, callback_url, created_at, updated_at) "
+                         "VALUES (?, ?, ?, 'queued', 'Task initialized', ?, ?, ?)",
+                         (job_id, kind, json.dumps(list(args)), callback_url, now, now))
+        logger.info(f"🚀 [Job {job_id}] {kind}{tuple(args)} queued")
+        return job_id
+
+    def claim(self, kinds, lease=JOB_LEASE_SECONDS):
+        """
+        Атомарно бере найстаршу задачу: нову або з простроченою лізою (вузол помер).
+        Задачу, яку вже JOB_MAX_ATTEMPTS разів перехоплювали, не запускаємо: вона
+        переходить в error і повертається з abandoned=True (прибирання + callback).
+        :return: dict задачі або None
+        """
+        now = time.time()
+        placeholders = ", ".join("?" for _ in kinds)
+        with self.transaction() as conn:
+            row = conn.execute(
+                f"SELECT * FROM jobs WHERE kind IN ({placeholders}) AND "
+                f"(status = 'queued' OR (status = 'processing' AND lease_until < ?)) "
+                f"ORDER BY created_at LIMIT 1", (*kinds, now)).fetchone()
+            if not row: return None
+            if row['status'] == 'processing':
+                logger.warning(f"⌛ [Job {row['id']}] lease of {row['node']} expired, reclaiming")
+            if row['attempts'] >= JOB_MAX_ATTEMPTS:
+                # Задача, на якій вузли падають знову і знову, — не крутимо її вічно.
+                # attempts — кількість claim-ів; кожен із них закінчився простроченою лізою
+                error = f"Abandoned: lease expired on all {row['attempts']} attempts (last node: {row['node']})"
+                conn.execute("UPDATE jobs SET status = 'error', error = ?, progress = 'Failed', updated_at = ? WHERE id = ?",
+                             (error, now, row['id']))
+                job = dict(row, status='error', error=error, abandoned=True,
+                           owner=_owner(row['id'], row['node'], row['attempts']))
+                job['args'] = json.loads(job['args'])
+                return job
+            conn.execute("UPDATE jobs SET status = 'processing', node = ?, lease_until = ?, attempts = attempts + 1, "
+                         "progress = 'Starting logic...', updated_at = ? WHERE id = ?",
+                         (NODE_ID, now + lease, now, row['id']))
+            job = dict(row)
+        job['args'] = json.loads(job['args'])
+        return job
+
+    def heartbeat(self, job_id, lease=JOB_LEASE_SECONDS):
+        """Продовжує лізу. False — задачу вже забрав інший вузол."""
+        with self.transaction() as conn:
+            cursor = conn.execute("UPDATE jobs SET lease_until = ? WHERE id = ? AND node = ? AND status = 'processing'",
+                                  (time.time() + lease, job_id, NODE_ID))
+            return cursor.rowcount == 1
+
+    def complete(self, job_id, status, result=None, error=None):
+        """Фіксує результат, лише якщо ліза ще наша (інакше задачу веде інший вузол)."""
+        with self.transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, progress = ?, updated_at = ? "
+                "WHERE id = ? AND node = ? AND status = 'processing'",
+                (status, json.dumps(result, default=str), error,
+                 "Completed successfully" if status == 'success' else "Failed", time.time(), job_id, NODE_ID))
+            return cursor.rowcount == 1
+
+    def update_progress(self, job_id, progress):
+        with self.transaction() as conn:
+            conn.execute("UPDATE jobs SET progress = ?, updated_at = ? WHERE id = ?", (progress, time.time(), job_id))
+
+    def set_callback_state(self, job_id, state):
+        with self.transaction() as conn:
+            conn.execute("UPDATE jobs SET callback = ? WHERE id = ?", (state, job_id))
+
+    def get(self, job_id):
+        """Стан задачі у форматі TASKS (для /status)."""
+        rows = self.query("SELECT * FROM jobs WHERE id = ?", (job_id,))
+        if not rows: return None
+        job = rows[0]
+        return {
+            "status": job['status'],
+            "created_at": job['created_at'],
+            "progress": job['progress'],
+            "result": json.loads(job['result']) if job['result'] else None,
+            "error": job['error'],
+            "callback_url": job['callback_url'],
+            "callback": job['callback'],
+            "node": job['node'],
+            "attempts": job['attempts'],
+        }
+
+    def cleanup(self, max_age_seconds):
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM jobs WHERE status IN ('success', 'error') AND updated_at < ?",
+                         (time.time() - max_age_seconds,))
+
+
+class JobWorkers:
+    """
+    Потоки-воркери вузла: беруть задачі зі спільної черги, поки вона не порожня.
+    Кожна виконувана задача має heartbeat-потік, що продовжує лізу.
+    """
+
+    def __init__(self, queue, handlers, count, poll_interval=JOB_POLL_INTERVAL, on_abandon=None):
+        """
+        :param handlers: { kind: func(task_id, *args) }
+        :param on_abandon: { kind: func(job, error) } — прибирання після покинутої задачі
+                           (job['owner'] — власник reservation останнього claim-у)
+        """
+        self.queue = queue
+        self.handlers = handlers
+        self.on_abandon = on_abandon or {}
+        self.count = count
+        self.poll_interval = poll_interval
+        self._stop = threading.Event()
+
+    def start(self):
+        for i in range(self.count):
+            threading.Thread(target=self._loop, name=f"job-worker-{i}", daemon=True).start()
+        logger.info(f"🧵 {self.count} job workers started on {NODE_ID} (kinds: {sorted(self.handlers)})")
+
+    def stop(self):
+        self._stop.set()
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                job = self.queue.claim(list(self.handlers))
+            except Exception as e:
+                logger.error(f"❌ Job claim failed: {e}")
+                job = None
+            if not job:
+                self._stop.wait(self.poll_interval)
+                continue
+            if job.get('abandoned'):
+                self._abandon(job)
+                continue
+            self._run(job)
+
+    def _abandon(self, job):
+        """Задача вже в error (JobQueue.claim): прибираємо її слід і повідомляємо, як про будь-який збій."""
+        job_id, error = job['id'], job['error']
+        logger.error(f"❌ [Job {job_id}] {job['kind']}{tuple(job['args'])} {error}")
+        cleanup = self.on_abandon.get(job['kind'])
+        if cleanup:
+            try:
+                cleanup(job, error)
+            except Exception as e:
+                logger.error(f"❌ [Job {job_id}] cleanup after abandon failed: {e}")
+        self._notify(job, "error", None, error)
+
+    def _run(self, job):
+        job_id = job['id']
+        done = threading.Event()
+        lost = threading.Event()
+
+        def heartbeat():
+            while not done.wait(JOB_HEARTBEAT_SECONDS):
+                try:
+                    if not self.queue.heartbeat(job_id):
+                        # Обробник побачить це на наступному кроці (ensure_lease) і зупиниться
+                        logger.warning(f"⚠️ [Job {job_id}] lease lost")
+                        lost.set()
+                        return
+                except Exception as e:
+                    logger.warning(f"⚠️ [Job {job_id}] heartbeat failed: {e}")
+
+        threading.Thread(target=heartbeat, daemon=True).start()
+        _current.job = {"id": job_id, "attempt": job['attempts'] + 1, "lost": lost}
+        logger.info(f"▶️ [Job {job_id}] {job['kind']}{tuple(job['args'])} started (attempt {job['attempts'] + 1})")
+        status, result, error = "success", None, None
+        try:
+            result = self.handlers[job['kind']](job_id, *job['args'])
+            logger.info(f"✅ [Job {job_id}] Finished successfully.")
+        except Exception as e:
+            status, error = "error", str(e)
+            logger.error(f"❌ [Job {job_id}] FAILED: {e}")
+        finally:
+            done.set()
+            _current.job = None
+
+        if not self.queue.complete(job_id, status, result, error):
+            logger.warning(f"⚠️ [Job {job_id}] result discarded: lease was taken over by another node")
+            return
+        self._notify(job, status, result, error)
+
+    def _notify(self, job, status, result, error):
+        if not job.get('callback_url'): return
+        job_id = job['id']
+        payload = {"task_id": job_id, "status": status, "result": result, "error": error}
+        self.queue.set_callback_state(job_id, "pending")
+        send_callback(job['callback_url'], payload,
+                      lambda ok: self.queue.set_callback_state(job_id, "delivered" if ok else "failed"))
@@ -0,0 +1,77 @@
+import time
+import logging
+
+from .config import STATE_DB_PATH
+from .state import StateStore
+
+logger = logging.getLogger("KDV-Journal")
+
+# Кроки інтеграції по порядку. "renaming" пишеться ДО переміщення файлу,
+# щоб після падіння посеред rename було видно, куди файл мав потрапити.
+STEPS = ["renaming", "renamed", "item_created", "bitstream_uploaded", "koha_linked"]
+
+
+def step_reached(entry, step):
+    """True, якщо запис журналу вже пройшов крок step."""
+    return bool(entry) and STEPS.index(entry['step']) >= STEPS.index(step)
+
+
+class IntegrationJournal(StateStore):
+    """
+    Журнал кроків інтеграції (один рядок на biblionumber).
+    Після рестарту або повтору інтеграція продовжує з останнього завершеного кроку:
+    не перейменовує файл удруге, не створює другий Item і не заливає PDF повторно.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS integrations (
+        biblionumber INTEGER PRIMARY KEY,
+        step         TEXT NOT NULL,
+        source_path  TEXT,     -- 956$u на диску
+        path         TEXT,     -- версійований файл у Processed
+        md5          TEXT,
+        item_uuid    TEXT,
+        handle       TEXT,
+        started_at   REAL,
+        updated_at   REAL
+    );
+    """
+
+    def load(self, biblionumber):
+        rows = self.query("SELECT * FROM integrations WHERE biblionumber = ?", (biblionumber,))
+        return rows[0] if rows else None
+
+    def save(self, biblionumber, step, **fields):
+        """Фіксує завершений крок (і дані, потрібні для наступних)."""
+        now = time.time()
+        columns = ["step", "updated_at"] + list(fields)
+        values = [step, now] + list(fields.values())
+        with self.transaction() as conn:
+            exists = conn.execute("SELECT 1 FROM integrations WHERE biblionumber = ?", (biblionumber,)).fetchone()
+            if exists:
+                assignments = ", ".join(f"{c} = ?" for c in columns)
+                conn.execute(f"UPDATE integrations SET {assignments} WHERE biblionumber = ?", values + [biblionumber])
+            else:
+                conn.execute(
+                    f"INSERT INTO integrations (biblionumber, started_at, {', '.join(columns)}) "
+                    f"VALUES (?, ?, {', '.join('?' for _ in columns)})",
+                    [biblionumber, now] + values)
+        logger.info(f"📒 #{biblionumber} -> {step}")
+
+    def update(self, biblionumber, **fields):
+        """Доповнює поточний крок даними (напр., md5 після staging), не змінюючи step."""
+        assignments = ", ".join(f"{c} = ?" for c in fields)
+        with self.transaction() as conn:
+            conn.execute(f"UPDATE integrations SET {assignments}, updated_at = ? WHERE biblionumber = ?",
+                         list(fields.values()) + [time.time(), biblionumber])
+
+    def discard(self, biblionumber):
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM integrations WHERE biblionumber = ?", (biblionumber,))
+
+    def incomplete(self):
+        """Інтеграції, перервані до koha_linked (для відновлення після рестарту)."""
+        return self.query("SELECT * FROM integrations WHERE step != 'koha_linked' ORDER BY updated_at")
+
+
+integration_journal = IntegrationJournal(STATE_DB_PATH)
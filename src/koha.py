@@ -1,24 +1,39 @@
-import requests
 import logging
 import pymarc
 import os
 import re
 import json
 import time
+import threading
 from io import BytesIO
 from urllib.parse import urljoin
 from pymarc import parse_xml_to_array, Field, Subfield
 from requests.auth import HTTPBasicAuth
 
 # 🟢 NEW: Імпортуємо KOHA_OPAC_URL
-from .config import KOHA_API_URL, KOHA_OPAC_URL, KOHA_USER, KOHA_PASS, TIMEOUT
+from .marc import parse_biblio, iter_records
+from .sessions import make_session
+from .config import KOHA_API_URL, KOHA_OPAC_URL, KOHA_USER, KOHA_PASS, TIMEOUT, KOHA_PENDING_REPORT_ID
 
 logger = logging.getLogger("KohaClient")
 
+# Блокування на рівні biblio: read-modify-write 956 з різних потоків (інтеграція,
+# задача обкладинки) не повинні затирати зміни одне одного
+_RECORD_LOCKS = {}
+_RECORD_LOCKS_GUARD = threading.Lock()
+
+def _record_lock(biblio_id):
+    with _RECORD_LOCKS_GUARD:
+        return _RECORD_LOCKS.setdefault(str(biblio_id), threading.Lock())
+
 class KohaClient:
-    def __init__(self):
+    def __init__(self, limiter=None, pool_size=10):
+        """
+        :param limiter: TokenBucket, спільний для всіх потоків (масові режими)
+        :param pool_size: розмір пулу з'єднань, якщо клієнт ділять кілька потоків
+        """
         self.base_url = KOHA_API_URL
-        self.session = requests.Session()
+        self.session = make_session(limiter, pool_size, backend="koha")
         self.session.auth = HTTPBasicAuth(KOHA_USER, KOHA_PASS)
         self.session.headers.update({
             "Content-Type": "application/json",
@@ -26,7 +41,7 @@ class KohaClient:
         })
         
         # Окрема сесія для CGI операцій (емуляція браузера)
-        self.cgi_session = requests.Session()
+        self.cgi_session = make_session(limiter, pool_size, backend="koha")
         self.cgi_session.headers.update({
             'User-Agent': 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:147.0) Gecko/20100101 Firefox/147.0',
             'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
@@ -38,34 +53,65 @@ class KohaClient:
     # --- STANDARD MARC API METHODS ---
 
     def _get_biblio_xml(self, biblio_id):
+        return self._fetch_biblio_xml(biblio_id)[0]
+
+    def _fetch_biblio_xml(self, biblio_id):
+        """:return: (MARCXML або None, answered); answered=False — Koha не відповіла (мережа, 5xx), а не «запису немає»"""
         url = f"{self.base_url}/api/v1/biblios/{biblio_id}"
         headers = {"Accept": "application/marcxml+xml"}
         try:
             resp = self.session.get(url, headers=headers, timeout=TIMEOUT)
             if resp.status_code == 200:
-                return resp.text
-            return None
+                return resp.text, True
+            return None, resp.status_code < 500
         except Exception as e:
             logger.error(f"❌ Network error fetching #{biblio_id}: {e}")
-            return None
+            return None, False
 
-    def get_biblio_metadata(self, biblio_id: int):
+    def get_biblio_record(self, biblio_id: int):
+        """
+        Один запит + один прохід парсера.
+        :return: {"metadata", "koha" (956), "timestamp" (005), "biblionumber"} або None
+        """
         xml_data = self._get_biblio_xml(biblio_id)
         if not xml_data: return None
+        return parse_biblio(xml_data)
 
-        record = self._parse_marc(xml_data)
-        if not record: return None
+    def get_biblio_records_bulk(self, biblio_ids):
+        """
+        Кілька записів одним запитом: GET /biblios?q={"biblio_id": [...]} у форматі MARCXML
+        (<collection>), розбір потоковий. Якщо Koha не підтримує списки в MARCXML —
+        відкат до поштучних запитів.
+        :return: { biblionumber: record (як get_biblio_record) }; відсутніх ID у словнику немає,
+                 а ID, які при поштучному відкаті не вдалося отримати (мережа, 5xx), мають значення None
+        """
+        ids = [int(i) for i in biblio_ids]
+        if not ids: return {}
+        url = f"{self.base_url}/api/v1/biblios"
+        params = {"q": json.dumps({"biblio_id": ids}), "_per_page": len(ids)}
+        try:
+            resp = self.session.get(url, params=params, headers={"Accept": "application/marcxml+xml"}, timeout=TIMEOUT)
+            if resp.status_code == 200:
+                parsed = list(iter_records(BytesIO(resp.content)))
+                # Без 999$c запис не зіставити з ID — тоді надійніше поштучно
+                if all(rec['biblionumber'] for rec in parsed):
+                    return {rec['biblionumber']: rec for rec in parsed}
+                logger.warning("Bulk MARCXML records lack 999$c, falling back to single requests")
+            else:
+                logger.warning(f"Bulk MARCXML not available ({resp.status_code}), falling back to single requests")
+        except Exception as e:
+            logger.warning(f"Bulk MARCXML request failed ({e}), falling back to single requests")
 
-        fields_956 = record.get_fields('956')
-        if not fields_956: return None
-        
-        field = fields_956[0]
-        return {
-            "file_path": self._get_subfield_safe(field, 'u'),
-            "collection_uuid": self._get_subfield_safe(field, 'x'),
-            "status": self._get_subfield_safe(field, 'y'),
-            "dspace_uuid": self._get_subfield_safe(field, '3')
-        }
+        records = {}
+        for biblio_id in ids:
+            xml_data, answered = self._fetch_biblio_xml(biblio_id)
+            if xml_data: records[biblio_id] = parse_biblio(xml_data)
+            elif not answered: records[biblio_id] = None
+        return records
+
+    def get_biblio_metadata(self, biblio_id: int):
+        record = self.get_biblio_record(biblio_id)
+        return record['koha'] if record else None
     
     def get_biblio_timestamp(self, biblio_id: int):
         url = f"{self.base_url}/api/v1/biblios/{biblio_id}"
@@ -77,6 +123,58 @@ class KohaClient:
             return None
         except: return None
 
+    def get_pending_files(self):
+        """
+        Повертає { "956$u": biblionumber } для записів, що чекають імпорту.
+        Дані беруться зі збереженого SQL-звіту Koha (svc/report), одним запитом.
+        """
+        if not KOHA_PENDING_REPORT_ID: return {}
+        if not self._ensure_cgi_login(): return {}
+
+        url = f"{self.base_url}/cgi-bin/koha/svc/report"
+        try:
+            resp = self.cgi_session.get(url, params={'id': KOHA_PENDING_REPORT_ID}, timeout=TIMEOUT)
+            if resp.status_code != 200: return {}
+            pending = {}
+            for row in resp.json():
+                if len(row) < 2 or not row[1]: continue
+                pending[str(row[1]).strip()] = int(row[0])
+            return pending
+        except Exception as e:
+            logger.warning(f"Failed to load pending report: {e}")
+            return {}
+
+    def iter_biblios_modified_since(self, since, per_page=100):
+        """
+        Генерує biblio_id записів, змінених після `since` (ISO рядок, час сервера Koha).
+        Koha REST: GET /biblios з фільтром q по timestamp, посторінково.
+        """
+        url = f"{self.base_url}/api/v1/biblios"
+        query = json.dumps({"timestamp": {">=": since}})
+        page = 1
+        while True:
+            params = {"q": query, "_page": page, "_per_page": per_page, "_order_by": "+biblio_id"}
+            resp = self.session.get(url, params=params, headers={"Accept": "application/json"}, timeout=TIMEOUT)
+            if resp.status_code != 200:
+                raise Exception(f"Koha biblios query failed ({resp.status_code}): {resp.text[:200]}")
+            rows = resp.json()
+            for row in rows:
+                if row.get('biblio_id'): yield int(row['biblio_id'])
+            if len(rows) < per_page: break
+            page += 1
+
+    def get_biblio_id_range(self):
+        """(min, max) biblionumber у каталозі — два запити з сортуванням, без сканування."""
+        url = f"{self.base_url}/api/v1/biblios"
+        bounds = []
+        for order in ("+biblio_id", "-biblio_id"):
+            params = {"_page": 1, "_per_page": 1, "_order_by": order}
+            resp = self.session.get(url, params=params, headers={"Accept": "application/json"}, timeout=TIMEOUT)
+            if resp.status_code != 200 or not resp.json():
+                return None
+            bounds.append(int(resp.json()[0]['biblio_id']))
+        return tuple(bounds)
+
     # --- 🟢 ROBUST COVER UPLOAD & SCRAPING ---
 
     def check_cover_exists(self, biblionumber):
@@ -100,12 +198,22 @@ class KohaClient:
         1. Скрапінг Staff-інтерфейсу (tools) для отримання ID.
         2. Формування лінка на OPAC-інтерфейс.
         """
-        if not self._ensure_cgi_login(): return None
+        return self.lookup_cover_image_url(biblionumber)[0]
+
+    def lookup_cover_image_url(self, biblionumber):
+        """
+        Як get_cover_image_url, але відрізняє «обкладинки немає» від «Koha не відповіла».
+        :return: (url або None, answered)
+        """
+        if not self._ensure_cgi_login(): return None, False
         
         # Йдемо в адмінку (Staff URL)
         url = f"{self.base_url}/cgi-bin/koha/tools/upload-cover-image.pl"
         try:
             resp = self.cgi_session.get(url, params={'biblionumber': biblionumber}, timeout=10)
+            if resp.status_code != 200: return None, False
+            # Сторінка логіну замість інструментів (сесія не встановилась) — це не «обкладинки немає»
+            if "Log out" not in resp.text and "Вихід" not in resp.text: return None, False
             
             # Шукаємо ID картинки через Regex
             match = re.search(r'imagenumber=(\d+)', resp.text)
@@ -116,11 +224,12 @@ class KohaClient:
                 # Чистимо можливі хвости API, якщо користувач вказав base url як api endpoint
                 base_host = KOHA_OPAC_URL.split("/api/v1")[0].rstrip('/')
                 
-                return f"{base_host}/cgi-bin/koha/opac-image.pl?imagenumber={image_id}"
+                return f"{base_host}/cgi-bin/koha/opac-image.pl?imagenumber={image_id}", True
+            return None, True
                 
         except Exception as e:
             logger.warning(f"Failed to scrape cover URL: {e}")
-        return None
+        return None, False
 
     def upload_cover(self, biblionumber, file_path):
         if not os.path.exists(file_path):
@@ -229,7 +338,19 @@ class KohaClient:
     def set_success(self, biblio_id, handle_url, item_uuid=None, cover_url=None):
         return self._update_956(biblio_id, status="imported", handle_url=handle_url, item_uuid=item_uuid, cover_url=cover_url)
 
+    def set_item_uuid(self, biblio_id, item_uuid):
+        """Записує лише 956$3 (статус і лог не чіпає)."""
+        return self._update_956(biblio_id, item_uuid=item_uuid)
+
+    def set_cover_url(self, biblio_id, cover_url):
+        """Оновлює лише 956$c (статус і лог не чіпає)."""
+        return self._update_956(biblio_id, cover_url=cover_url)
+
     def _update_956(self, biblio_id, status=None, log_msg=None, handle_url=None, item_uuid=None, cover_url=None):
+        with _record_lock(biblio_id):
+            return self._update_956_locked(biblio_id, status, log_msg, handle_url, item_uuid, cover_url)
+
+    def _update_956_locked(self, biblio_id, status, log_msg, handle_url, item_uuid, cover_url):
         xml_data = self._get_biblio_xml(biblio_id)
         if not xml_data: return False
         
@@ -237,9 +358,10 @@ class KohaClient:
         fields = record.get_fields('956')
         if fields:
             f956 = fields[0]
-            for code in ['y', 'z']:
-                try: f956.delete_subfield(code)
-                except: pass
+            if status is not None or log_msg is not None:
+                for code in ['y', 'z']:
+                    try: f956.delete_subfield(code)
+                    except: pass
             
             if status: f956.add_subfield('y', status)
             if log_msg: f956.add_subfield('z', str(log_msg)[:100])
@@ -275,7 +397,3 @@ class KohaClient:
         try:
             return parse_xml_to_array(BytesIO(xml_string.encode('utf-8')))[0]
         except: return None
-    
-    def _get_subfield_safe(self, field, code):
-        try: return field.get_subfields(code)[0].strip()
-        except: return None
\ No newline at end of file
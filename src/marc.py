@@ -0,0 +1,318 @@
+"""
+Однопрохідний парсер MARCXML.
+Правила з mapping.py (або з MAPPING_CONFIG_PATH) компілюються один раз у план
+вилучення (ExtractionPlan): попередньо скомпільовані regex, індекс tag -> правила
+та набір потрібних тегів. Файл правил перечитується на льоту, без рестарту воркерів.
+Один прохід по XML дає і метадані для DSpace, і службові поля (956, 856, 005, 999).
+"""
+import os
+import re
+import json
+import time
+import threading
+import logging
+import xml.etree.ElementTree as ET
+from io import BytesIO
+
+try:
+    import yaml
+    YAML_AVAILABLE = True
+except ImportError:
+    YAML_AVAILABLE = False
+
+from .mapping import METADATA_RULES, TYPE_CONVERSION
+from .config import MAPPING_CONFIG_PATH, MAPPING_RELOAD_INTERVAL
+
+logger = logging.getLogger("KDV-MARC")
+
+HANDLE_PATTERN = re.compile(r'handle/(\d+/\d+)')
+
+# Службові поля, які потрібні інтегратору незалежно від правил мапування
+CONTROL_TAGS = {'956', '856', '999'}
+CONTROL_FIELDS = {'001', '005'}
+
+
+class CompiledRule:
+    __slots__ = ('dspace_field', 'sources', 'multivalue', 'regex', 'conversion')
+
+    def __init__(self, dspace_field, rule, type_conversion):
+        self.dspace_field = dspace_field
+        sources = rule.get('sources', [{"tag": rule.get("tag"), "subfield": rule.get("subfield")}])
+        self.sources = [(src.get('tag'), src.get('subfield')) for src in sources if src.get('tag')]
+        self.multivalue = bool(rule.get('multivalue'))
+        self.regex = re.compile(rule['regex']) if 'regex' in rule else None
+        self.conversion = type_conversion if rule.get('conversion') == 'type' else None
+
+
+class ExtractionPlan:
+    """Скомпільовані правила METADATA_RULES."""
+
+    def __init__(self, rules, type_conversion):
+        self.rules = [CompiledRule(name, rule, type_conversion) for name, rule in rules.items()]
+        self.tag_index = {}
+        for idx, rule in enumerate(self.rules):
+            for tag, _ in rule.sources:
+                self.tag_index.setdefault(tag, []).append(idx)
+        self.tags = set(self.tag_index) | CONTROL_TAGS
+
+    def extract(self, fields):
+        """
+        :param fields: { tag: [ [(code, value), ...], ... ] } — лише потрібні теги
+        :return: { dspace_field: value | [values] }
+        """
+        extracted = {}
+        active = sorted({idx for tag in fields for idx in self.tag_index.get(tag, ())})
+        for idx in active:
+            rule = self.rules[idx]
+            values = []
+            for tag, sub in rule.sources:
+                tag_fields = fields.get(tag)
+                if not tag_fields: continue
+                if rule.multivalue:
+                    for field in tag_fields:
+                        val = _first_subfield(field, sub)
+                        if val: values.append(val)
+                else:
+                    val = _first_subfield(tag_fields[0], sub)
+                    if val:
+                        values.append(val)
+                        break
+
+            final_values = []
+            for v in values:
+                if rule.regex:
+                    match = rule.regex.search(v)
+                    if match: v = match.group(1)
+                    else: continue
+                if rule.conversion is not None:
+                    v = rule.conversion.get(v, rule.conversion.get("DEFAULT"))
+                final_values.append(v)
+            if final_values:
+                extracted[rule.dspace_field] = final_values if rule.multivalue else final_values[0]
+        return extracted
+
+
+# --- ВАЛІДАЦІЯ ТА HOT-RELOAD ПРАВИЛ ---
+
+SUPPORTED_CONVERSIONS = {'type'}
+
+def validate_rules(rules, type_conversion):
+    """Перевіряє структуру правил. Кидає ValueError зі списком усіх проблем."""
+    errors = []
+    if not isinstance(rules, dict) or not rules:
+        raise ValueError("metadata_rules must be a non-empty object")
+    if not isinstance(type_conversion, dict) or "DEFAULT" not in type_conversion:
+        errors.append("type_conversion must be an object with a DEFAULT key")
+
+    for name, rule in rules.items():
+        if not isinstance(rule, dict):
+            errors.append(f"{name}: rule must be an object")
+            continue
+        sources = rule.get('sources', [{"tag": rule.get("tag"), "subfield": rule.get("subfield")}])
+        if not isinstance(sources, list) or not sources:
+            errors.append(f"{name}: 'sources' must be a non-empty list")
+            sources = []
+        for src in sources:
+            tag, sub = (src.get('tag'), src.get('subfield')) if isinstance(src, dict) else (None, None)
+            if not (isinstance(tag, str) and len(tag) == 3 and tag.isdigit()):
+                errors.append(f"{name}: invalid tag {tag!r}")
+            if not (isinstance(sub, str) and len(sub) == 1):
+                errors.append(f"{name}: invalid subfield {sub!r}")
+        if 'regex' in rule:
+            try:
+                if re.compile(rule['regex']).groups < 1:
+                    errors.append(f"{name}: regex needs a capture group")
+            except (re.error, TypeError) as e:
+                errors.append(f"{name}: bad regex ({e})")
+        if 'conversion' in rule and rule['conversion'] not in SUPPORTED_CONVERSIONS:
+            errors.append(f"{name}: unknown conversion {rule['conversion']!r}")
+        if 'multivalue' in rule and not isinstance(rule['multivalue'], bool):
+            errors.append(f"{name}: 'multivalue' must be true/false")
+
+    if errors:
+        raise ValueError("; ".join(errors))
+
+def load_mapping_file(path):
+    """
+    Читає JSON/YAML файл правил:
+      { "metadata_rules": {...}, "type_conversion": {...} }
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        if path.endswith(('.yaml', '.yml')):
+            if not YAML_AVAILABLE:
+                raise ValueError("PyYAML is not installed, use a .json mapping file")
+            data = yaml.safe_load(f)
+        else:
+            data = json.load(f)
+    if not isinstance(data, dict):
+        raise ValueError("mapping file must contain an object")
+    rules = data.get('metadata_rules')
+    type_conversion = data.get('type_conversion', TYPE_CONVERSION)
+    validate_rules(rules, type_conversion)
+    return rules, type_conversion
+
+def diff_rules(old_rules, old_types, new_rules, new_types):
+    """Поля DSpace, на які вплинула зміна правил (для точкового re-sync)."""
+    changed = {name for name in set(old_rules) | set(new_rules) if old_rules.get(name) != new_rules.get(name)}
+    if old_types != new_types:
+        changed |= {name for name, rule in new_rules.items() if rule.get('conversion') == 'type'}
+    return sorted(changed)
+
+
+class PlanRegistry:
+    """
+    Тримає поточний скомпільований план. Файл правил перевіряється не частіше,
+    ніж раз на MAPPING_RELOAD_INTERVAL секунд; новий план підміняється атомарно
+    (одне присвоєння), а битий файл логується і ігнорується — працює старий план.
+    """
+
+    def __init__(self, path=MAPPING_CONFIG_PATH, interval=MAPPING_RELOAD_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._rules = METADATA_RULES
+        self._types = TYPE_CONVERSION
+        self._plan = ExtractionPlan(METADATA_RULES, TYPE_CONVERSION)
+        self._mtime = None
+        self._checked_at = 0
+        self.version = 1
+        self.changed_fields = []
+        self.last_error = None
+        if self.path: self.reload(force=True)
+
+    def get(self):
+        if self.path and time.time() - self._checked_at >= self.interval:
+            self.reload()
+        return self._plan
+
+    def reload(self, force=False):
+        """Перечитує файл, якщо він змінився. Повертає True, якщо план замінено (зміст інший)."""
+        with self._lock:
+            self._checked_at = time.time()
+            mtime = None
+            try:
+                mtime = os.stat(self.path).st_mtime
+                if not force and mtime == self._mtime: return False
+                rules, types = load_mapping_file(self.path)
+                # touch чи примусовий reload без змін: версія і changed_fields лишаються як були
+                if rules == self._rules and types == self._types:
+                    self._mtime = mtime
+                    self.last_error = None
+                    return False
+                plan = ExtractionPlan(rules, types)
+            except Exception as e:
+                self.last_error = str(e)
+                if mtime: self._mtime = mtime  # битий файл не перечитуємо, доки його не змінять
+                logger.error(f"❌ Mapping reload failed ({self.path}): {e}. Keeping version {self.version}.")
+                return False
+
+            self.changed_fields = diff_rules(self._rules, self._types, rules, types)
+            self._rules, self._types, self._mtime = rules, types, mtime
+            self._plan = plan
+            self.version += 1
+            self.last_error = None
+            logger.info(f"🔁 Mapping v{self.version} loaded from {self.path}. Changed fields: {self.changed_fields}")
+            return True
+
+    def info(self):
+        return {
+            "version": self.version,
+            "source": self.path or "mapping.py",
+            "fields": sorted(self._rules),
+            "changed_fields": self.changed_fields,
+            "last_error": self.last_error
+        }
+
+
+plan_registry = PlanRegistry()
+
+def get_plan():
+    return plan_registry.get()
+
+
+def _local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+def _first_subfield(field, code):
+    for sub_code, value in field:
+        if sub_code == code: return value
+    return None
+
+def _strip_or_none(value):
+    return value.strip() if value else None
+
+
+def parse_record_element(record_elem, plan=None):
+    """
+    Розбір одного <record>. Повертає:
+    {
+      "metadata": {...DSpace поля..., "handle": "123/456" | None},
+      "koha": { file_path, collection_uuid, status, dspace_uuid } | None  (956),
+      "timestamp": "20240101120000.0" | None  (005),
+      "biblionumber": int | None  (999$c / 001)
+    }
+    """
+    plan = plan or get_plan()
+    fields = {}
+    controls = {}
+    for child in record_elem:
+        name = _local_name(child.tag)
+        tag = child.get('tag')
+        if name == 'controlfield':
+            if tag in CONTROL_FIELDS: controls[tag] = child.text or ''
+        elif name == 'datafield' and tag in plan.tags:
+            subfields = [(sf.get('code'), sf.text or '') for sf in child]
+            fields.setdefault(tag, []).append(subfields)
+
+    metadata = plan.extract(fields)
+
+    handle = None
+    if '856' in fields:
+        url = _first_subfield(fields['856'][0], 'u')
+        match = HANDLE_PATTERN.search(url) if url else None
+        if match: handle = match.group(1)
+    metadata['handle'] = handle
+
+    koha = None
+    if '956' in fields:
+        f956 = fields['956'][0]
+        koha = {
+            "file_path": _strip_or_none(_first_subfield(f956, 'u')),
+            "collection_uuid": _strip_or_none(_first_subfield(f956, 'x')),
+            "status": _strip_or_none(_first_subfield(f956, 'y')),
+            "dspace_uuid": _strip_or_none(_first_subfield(f956, '3'))
+        }
+
+    biblionumber = None
+    raw_id = _first_subfield(fields['999'][0], 'c') if '999' in fields else controls.get('001')
+    if raw_id and raw_id.strip().isdigit():
+        biblionumber = int(raw_id.strip())
+
+    return {"metadata": metadata, "koha": koha, "timestamp": controls.get('005'), "biblionumber": biblionumber}
+
+
+def iter_records(source, plan=None):
+    """
+    Потоковий розбір MARCXML (один запис або <collection>).
+    Оброблені елементи одразу звільняються, тож пам'ять не росте з розміром файлу.
+    :param source: шлях до файлу або file-like об'єкт
+    """
+    root = None
+    for event, elem in ET.iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            if root is None: root = elem
+            continue
+        if _local_name(elem.tag) == 'record':
+            yield parse_record_element(elem, plan)
+            elem.clear()
+            if root is not None and root is not elem: root.clear()
+
+
+def parse_biblio(xml_data, plan=None):
+    """Розбір відповіді Koha /biblios/{id} (MARCXML рядок). None, якщо XML битий."""
+    try:
+        for parsed in iter_records(BytesIO(xml_data.encode('utf-8')), plan):
+            return parsed
+    except Exception as e:
+        logger.warning(f"Could not parse MARC details: {e}")
+    return None
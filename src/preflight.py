@@ -0,0 +1,62 @@
+import os
+import re
+import mmap
+import logging
+
+logger = logging.getLogger("KDV-Preflight")
+
+HEADER_WINDOW = 1024    # %PDF- має бути на початку файлу
+TRAILER_WINDOW = 2048   # startxref / %%EOF шукаємо лише в хвості
+TRAILER_MAX_WINDOW = 1024 * 1024   # ...а якщо там немає — глибше (padding після %%EOF)
+XREF_SLACK = 32         # допуск на неточний offset (poppler такі файли читає)
+XREF_OBJ_PATTERN = re.compile(rb'\d+\s+\d+\s+obj\b')
+
+
+def check_pdf(file_path):
+    """
+    Швидка перевірка цілісності PDF без повного читання файлу.
+    Через mmap читаються лише заголовок, хвіст і початок таблиці xref,
+    тож навіть на rclone-диску це кілька сторінок, а не 250 MB.
+    :return: (True, None) або (False, "причина")
+    :raises OSError: файл не вдалося прочитати (мережевий диск, права) — це не битий PDF
+    """
+    try:
+        size = os.path.getsize(file_path)
+        if size == 0:
+            return False, "empty file"
+
+        with open(file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            # 1. Заголовок
+            if mm.find(b'%PDF-', 0, min(HEADER_WINDOW, size)) == -1:
+                return False, "missing %PDF header"
+
+            # 2. Трейлер (файл обрізаний, якщо немає %%EOF у хвості)
+            eof_pos = mm.rfind(b'%%EOF', max(0, size - TRAILER_WINDOW), size)
+            if eof_pos == -1:
+                eof_pos = mm.rfind(b'%%EOF', max(0, size - TRAILER_MAX_WINDOW), size)
+            if eof_pos == -1:
+                return False, "missing %%EOF (truncated?)"
+
+            startxref_pos = mm.rfind(b'startxref', max(0, eof_pos - TRAILER_WINDOW), eof_pos)
+            if startxref_pos == -1:
+                return False, "missing startxref"
+
+            match = re.match(rb'startxref\s+(\d+)', mm[startxref_pos:min(size, startxref_pos + 64)])
+            if not match:
+                return False, "unreadable startxref offset"
+
+            # 3. xref: класична таблиця або xref-stream (PDF 1.5+)
+            xref_offset = int(match.group(1))
+            if xref_offset >= size:
+                return False, f"xref offset {xref_offset} beyond EOF"
+            head = mm[max(0, xref_offset - XREF_SLACK):min(size, xref_offset + 64)]
+            if b'xref' not in head and not XREF_OBJ_PATTERN.search(head):
+                return False, f"no xref at offset {xref_offset}"
+
+        return True, None
+    except OSError:
+        raise
+    except Exception as e:
+        # Структура, яку не вдалося розібрати (напр. файл обрізали між getsize і mmap)
+        logger.warning(f"Preflight failed to parse {file_path}: {e}")
+        return False, f"unreadable: {e}"
@@ -0,0 +1,124 @@
+"""
+Локальний індекс «хто зараз інтегрує biblio» та «який Item уже створено».
+Solr індексує новий Item із затримкою, тому find_item_by_biblionumber не бачить
+щойно створені айтеми; таблиця reservations атомарно (BEGIN IMMEDIATE)
+відповідає на обидва питання ще до запиту в Solr.
+"""
+import os
+import time
+import uuid
+import sqlite3
+import socket
+import logging
+
+from .config import STATE_DB_PATH, RESERVATION_TTL, RESERVATION_ITEM_TTL
+from .state import StateStore
+
+logger = logging.getLogger("KDV-Reservations")
+
+NODE_ID = socket.gethostname()
+# Ідентифікатор запуску процесу. hostname контейнера після rebuild інший, а PID
+# воркера gunicorn після рестарту часто той самий — тож «свої» claim-и впізнаємо лише так
+BOOT_ID = uuid.uuid4().hex
+
+
+class ReservationIndex(StateStore):
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS reservations (
+        biblionumber INTEGER PRIMARY KEY,
+        owner        TEXT,      -- task_id активної інтеграції, у кластері job_id:вузол:спроба (NULL — claim звільнено)
+        node         TEXT,
+        pid          INTEGER,
+        boot         TEXT,      -- BOOT_ID процесу, що взяв claim
+        item_uuid    TEXT,      -- створений/знайдений Item
+        handle       TEXT,
+        claimed_at   REAL,
+        expires_at   REAL,      -- claim без оновлення довше RESERVATION_TTL вважається мертвим
+        item_seen_at REAL
+    );
+    """
+
+    def __init__(self, path):
+        super().__init__(path)
+        # БД, створена до появи колонки boot
+        columns = {row['name'] for row in self.query("PRAGMA table_info(reservations)")}
+        if 'boot' not in columns:
+            try:
+                self._connect().execute("ALTER TABLE reservations ADD COLUMN boot TEXT")
+            except sqlite3.OperationalError:
+                pass  # колонку щойно додав інший процес
+
+    def claim(self, biblionumber, owner, ttl=RESERVATION_TTL):
+        """
+        Атомарно бере biblio в роботу.
+        :return: (True, None) або (False, рядок чужого активного claim)
+        """
+        now = time.time()
+        with self.transaction() as conn:
+            row = conn.execute("SELECT * FROM reservations WHERE biblionumber = ?", (biblionumber,)).fetchone()
+            if row and row['owner'] and row['owner'] != owner and row['expires_at'] > now:
+                return False, dict(row)
+            if row and row['owner'] and row['owner'] != owner:
+                logger.warning(f"⌛ #{biblionumber}: stale claim of {row['owner']} ({row['node']}) taken over")
+            conn.execute(
+                "INSERT INTO reservations (biblionumber, owner, node, pid, boot, claimed_at, expires_at) VALUES (?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(biblionumber) DO UPDATE SET owner=excluded.owner, node=excluded.node, pid=excluded.pid, "
+                "boot=excluded.boot, claimed_at=excluded.claimed_at, expires_at=excluded.expires_at",
+                (biblionumber, owner, NODE_ID, os.getpid(), BOOT_ID, now, now + ttl))
+        return True, None
+
+    def active_claim(self, biblionumber):
+        """Чужий живий claim (для швидкого 409 в API) або None."""
+        rows = self.query("SELECT * FROM reservations WHERE biblionumber = ? AND owner IS NOT NULL AND expires_at > ?",
+                          (biblionumber, time.time()))
+        return rows[0] if rows else None
+
+    def refresh(self, biblionumber, owner, ttl=RESERVATION_TTL):
+        """Продовжує claim (викликається на кожному кроці інтеграції)."""
+        with self.transaction() as conn:
+            conn.execute("UPDATE reservations SET expires_at = ? WHERE biblionumber = ? AND owner = ?",
+                         (time.time() + ttl, biblionumber, owner))
+
+    def set_item(self, biblionumber, item_uuid, handle=None):
+        with self.transaction() as conn:
+            conn.execute("UPDATE reservations SET item_uuid = ?, handle = ?, item_seen_at = ? WHERE biblionumber = ?",
+                         (item_uuid, handle, time.time(), biblionumber))
+
+    def known_item(self, biblionumber, ttl=RESERVATION_ITEM_TTL):
+        """
+        Item, який цей інтегратор створив/бачив нещодавно (Solr міг ще не проіндексувати).
+        :return: {"uuid", "handle"} або None
+        """
+        rows = self.query("SELECT item_uuid, handle FROM reservations WHERE biblionumber = ? "
+                          "AND item_uuid IS NOT NULL AND item_seen_at > ?", (biblionumber, time.time() - ttl))
+        return {"uuid": rows[0]['item_uuid'], "handle": rows[0]['handle']} if rows else None
+
+    def forget_item(self, biblionumber):
+        """Item видалено/недоступний: наступна спроба піде до Solr."""
+        with self.transaction() as conn:
+            conn.execute("UPDATE reservations SET item_uuid = NULL, handle = NULL WHERE biblionumber = ?", (biblionumber,))
+
+    def release(self, biblionumber, owner):
+        """Звільняє claim; відомості про Item лишаються (до RESERVATION_ITEM_TTL)."""
+        with self.transaction() as conn:
+            conn.execute("UPDATE reservations SET owner = NULL, expires_at = 0 WHERE biblionumber = ? AND owner = ?",
+                         (biblionumber, owner))
+
+    def release_orphaned(self, all_nodes=True):
+        """
+        Після рестарту: claim-и попередніх процесів (інший BOOT_ID) вже нікому не належать.
+        :param all_nodes: False — лише claim-и з цим hostname (у кластері БД спільна,
+                          живі claim-и інших вузлів не чіпаємо; claim-и мертвих спливуть за TTL)
+        :return: кількість звільнених
+        """
+        sql = "UPDATE reservations SET owner = NULL, expires_at = 0 WHERE owner IS NOT NULL AND boot IS NOT ?"
+        params = [BOOT_ID]
+        if not all_nodes:
+            sql += " AND node = ?"
+            params.append(NODE_ID)
+        with self.transaction() as conn:
+            return conn.execute(sql, params).rowcount
+
+
+reservations = ReservationIndex(STATE_DB_PATH)
@@ -0,0 +1,95 @@
+import time
+import threading
+from contextlib import contextmanager
+import requests
+from requests.adapters import HTTPAdapter
+
+from .breaker import get_breaker
+
+# Журнал викликів поточного потоку: [(backend, секунди), ...] (для звітів з латентностями)
+_call_log = threading.local()
+
+@contextmanager
+def record_calls():
+    """Збирає тривалість усіх HTTP-викликів, зроблених у цьому потоці всередині блоку."""
+    calls = []
+    previous = getattr(_call_log, 'calls', None)
+    _call_log.calls = calls
+    try:
+        yield calls
+    finally:
+        _call_log.calls = previous
+
+
+class TokenBucket:
+    """
+    Глобальний ліміт запитів до одного бекенду (Koha / DSpace), спільний для всіх потоків.
+    rate — токенів за секунду, burst — скільки запитів можна зробити «пачкою».
+    rate <= 0 вимикає ліміт.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst if burst else max(1.0, self.rate))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        if self.rate <= 0: return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class GuardedSession(requests.Session):
+    """
+    requests.Session, яка перед кожним запитом бере токен із TokenBucket бекенду
+    та відмічає тривалість виклику в record_calls() (без часу очікування токена).
+    Поки circuit breaker бекенду відкритий — одразу кидає CircuitOpenError.
+    """
+
+    def __init__(self, limiter=None, backend=None):
+        super().__init__()
+        self.limiter = limiter
+        self.backend = backend
+        self.breaker = get_breaker(backend)
+
+    def request(self, method, url, *args, **kwargs):
+        if self.breaker: self.breaker.before_call()
+        if self.limiter: self.limiter.acquire()
+        started = time.perf_counter()
+        response, error = None, None
+        try:
+            response = super().request(method, url, *args, **kwargs)
+            return response
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            if self.breaker:
+                self.breaker.record(not self.breaker.is_failure(response, error, elapsed, kwargs.get('timeout')))
+            calls = getattr(_call_log, 'calls', None)
+            if calls is not None:
+                calls.append((self.backend, elapsed))
+
+
+def make_session(limiter=None, pool_size=10, backend=None):
+    """
+    Сесія з пулом з'єднань під потрібну кількість потоків.
+    :param pool_size: скільки keep-alive з'єднань тримати (≈ кількість воркерів)
+    :param backend: назва бекенду для звітів ("koha" / "dspace")
+    """
+    session = GuardedSession(limiter, backend)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
@@ -0,0 +1,110 @@
+import os
+import hashlib
+import threading
+import logging
+
+from .config import STAGING_DIR, STAGING_MAX_BYTES
+
+logger = logging.getLogger("KDV-Staging")
+
+
+class StagingCache:
+    """
+    Обмежений за розміром локальний кеш PDF-файлів.
+    Файл один раз стрімиться з мережевого диска (rclone) на локальний SSD,
+    паралельно рахуються розмір та MD5. Обкладинка і DSpace читають локальну копію.
+    Старі файли витісняються (LRU), файли в роботі (pinned) не чіпаються.
+    """
+
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, base_dir=STAGING_DIR, max_bytes=STAGING_MAX_BYTES):
+        self.base_dir = base_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._pins = {}     # { local_path: кількість активних користувачів }
+        self._meta = {}     # { local_path: {"path", "size", "md5"} }
+
+    def stage(self, src_path):
+        """
+        Копіює файл у кеш (або повертає вже закешовану копію) та закріплює її.
+        :return: {"path": local_path, "size": int, "md5": hex}
+        """
+        os.makedirs(self.base_dir, exist_ok=True)
+        local_path = os.path.join(self.base_dir, os.path.basename(src_path))
+
+        with self._lock:
+            cached = self._meta.get(local_path)
+            if cached and os.path.exists(local_path):
+                os.utime(local_path)  # LRU: відмічаємо використання
+                self._pins[local_path] = self._pins.get(local_path, 0) + 1
+                return dict(cached)
+            # Резервуємо слот заздалегідь, щоб паралельне витіснення його не чіпало
+            self._pins[local_path] = self._pins.get(local_path, 0) + 1
+
+        try:
+            self._make_room(os.path.getsize(src_path))
+            info = self._copy(src_path, local_path)
+        except Exception:
+            self.release(local_path)
+            raise
+
+        with self._lock:
+            self._meta[local_path] = info
+        logger.info(f"📥 Staged {os.path.basename(src_path)} ({round(info['size']/1024/1024, 1)} MB, md5={info['md5']})")
+        return dict(info)
+
+    def pin(self, local_path):
+        """Додатковий користувач локальної копії (наприклад, фонова задача обкладинки)."""
+        with self._lock:
+            self._pins[local_path] = self._pins.get(local_path, 0) + 1
+
+    def release(self, local_path):
+        """Звільняє копію. Файл лишається в кеші до витіснення."""
+        with self._lock:
+            count = self._pins.get(local_path, 0) - 1
+            if count > 0:
+                self._pins[local_path] = count
+            else:
+                self._pins.pop(local_path, None)
+
+    def _copy(self, src_path, local_path):
+        """Потокове копіювання з підрахунком розміру та контрольної суми."""
+        digest = hashlib.md5()
+        size = 0
+        tmp_path = f"{local_path}.part"
+        with open(src_path, 'rb') as src, open(tmp_path, 'wb') as dst:
+            while True:
+                chunk = src.read(self.CHUNK_SIZE)
+                if not chunk: break
+                digest.update(chunk)
+                size += len(chunk)
+                dst.write(chunk)
+        os.replace(tmp_path, local_path)
+        return {"path": local_path, "size": size, "md5": digest.hexdigest()}
+
+    def _make_room(self, incoming_size):
+        """Витісняє найстаріші незакріплені файли, поки новий файл не вміститься в ліміт."""
+        with self._lock:
+            entries = []
+            total = 0
+            with os.scandir(self.base_dir) as it:
+                for entry in it:
+                    if not entry.is_file(): continue
+                    st = entry.stat()
+                    total += st.st_size
+                    entries.append((st.st_mtime, entry.path, st.st_size))
+
+            for _, path, size in sorted(entries):
+                if total + incoming_size <= self.max_bytes: break
+                if path.removesuffix('.part') in self._pins: continue
+                try:
+                    os.remove(path)
+                    total -= size
+                    self._meta.pop(path, None)
+                except OSError as e:
+                    logger.warning(f"Could not evict {path}: {e}")
+
+
+# Єдиний екземпляр кешу для процесу
+staging_cache = StagingCache()
@@ -0,0 +1,57 @@
+"""
+Спільне локальне сховище стану на SQLite (журнали, черги, лізи).
+Один файл БД можуть відкривати кілька потоків і процесів; запис іде через
+короткі транзакції BEGIN IMMEDIATE, тож конкуренти чекають, а не ламають дані.
+"""
+import os
+import sqlite3
+import threading
+import logging
+from contextlib import contextmanager
+
+from .config import STATE_DB_JOURNAL_MODE
+
+logger = logging.getLogger("KDV-State")
+
+
+class StateStore:
+    """
+    Базовий клас для таблиць стану. Нащадки задають SCHEMA (DDL).
+    З'єднання — окреме на кожен потік (sqlite3 не любить спільних з'єднань).
+    """
+
+    SCHEMA = ""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory: os.makedirs(directory, exist_ok=True)
+        if self.SCHEMA:
+            self._connect().executescript(self.SCHEMA)
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            # WAL — для одного хоста; для БД на спільному томі між вузлами ставте DELETE
+            conn.execute(f"PRAGMA journal_mode={STATE_DB_JOURNAL_MODE}")
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        """Транзакція з негайним блокуванням на запис (атомарні claim/update)."""
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def query(self, sql, params=()):
+        return [dict(row) for row in self._connect().execute(sql, params).fetchall()]
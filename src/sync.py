@@ -0,0 +1,148 @@
+"""
+Оновлення метаданих DSpace з Koha: для одного запису (PUT, події)
+та масово (resync після зміни правил мапування).
+"""
+import time
+import itertools
+import logging
+import concurrent.futures
+
+from .config import RESYNC_WORKERS, RESYNC_DSPACE_RPS
+from .koha import KohaClient
+from .dspace import DSpaceClient
+from .sessions import TokenBucket
+from .cache import handle_uuid_cache, biblio_uuid_cache
+
+logger = logging.getLogger("KDV-Sync")
+
+RESYNC_CHUNK = 100          # biblio в одному bulk-запиті до Koha
+MAX_REPORTED_FAILURES = 200 # скільки невдач детально показувати в результаті задачі
+
+
+def sync_metadata(biblionumber, fields=None, record=None, koha=None, dspace=None):
+    """
+    Оновлює метадані DSpace-айтема з поточного запису Koha.
+    :param record: вже розібраний запис (масовий режим), інакше читається з Koha
+    :return: {"status": "success" | "error" | "not_found", ...}
+    """
+    koha = koha or KohaClient()
+    dspace = dspace or DSpaceClient()
+    record = record or koha.get_biblio_record(biblionumber)
+    if not record:
+        return {"status": "not_found", "message": "Biblio not found"}
+    md = dict(record['metadata'])
+    md['koha.biblionumber'] = str(biblionumber)
+
+    meta = record['koha'] or {}
+    item_uuid, source = resolve_item_uuid(biblionumber, meta, md.get('handle'), dspace)
+    if not item_uuid:
+        return {"status": "not_found", "message": "Item not found"}
+
+    success = dspace.update_metadata(item_uuid, md, fields=fields)
+    if not success:
+        # Можливо, айтем видалено/замінено — наступна спроба розв'яже uuid заново
+        handle_uuid_cache.invalidate(md.get('handle'))
+        biblio_uuid_cache.invalidate(biblionumber)
+        return {"status": "error", "uuid": item_uuid, "message": "DSpace PATCH failed"}
+
+    if source != '956' and meta:
+        # Запам'ятовуємо uuid у 956$3: наступні оновлення обійдуться без пошуку
+        koha.set_item_uuid(biblionumber, item_uuid)
+    return {"status": "success", "uuid": item_uuid, "resolved_by": source}
+
+def resolve_item_uuid(biblionumber, meta, handle, dspace):
+    """
+    uuid DSpace-айтема: 956$3 -> кеш/пошук за handle -> кеш/пошук за biblionumber.
+    :return: (uuid | None, джерело)
+    """
+    if meta.get('dspace_uuid'):
+        return meta['dspace_uuid'], '956'
+
+    if handle:
+        item_uuid = handle_uuid_cache.get(handle)
+        if item_uuid: return item_uuid, 'cache'
+        item_uuid = dspace.find_item_uuid_by_handle(handle)
+        if item_uuid:
+            handle_uuid_cache.set(handle, item_uuid)
+            biblio_uuid_cache.set(biblionumber, item_uuid)
+            return item_uuid, 'handle'
+
+    item_uuid = biblio_uuid_cache.get(biblionumber)
+    if item_uuid: return item_uuid, 'cache'
+    existing = dspace.find_item_by_biblionumber(biblionumber)
+    if existing:
+        biblio_uuid_cache.set(biblionumber, existing['uuid'])
+        if existing.get('handle'): handle_uuid_cache.set(existing['handle'], existing['uuid'])
+        return existing['uuid'], 'search'
+    return None, None
+
+
+def prefetch_uuids(records, dspace):
+    """
+    Масове розв'язання uuid: записи без 956$3 і без кешу шукаються в DSpace
+    одним запитом на пачку; знайдене кладеться в biblio_uuid_cache,
+    звідки його візьме resolve_item_uuid.
+    """
+    missing = [bib for bib, rec in records.items()
+               if not (rec['koha'] or {}).get('dspace_uuid') and not biblio_uuid_cache.get(bib)]
+    if not missing: return
+    for bib, hit in dspace.find_items_by_biblionumbers(missing).items():
+        biblio_uuid_cache.set(bib, hit['uuid'])
+        if hit.get('handle'): handle_uuid_cache.set(hit['handle'], hit['uuid'])
+
+
+def run_bulk_resync(ids, fields=None, workers=RESYNC_WORKERS, dspace_rps=RESYNC_DSPACE_RPS, total=None, progress=None):
+    """
+    Масовий re-sync метаданих.
+    MARC читається пачками по RESYNC_CHUNK, uuid розв'язуються пачками,
+    PATCH-і йдуть через пул із workers потоків під спільним лімітом dspace_rps.
+    :param ids: ітерований набір biblionumber (напр., IntervalSet)
+    :param progress: callback(str) для звітування прогресу
+    :return: { "total", "counts": {status: n}, "failures": [{biblionumber, status, message}] }
+    """
+    koha = KohaClient(pool_size=workers)
+    dspace = DSpaceClient(limiter=TokenBucket(dspace_rps), pool_size=workers)
+    counts = {}
+    failures = []
+    done = 0
+    started = time.time()
+    iterator = iter(ids)
+
+    def sync_one(bib, record):
+        try:
+            return sync_metadata(bib, fields, record=record, koha=koha, dspace=dspace)
+        except Exception as e:
+            return {"status": "error", "message": str(e)}
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            chunk = [int(b) for b in itertools.islice(iterator, RESYNC_CHUNK)]
+            if not chunk: break
+
+            records = koha.get_biblio_records_bulk(chunk)
+            prefetch_uuids(records, dspace)
+
+            futures = {executor.submit(sync_one, bib, records[bib]): bib for bib in chunk if records.get(bib)}
+            for bib in chunk:
+                if not records.get(bib):
+                    # None — Koha не відповіла про цей запис; це не «запису немає»
+                    status, message = ("error", "Koha unavailable") if bib in records else ("not_found", "Biblio not found")
+                    counts[status] = counts.get(status, 0) + 1
+                    if len(failures) < MAX_REPORTED_FAILURES:
+                        failures.append({"biblionumber": bib, "status": status, "message": message})
+
+            for future in concurrent.futures.as_completed(futures):
+                bib = futures[future]
+                result = future.result()
+                status = result.get('status', 'error')
+                counts[status] = counts.get(status, 0) + 1
+                if status != 'success' and len(failures) < MAX_REPORTED_FAILURES:
+                    failures.append({"biblionumber": bib, "status": status, "message": result.get('message')})
+
+            done += len(chunk)
+            rate = done / max(time.time() - started, 1e-9) * 60
+            message = f"{done}/{total or '?'} processed, {counts.get('success', 0)} updated, {done - counts.get('success', 0)} failed ({round(rate, 1)}/min)"
+            logger.info(f"🔁 Resync: {message}")
+            if progress: progress(message)
+
+    return {"total": done, "counts": counts, "failures": failures}
@@ -1,7 +1,14 @@
 import threading
 import uuid
 import time
+import json
+import hmac
+import hashlib
 import logging
+import concurrent.futures
+import requests
+
+from .config import KDV_API_TOKEN
 
 # Налаштування логера для цього модуля
 logger = logging.getLogger("KDV-Tasks")
@@ -9,18 +16,75 @@ logger = logging.getLogger("KDV-Tasks")
 # Глобальний словник для зберігання задач у пам'яті (In-Memory DB)
 # Структура: { "task_uuid": { "status": "queued", "created_at": time, ... } }
 TASKS = {}
+# Пакети задач: { "batch_uuid": { "task_ids": [...], "callback_url": ..., ... } }
+BATCHES = {}
+
+CALLBACK_RETRIES = 5        # спроби доставити callback
+CALLBACK_RETRY_DELAY = 2    # секунди, подвоюється після кожної спроби
+CALLBACK_TIMEOUT = 10
+CALLBACK_WORKERS = 4        # потоки доставки callback-ів (повтори не тримають воркери задач)
+BATCH_WORKERS = 2           # скільки задач пакета виконується одночасно
+BATCH_WATCH_INTERVAL = 5    # CLUSTER_MODE: як часто перевіряти завершення задач пакета
+
+def is_valid_callback_url(url):
+    return isinstance(url, str) and url.startswith(('http://', 'https://'))
+
+def _sign(body):
+    """HMAC-SHA256 тіла callback-а (ключ — KDV_API_TOKEN), щоб отримувач міг перевірити джерело."""
+    return hmac.new(KDV_API_TOKEN.encode('utf-8'), body, hashlib.sha256).hexdigest()
+
+def deliver_callback(url, payload):
+    """
+    POST фінального результату на callback_url з повторами (експоненційна пауза).
+    :return: True, якщо отримувач відповів 2xx
+    """
+    body = json.dumps(payload, ensure_ascii=False, default=str).encode('utf-8')
+    headers = {"Content-Type": "application/json", "X-KDV-Signature": _sign(body)}
+    delay = CALLBACK_RETRY_DELAY
+    for attempt in range(1, CALLBACK_RETRIES + 1):
+        try:
+            resp = requests.post(url, data=body, headers=headers, timeout=CALLBACK_TIMEOUT)
+            if 200 <= resp.status_code < 300:
+                return True
+            logger.warning(f"⚠️ Callback {url} -> {resp.status_code} (attempt {attempt}/{CALLBACK_RETRIES})")
+        except requests.RequestException as e:
+            logger.warning(f"⚠️ Callback {url} failed: {e} (attempt {attempt}/{CALLBACK_RETRIES})")
+        if attempt < CALLBACK_RETRIES:
+            time.sleep(delay)
+            delay *= 2
+    logger.error(f"❌ Callback {url} not delivered after {CALLBACK_RETRIES} attempts")
+    return False
+
+# Окремий пул: повільний отримувач (до ~1 хв повторів) не блокує потік задачі, пакета чи JobWorkers
+_callback_executor = concurrent.futures.ThreadPoolExecutor(max_workers=CALLBACK_WORKERS, thread_name_prefix="kdv-callback")
+
+def send_callback(url, payload, on_done=None):
+    """
+    Фонова доставка callback-а (deliver_callback у пулі CALLBACK_WORKERS).
+    :param on_done: callback(ok) — фіксація стану доставки ("delivered" / "failed")
+    """
+    def deliver():
+        ok = deliver_callback(url, payload)
+        if on_done:
+            try: on_done(ok)
+            except Exception as e: logger.error(f"❌ Callback state for {url} not saved: {e}")
+    _callback_executor.submit(deliver)
 
 class TaskManager:
     def __init__(self):
-        pass
+        # CLUSTER_MODE: спільна черга (jobs.JobQueue) і { func: kind } задач, які в неї йдуть
+        self.queue = None
+        self._cluster_kinds = {}
 
-    def start_task(self, func, *args):
+    def enable_cluster(self, queue, handlers):
         """
-        Запускає нову фонову задачу.
-        :param func: Функція, яку треба виконати (бізнес-логіка)
-        :param args: Аргументи для цієї функції (наприклад, biblionumber)
-        :return: task_id (UUID string)
+        Задачі з handlers ({kind: func}) ставляться у спільну чергу, а не в локальний потік:
+        їх виконає будь-який вузол. Решта (напр., обкладинки) лишається локальною.
         """
+        self.queue = queue
+        self._cluster_kinds = {func: kind for kind, func in handlers.items()}
+
+    def _register(self, callback_url=None):
         task_id = str(uuid.uuid4())
         
         # Ініціалізація стану задачі
@@ -29,8 +93,24 @@ class TaskManager:
             "created_at": time.time(),
             "progress": "Task initialized",
             "result": None,              # Тут буде результат (наприклад, handle посилання)
-            "error": None
+            "error": None,
+            "callback_url": callback_url,
+            "callback": None             # pending / delivered / failed (якщо задано callback_url)
         }
+        return task_id
+
+    def start_task(self, func, *args, callback_url=None):
+        """
+        Запускає нову фонову задачу.
+        :param func: Функція, яку треба виконати (бізнес-логіка)
+        :param args: Аргументи для цієї функції (наприклад, biblionumber)
+        :param callback_url: куди POST-нути фінальний стан задачі (замість опитування /status)
+        :return: task_id (UUID string)
+        """
+        if self.queue and func in self._cluster_kinds:
+            return self.queue.enqueue(self._cluster_kinds[func], args, callback_url)
+
+        task_id = self._register(callback_url)
         
         logger.info(f"🚀 [Task {task_id}] Created and Queued.")
 
@@ -68,10 +148,98 @@ class TaskManager:
             TASKS[task_id]["status"] = "error"
             TASKS[task_id]["error"] = str(e)
             TASKS[task_id]["progress"] = "Failed"
+        finally:
+            self._notify(task_id)
+
+    def _notify(self, task_id):
+        """Доставляє фінальний стан задачі на її callback_url (якщо задано)."""
+        task = TASKS.get(task_id)
+        if not task or not task.get("callback_url"): return
+        payload = {"task_id": task_id, **{k: task[k] for k in ("status", "result", "error")}}
+        task["callback"] = "pending"
+        send_callback(task["callback_url"], payload,
+                      lambda ok: task.update(callback="delivered" if ok else "failed"))
+
+    def start_batch(self, func, items, callback_url=None, task_callback_url=None):
+        """
+        Пакет задач: по одній задачі на елемент (кожна має свій task_id і /status),
+        виконуються по BATCH_WORKERS одночасно. Коли завершаться всі — один callback на пакет.
+        :return: (batch_id, { item: task_id })
+        """
+        batch_id = str(uuid.uuid4())
+        clustered = bool(self.queue and func in self._cluster_kinds)
+        if clustered:
+            task_ids = {item: self.queue.enqueue(self._cluster_kinds[func], (item,), task_callback_url) for item in items}
+        else:
+            task_ids = {item: self._register(task_callback_url) for item in items}
+        BATCHES[batch_id] = {
+            "status": "processing",
+            "created_at": time.time(),
+            "task_ids": task_ids,
+            "callback_url": callback_url,
+            "callback": None
+        }
+        logger.info(f"🚀 [Batch {batch_id}] {len(task_ids)} tasks queued.")
+
+        target = self._watch_batch if clustered else self._run_batch
+        thread = threading.Thread(target=target, args=(batch_id, func))
+        thread.daemon = True
+        thread.start()
+        return batch_id, task_ids
+
+    def _run_batch(self, batch_id, func):
+        batch = BATCHES[batch_id]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=BATCH_WORKERS) as executor:
+            for item, task_id in batch["task_ids"].items():
+                executor.submit(self._wrapper, task_id, func, (item,))
+        self._finish_batch(batch_id)
+
+    def _watch_batch(self, batch_id, func):
+        """CLUSTER_MODE: задачі пакета виконують воркери вузлів; тут лише чекаємо їх завершення."""
+        batch = BATCHES[batch_id]
+        pending = set(batch["task_ids"].values())
+        while pending:
+            time.sleep(BATCH_WATCH_INTERVAL)
+            pending = {tid for tid in pending if (self.get_status(tid) or {}).get("status") not in ("success", "error")}
+        self._finish_batch(batch_id)
+
+    def _finish_batch(self, batch_id):
+        batch = BATCHES[batch_id]
+        batch["status"] = "completed"
+        logger.info(f"🏁 [Batch {batch_id}] Completed.")
+        if batch.get("callback_url"):
+            batch["callback"] = "pending"
+            send_callback(batch["callback_url"], self.get_batch_status(batch_id),
+                          lambda ok: batch.update(callback="delivered" if ok else "failed"))
+
+    def get_batch_status(self, batch_id):
+        """Зведений стан пакета: лічильники та фінальний стан кожної задачі."""
+        batch = BATCHES.get(batch_id)
+        if not batch: return None
+        tasks = {}
+        counts = {}
+        for item, task_id in batch["task_ids"].items():
+            task = self.get_status(task_id) or {}
+            status = task.get("status", "expired")
+            counts[status] = counts.get(status, 0) + 1
+            tasks[str(item)] = {"task_id": task_id, "status": status,
+                                "result": task.get("result"), "error": task.get("error")}
+        return {"batch_id": batch_id, "status": batch["status"], "callback": batch["callback"],
+                "counts": counts, "tasks": tasks}
+
+    def update_progress(self, task_id, progress):
+        """Оновлює рядок прогресу задачі (для довгих задач, напр. масового resync)."""
+        if task_id in TASKS:
+            TASKS[task_id]["progress"] = progress
+        elif self.queue:
+            self.queue.update_progress(task_id, progress)
 
     def get_status(self, task_id):
-        """Повертає словник зі станом задачі або None"""
-        return TASKS.get(task_id)
+        """Повертає словник зі станом задачі або None (у CLUSTER_MODE — також зі спільної черги)"""
+        task = TASKS.get(task_id)
+        if task is None and self.queue:
+            task = self.queue.get(task_id)
+        return task
 
     def cleanup_old_tasks(self, max_age_seconds=3600):
         """Очищення пам'яті від старих задач (можна викликати періодично)"""
@@ -79,6 +247,10 @@ class TaskManager:
         to_delete = [tid for tid, data in TASKS.items() if now - data['created_at'] > max_age_seconds]
         for tid in to_delete:
             del TASKS[tid]
+        for bid in [b for b, data in BATCHES.items() if data['status'] == 'completed' and now - data['created_at'] > max_age_seconds]:
+            del BATCHES[bid]
+        if self.queue:
+            self.queue.cleanup(max_age_seconds)
         if to_delete:
             logger.info(f"🧹 Cleaned up {len(to_delete)} old tasks.")
 
@@ -0,0 +1,76 @@
+import os
+import re
+import threading
+import logging
+
+logger = logging.getLogger("KDV-Versioning")
+
+VERSION_PATTERN = re.compile(r'^biblio_(\d+)_v(\d+)(?:_[0-9a-f]+)?\.pdf$')
+MAX_VERSION = 999
+
+
+class VersionIndex:
+    """
+    Кешований індекс версій файлів у папках Processed.
+    Папка читається один раз (os.scandir), далі версії видаються з пам'яті,
+    без os.path.exists-проб через rclone FUSE.
+    Структура: { "/mnt/drive/.../Processed": { "123": 2, ... } }
+    """
+
+    def __init__(self):
+        self._dirs = {}
+        self._lock = threading.Lock()
+
+    def _load_dir(self, target_dir):
+        """Одноразове сканування папки та побудова індексу максимальних версій."""
+        index = {}
+        os.makedirs(target_dir, exist_ok=True)
+        with os.scandir(target_dir) as it:
+            for entry in it:
+                match = VERSION_PATTERN.match(entry.name)
+                if not match: continue
+                bib, ver = match.group(1), int(match.group(2))
+                if ver > index.get(bib, 0):
+                    index[bib] = ver
+        logger.info(f"📇 Indexed {len(index)} biblios in {target_dir}")
+        return index
+
+    def allocate(self, target_dir, biblionumber):
+        """
+        Атомарно резервує наступну версію для biblionumber.
+        Повертає повний шлях (файл ще не існує).
+        """
+        bib = str(biblionumber)
+        with self._lock:
+            index = self._dirs.get(target_dir)
+            if index is None:
+                index = self._dirs[target_dir] = self._load_dir(target_dir)
+
+            version = index.get(bib, 0) + 1
+            if version > MAX_VERSION:
+                return os.path.join(target_dir, f"biblio_{bib}_v{MAX_VERSION}_{os.urandom(4).hex()}.pdf")
+
+            full_path = os.path.join(target_dir, f"biblio_{bib}_v{version:02d}.pdf")
+            # Захист від змін поза процесом (ручне копіювання на диск): одна перевірка
+            # замість циклу. Якщо слот зайнятий — перечитуємо папку.
+            if os.path.exists(full_path):
+                index = self._dirs[target_dir] = self._load_dir(target_dir)
+                version = max(index.get(bib, 0), version) + 1
+                if version > MAX_VERSION:
+                    return os.path.join(target_dir, f"biblio_{bib}_v{MAX_VERSION}_{os.urandom(4).hex()}.pdf")
+                full_path = os.path.join(target_dir, f"biblio_{bib}_v{version:02d}.pdf")
+
+            index[bib] = version
+            return full_path
+
+    def invalidate(self, target_dir=None):
+        """Скидає кеш (для однієї папки або повністю)."""
+        with self._lock:
+            if target_dir is None:
+                self._dirs.clear()
+            else:
+                self._dirs.pop(target_dir, None)
+
+
+# Єдиний екземпляр індексу для процесу
+version_index = VersionIndex()
@@ -0,0 +1,167 @@
+import os
+import time
+import threading
+import logging
+
+from .config import INTEGRATOR_MOUNT_PATH, FOLDER_PROCESSED, FOLDER_ERROR, WATCHER_INTERVAL
+
+logger = logging.getLogger("KDV-Watcher")
+
+# Папки, які пише сам інтегратор — їх не скануємо. Processed/Error створюються
+# поруч із кожним PDF (на будь-якій глибині), covers — лише в корені
+SKIP_DIRS = {FOLDER_PROCESSED, FOLDER_ERROR}
+SKIP_ROOT_DIRS = SKIP_DIRS | {"covers"}
+# Як часто перепитувати Koha про файли, що лежать на диску, але ще не мають 956$u
+UNMATCHED_RECHECK = 600
+
+
+def normalize_rel_path(path):
+    """Приводить 956$u та шлях на диску до спільного вигляду для порівняння."""
+    return os.path.normpath(path.strip()).lstrip('/')
+
+
+class InboxWatcher:
+    """
+    Інкрементальний сканер INTEGRATOR_MOUNT_PATH.
+    Тримає знімок папок (mtime) та файлів (mtime, size): папка перелічується
+    повторно лише тоді, коли змінився її mtime. Новий PDF вважається готовим,
+    коли його розмір і mtime не змінились між двома проходами (rclone дописав файл).
+    Готові файли зіставляються з biblio, що чекають імпорту (956$u), і ставляться в чергу.
+    """
+
+    def __init__(self, koha_client, on_match, root=INTEGRATOR_MOUNT_PATH, interval=WATCHER_INTERVAL):
+        """
+        :param koha_client: KohaClient (для звіту pending 956$u)
+        :param on_match: callback(biblionumber) — постановка інтеграції в чергу
+        """
+        self.koha = koha_client
+        self.on_match = on_match
+        self.root = root
+        self.interval = interval
+        self._dirs = {}       # { dir_path: (mtime, [subdirs], [pdf files]) }
+        self._files = {}      # { file_path: (mtime, size) } — останній бачений стан
+        self._unstable = {}   # { file_path: (mtime, size) } — ще можуть дописуватись
+        self._ready = set()   # готові, але ще не зіставлені з biblio
+        self._enqueued = set()
+        self._last_report = 0
+        self._stop = threading.Event()
+
+    def scan(self):
+        """Один інкрементальний прохід. Повертає множину нових/змінених PDF."""
+        changed = set()
+        seen_dirs = set()
+        stack = [self.root]
+
+        while stack:
+            current = stack.pop()
+            seen_dirs.add(current)
+            try:
+                dir_mtime = os.stat(current).st_mtime
+            except OSError:
+                continue
+
+            cached = self._dirs.get(current)
+            if cached and cached[0] == dir_mtime:
+                stack.extend(cached[1])
+                continue
+
+            subdirs, files = [], []
+            try:
+                with os.scandir(current) as it:
+                    for entry in it:
+                        if entry.name.startswith('.'): continue
+                        if entry.is_dir(follow_symlinks=False):
+                            if entry.name in (SKIP_ROOT_DIRS if current == self.root else SKIP_DIRS): continue
+                            subdirs.append(entry.path)
+                        elif entry.name.lower().endswith('.pdf'):
+                            st = entry.stat()
+                            state = (st.st_mtime, st.st_size)
+                            files.append(entry.path)
+                            if self._files.get(entry.path) != state:
+                                self._files[entry.path] = state
+                                changed.add(entry.path)
+            except OSError as e:
+                logger.warning(f"Could not list {current}: {e}")
+                continue
+
+            # Файли, що зникли з папки (інтегровані або видалені), забуваємо
+            if cached:
+                for gone in set(cached[2]) - set(files):
+                    self._forget(gone)
+            self._dirs[current] = (dir_mtime, subdirs, files)
+            stack.extend(subdirs)
+
+        for gone_dir in set(self._dirs) - seen_dirs:
+            for gone in self._dirs.pop(gone_dir)[2]:
+                self._forget(gone)
+
+        return changed
+
+    def _forget(self, path):
+        self._files.pop(path, None)
+        self._unstable.pop(path, None)
+        self._ready.discard(path)
+        self._enqueued.discard(path)
+
+    def poll(self):
+        """Сканування + перевірка стабільності + зіставлення з Koha."""
+        for path in self.scan():
+            self._unstable[path] = self._files[path]
+
+        # Перевіряємо лише файли, що могли дописуватись (точковий stat, без повного пересканування)
+        fresh = False
+        for path, state in list(self._unstable.items()):
+            try:
+                st = os.stat(path)
+            except OSError:
+                self._forget(path)
+                continue
+            current = (st.st_mtime, st.st_size)
+            if current == state and st.st_size > 0:
+                del self._unstable[path]
+                if path not in self._enqueued:
+                    self._ready.add(path)
+                    fresh = True
+            else:
+                self._unstable[path] = current
+                self._files[path] = current
+
+        if not self._ready: return 0
+        # Звіт Koha тягнемо лише для нових файлів або зрідка для незіставлених
+        if not fresh and time.time() - self._last_report < UNMATCHED_RECHECK: return 0
+
+        self._last_report = time.time()
+        pending = self.koha.get_pending_files()
+        pending = {normalize_rel_path(k): v for k, v in pending.items()}
+        enqueued = 0
+        for path in list(self._ready):
+            rel_path = normalize_rel_path(os.path.relpath(path, self.root))
+            biblionumber = pending.get(rel_path)
+            if not biblionumber: continue
+            try:
+                self.on_match(biblionumber)
+                self._ready.discard(path)
+                self._enqueued.add(path)
+                enqueued += 1
+                logger.info(f"📬 [Watcher] {rel_path} -> Biblio #{biblionumber} enqueued")
+            except Exception as e:
+                logger.error(f"❌ [Watcher] Failed to enqueue #{biblionumber}: {e}")
+        return enqueued
+
+    def run_forever(self):
+        logger.info(f"👀 [Watcher] Watching {self.root} every {self.interval}s")
+        while not self._stop.is_set():
+            try:
+                self.poll()
+            except Exception as e:
+                logger.error(f"❌ [Watcher] Poll failed: {e}")
+            self._stop.wait(self.interval)
+
+    def start(self):
+        thread = threading.Thread(target=self.run_forever, name="kdv-watcher")
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def stop(self):
+        self._stop.set()